@@ -0,0 +1,515 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Compressed archive format for data sets and vintage stores.
+
+Cumulative series change by small amounts from one day to the next, so each
+series is stored as the differences between its values, zigzag / varint
+encoded (small differences take a single byte), and the encoded series of
+an attribute are compressed with zlib or lzma in blocks of BLOCK_SERIES
+series.  Missing values are stored as run lengths, float series (ie incident
+rates) as their raw bytes grouped by byte position, which compresses better.
+
+An archive file is MAGIC, the length of a json index, the index and the
+compressed blocks.  The index holds the dates, the tree and where each node
+series is, so Covid19_Archive.get_series only decompresses the block of the
+requested node.  save_vintages / load_vintages store a Vintage_Store the same
+way (the base snapshot in blocks, every vintage delta in a block of its own).
+"""
+import datetime
+import json
+import lzma
+import os
+import zlib
+
+import numpy as np
+
+import covid19_data
+import covid19_metrics
+import covid19_series
+import covid19_vintages
+
+
+MAGIC = b"C19ARCH1"
+
+# incremented whenever the encoding changes, older archives can't be read
+ARCHIVE_VERSION = 1
+
+COMPRESSIONS = {
+    "zlib": (lambda data: zlib.compress(data, 9), zlib.decompress),
+    "lzma": (lzma.compress, lzma.decompress),
+    }
+
+# number of series compressed together, reading one series decompresses its whole block
+BLOCK_SERIES = 256
+
+# kinds of encoded series
+INT_SERIES = 0
+FLOAT_SERIES = 1
+
+
+def _encode_varints(values):
+    """
+    Outputs: bytes of an int64 array as zigzag encoded varints (7 bits per byte, high bit set on every byte but the last)
+    """
+    values = np.asarray(values, dtype=np.int64)
+    zigzag = ((values << 1) ^ (values >> 63)).view(np.uint64)
+    shifts = np.arange(10, dtype=np.uint64) * np.uint64(7)
+    byte_count = 1 + (zigzag[:, None] >= (np.uint64(1) << shifts[1:])).sum(axis=1)
+    groups = ((zigzag[:, None] >> shifts) & np.uint64(0x7f)).astype(np.uint8)
+    groups[np.arange(10) < (byte_count - 1)[:, None]] |= 0x80
+    return groups[np.arange(10) < byte_count[:, None]].tobytes()
+
+
+def _decode_varints(buffer, count, position=0):
+    """
+    Outputs: (int64 array of the count varints starting at position of a uint8 array (every varint up to the end if count
+    is None), position after the last one)
+    """
+    ends = np.flatnonzero(buffer[position:] < 0x80)[:count]
+    if count is not None and len(ends) < count:
+        raise ValueError("truncated archive data")
+    if not len(ends):
+        return np.zeros(0, dtype=np.int64), position
+    chunk = buffer[position:position + ends[-1] + 1]
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    byte_positions = np.arange(len(chunk)) - np.repeat(starts, ends - starts + 1)
+    parts = (chunk & 0x7f).astype(np.uint64) << (byte_positions * 7).astype(np.uint64)
+    zigzag = np.bitwise_or.reduceat(parts, starts)
+    values = (zigzag >> np.uint64(1)).view(np.int64) ^ -(zigzag & np.uint64(1)).view(np.int64)
+    return values, position + len(chunk)
+
+
+def _encode_series(series):
+    """
+    Outputs: bytes of a node series (list, Compact_Series or Sparse_Series with None for missing values)
+    """
+    if isinstance(series, (covid19_series.Compact_Series, covid19_series.Sparse_Series)):
+        series = series.tolist()
+    present = np.array([value is not None for value in series], dtype=bool)
+    values = np.array([value for value in series if value is not None])
+    # lengths of the alternating runs of present and missing values, starting with a run of present values
+    edges = np.concatenate(([0], np.flatnonzero(np.diff(present.astype(np.int8))) + 1, [len(present)]))
+    runs = np.diff(edges)
+    if len(present) and not present[0]:
+        runs = np.concatenate(([0], runs))
+
+    if values.dtype.kind in "iub" or not values.size:
+        kind = INT_SERIES
+        payload = _encode_varints(np.diff(values.astype(np.int64), prepend=np.int64(0)))
+    else:
+        kind = FLOAT_SERIES
+        payload = np.frombuffer(values.astype("<f8").tobytes(), dtype=np.uint8).reshape(-1, 8).T.tobytes()
+    return _encode_varints([len(present), kind, len(runs)]) + _encode_varints(runs) + payload
+
+
+def _decode_series(buffer):
+    """
+    Outputs: list of a node series encoded by _encode_series (None for missing values)
+    """
+    buffer = np.frombuffer(buffer, dtype=np.uint8)
+    (length, kind, run_count), position = _decode_varints(buffer, 3)
+    runs, position = _decode_varints(buffer, int(run_count), position)
+    present = np.repeat(np.arange(len(runs)) % 2 == 0, runs)
+    count = int(present.sum())
+    if kind == INT_SERIES:
+        values = np.cumsum(_decode_varints(buffer, count, position)[0])
+    else:
+        values = buffer[position:position + 8 * count].reshape(8, count).T.copy().view("<f8").ravel()
+    series = np.full(int(length), None, dtype=object)
+    series[present] = values
+    return series.tolist()
+
+
+def _pack(pieces):
+    """
+    Outputs: bytes of a list of byte strings, each prefixed with its length
+    """
+    return b"".join(_encode_varints([len(piece)]) + piece for piece in pieces)
+
+
+def _unpack(buffer):
+    """
+    Outputs: list of the byte strings packed by _pack
+    """
+    array = np.frombuffer(buffer, dtype=np.uint8)
+    pieces = []
+    position = 0
+    while position < len(buffer):
+        (size,), position = _decode_varints(array, 1, position)
+        pieces.append(buffer[position:position + int(size)])
+        position = position + int(size)
+    return pieces
+
+
+def _write_archive(filename, index, blocks, compression):
+    """
+    Outputs: writes an archive file with the json index and the blocks (compressed), index["blocks"] holds their offsets
+    """
+    compress = COMPRESSIONS[compression][0]
+    index["version"] = ARCHIVE_VERSION
+    index["compression"] = compression
+    index["blocks"] = []
+    compressed = []
+    offset = 0
+    for block in blocks:
+        block = compress(block)
+        index["blocks"].append([offset, len(block)])
+        compressed.append(block)
+        offset = offset + len(block)
+    index_bytes = json.dumps(index).encode("utf-8")
+    # replaced in one step so an interrupted write doesn't destroy the previous archive
+    temporary = filename + ".tmp"
+    with open(temporary, "wb") as archive_file:
+        archive_file.write(MAGIC)
+        archive_file.write(len(index_bytes).to_bytes(8, "little"))
+        archive_file.write(index_bytes)
+        for block in compressed:
+            archive_file.write(block)
+    os.replace(temporary, filename)
+
+
+def _read_index(archive_file):
+    """
+    Outputs: (index, offset of the first block) of an open archive file, raises ValueError if it isn't a readable archive
+    """
+    if archive_file.read(len(MAGIC)) != MAGIC:
+        raise ValueError("not an archive file")
+    index_size = int.from_bytes(archive_file.read(8), "little")
+    index = json.loads(archive_file.read(index_size).decode("utf-8"))
+    if index.get("version") != ARCHIVE_VERSION or index.get("compression") not in COMPRESSIONS:
+        raise ValueError("unsupported archive version")
+    return index, len(MAGIC) + 8 + index_size
+
+
+class _Block_Writer:
+    """
+    collects encoded series into blocks of BLOCK_SERIES series
+    """
+    def __init__(self, blocks):
+        self.blocks = blocks
+        self.pending = []
+        self.size = 0
+
+    def add(self, encoded):
+        """
+        Outputs: [block, start, size] location of the encoded series in the uncompressed blocks
+        """
+        location = [len(self.blocks), self.size, len(encoded)]
+        self.pending.append(encoded)
+        self.size = self.size + len(encoded)
+        if len(self.pending) == BLOCK_SERIES:
+            self.flush()
+        return location
+
+    def flush(self):
+        if self.pending:
+            self.blocks.append(b"".join(self.pending))
+            self.pending = []
+            self.size = 0
+
+
+def save_archive(data, filename, compression="lzma"):
+    """
+    Writes a data set to a compressed archive file
+
+    Parameters
+    ----------
+    data : Covid19_Data
+        the data set.
+    filename : str
+        path of the archive file.
+    compression : str, optional
+        "lzma" (smaller) or "zlib" (faster).  The default is "lzma".
+
+    Raises
+    ------
+    ValueError
+        Raised if the compression is unknown.
+
+    Returns
+    -------
+    None.
+
+    """
+    if compression not in COMPRESSIONS:
+        raise ValueError("unknown compression " + str(compression))
+    nodes = data.get_nodes()
+    rows = {id(node): row for row, node in enumerate(nodes)}
+    index = {"dates": [date.isoformat() for date in data.time_series_dates], "nodes": [], "series": {}}
+    for node in nodes:
+        entry = {"name": node.node_name, "parent": rows[id(node.parent)] if node.parent is not None else -1}
+        for attribute in covid19_data.TREE_FILE_ATTRIBUTES:
+            entry[attribute] = getattr(node, attribute)
+        index["nodes"].append(entry)
+
+    blocks = []
+    for attribute in covid19_data.Covid19_Tree_Node.SERIES_ATTRIBUTES:
+        # the series of one attribute are blocked together, they have similar values and compress well together
+        writer = _Block_Writer(blocks)
+        index["series"][attribute] = [[row] + writer.add(_encode_series(getattr(node, attribute)))
+                                      for row, node in enumerate(nodes) if getattr(node, attribute)]
+        writer.flush()
+    _write_archive(filename, index, blocks, compression)
+
+
+class Covid19_Archive:
+    """
+    random access to the node series of an archive written by save_archive
+    """
+    def __init__(self, filename):
+        """
+        Parameters
+        ----------
+        filename : str
+            path of the archive file.
+
+        Raises
+        ------
+        ValueError
+            Raised if the file isn't an archive of the current ARCHIVE_VERSION.
+
+        """
+        self.archive_file = open(filename, "rb")
+        try:
+            self.index, self.data_offset = _read_index(self.archive_file)
+        except ValueError:
+            self.archive_file.close()
+            raise
+        self.dates = [datetime.datetime.fromisoformat(date) for date in self.index["dates"]]
+        self.rows = {}
+        paths = []
+        for row, entry in enumerate(self.index["nodes"]):
+            path = paths[entry["parent"]] + (entry["name"],) if entry["parent"] >= 0 else ()
+            paths.append(path)
+            self.rows[path] = row
+        self.locations = {attribute: {entry[0]: entry[1:] for entry in entries} for attribute, entries in self.index["series"].items()}
+        self.__cached_block = (None, None)
+
+    def close(self):
+        """
+        Closes the archive file
+
+        Returns
+        -------
+        None.
+
+        """
+        self.archive_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __block(self, block):
+        """
+        Outputs: the uncompressed bytes of a block, the last block read is kept so neighbouring nodes are cheap to read
+        """
+        if self.__cached_block[0] != block:
+            offset, size = self.index["blocks"][block]
+            self.archive_file.seek(self.data_offset + offset)
+            decompress = COMPRESSIONS[self.index["compression"]][1]
+            self.__cached_block = (block, decompress(self.archive_file.read(size)))
+        return self.__cached_block[1]
+
+    def get_series(self, path, metric):
+        """
+        Parameters
+        ----------
+        path : tuple of str
+            path of the node, see Covid19_Tree_Node.get_path.
+        metric : str
+            name of a base metric (ie "CONFIRMED_CASES").
+
+        Raises
+        ------
+        KeyError
+            Raised if the node or the metric is unknown.
+
+        Returns
+        -------
+        list
+            the node series with None for missing values, None if the node
+            has no data for the metric.
+
+        """
+        row = self.rows.get(tuple(path))
+        if row is None:
+            raise KeyError("no node " + str(path))
+        location = self.locations.get(covid19_metrics.get_base_attributes()[metric], {}).get(row)
+        if location is None:
+            return None
+        block, start, size = location
+        return _decode_series(self.__block(block)[start:start + size])
+
+    def load_data(self):
+        """
+        Reads the whole data set
+
+        Returns
+        -------
+        Covid19_Data
+            the data set, node series are lists.
+
+        """
+        data = covid19_data.Covid19_Data()
+        data.time_series_dates = list(self.dates)
+        nodes = []
+        for entry in self.index["nodes"]:
+            if entry["parent"] < 0:
+                node = data.time_series_data_tree
+            else:
+                node = covid19_data.Covid19_Tree_Node(entry["name"])
+                nodes[entry["parent"]].add_child(node)
+            for attribute in covid19_data.TREE_FILE_ATTRIBUTES:
+                setattr(node, attribute, entry.get(attribute))
+            nodes.append(node)
+
+        for attribute, entries in self.index["series"].items():
+            for row, block, start, size in entries:
+                setattr(nodes[row], attribute, _decode_series(self.__block(block)[start:start + size]))
+        data.data_changed()
+        return data
+
+
+def load_archive(filename):
+    """
+    Reads a data set from an archive written by save_archive
+
+    Parameters
+    ----------
+    filename : str
+        path of the archive file.
+
+    Raises
+    ------
+    ValueError
+        Raised if the file isn't an archive of the current ARCHIVE_VERSION.
+
+    Returns
+    -------
+    Covid19_Data
+        the data set, node series are lists.
+
+    """
+    with Covid19_Archive(filename) as archive:
+        return archive.load_data()
+
+
+def save_vintages(store, filename, compression="lzma"):
+    """
+    Writes a vintage store to a compressed archive file.  Only the changed
+    cells of every vintage are stored, so a year of daily vintages takes
+    little more than the base snapshot.
+
+    Parameters
+    ----------
+    store : Vintage_Store
+        the store.  Its labels must be strings or numbers.
+    filename : str
+        path of the archive file.
+    compression : str, optional
+        "lzma" or "zlib".  The default is "lzma".
+
+    Raises
+    ------
+    ValueError
+        Raised if the compression is unknown.
+
+    Returns
+    -------
+    None.
+
+    """
+    if compression not in COMPRESSIONS:
+        raise ValueError("unknown compression " + str(compression))
+    keys = list(store.base)
+    for delta, (added, removed) in zip(store.deltas, store.key_changes):
+        keys.extend(delta)
+        keys.extend(added)
+        keys.extend(removed)
+    keys = list(dict.fromkeys(keys))
+    key_ids = {key: key_id for key_id, key in enumerate(keys)}
+
+    index = {
+        "labels": store.labels,
+        "dates": [date.isoformat() for date in store.dates],
+        "keys": [[list(path), attribute] for path, attribute in keys],
+        "base": [],
+        "vintages": [],
+        }
+    blocks = []
+    writer = _Block_Writer(blocks)
+    index["base"] = [[key_ids[key]] + writer.add(_encode_series(series)) for key, series in store.base.items()]
+    writer.flush()
+
+    for columns, delta, (added, removed) in zip(store.vintage_columns, [{}] + store.deltas, [(frozenset(), frozenset())] + store.key_changes):
+        pieces = [
+            _encode_varints(np.diff(columns.astype(np.int64), prepend=np.int64(0))),
+            _encode_varints(sorted(key_ids[key] for key in added)),
+            _encode_varints(sorted(key_ids[key] for key in removed)),
+            ]
+        for key, (changed_columns, values) in delta.items():
+            pieces.append(_encode_varints(np.concatenate(([key_ids[key]], np.diff(changed_columns.astype(np.int64), prepend=np.int64(0))))))
+            pieces.append(_encode_series(list(values)))
+        index["vintages"].append(len(blocks))
+        blocks.append(_pack(pieces))
+    _write_archive(filename, index, blocks, compression)
+
+
+def load_vintages(filename):
+    """
+    Reads a vintage store from an archive written by save_vintages
+
+    Parameters
+    ----------
+    filename : str
+        path of the archive file.
+
+    Raises
+    ------
+    ValueError
+        Raised if the file isn't an archive of the current ARCHIVE_VERSION.
+
+    Returns
+    -------
+    Vintage_Store
+        the store.
+
+    """
+    with open(filename, "rb") as archive_file:
+        index, data_offset = _read_index(archive_file)
+        decompress = COMPRESSIONS[index["compression"]][1]
+        blocks = []
+        for offset, size in index["blocks"]:
+            archive_file.seek(data_offset + offset)
+            blocks.append(decompress(archive_file.read(size)))
+
+    keys = [(tuple(path), attribute) for path, attribute in index["keys"]]
+    base = {}
+    for key_id, block, start, size in index["base"]:
+        series = covid19_series.Compact_Series(_decode_series(blocks[block][start:start + size]))
+        series.freeze()
+        base[keys[key_id]] = series
+
+    vintage_columns = []
+    deltas = []
+    key_changes = []
+    for vintage, block in enumerate(index["vintages"]):
+        pieces = [np.frombuffer(piece, dtype=np.uint8) for piece in _unpack(blocks[block])]
+        vintage_columns.append(np.cumsum(_decode_varints(pieces[0], None)[0]).astype(np.intp))
+        if vintage == 0:
+            # the first vintage is the base snapshot
+            continue
+        added = frozenset(keys[key_id] for key_id in _decode_varints(pieces[1], None)[0].tolist())
+        removed = frozenset(keys[key_id] for key_id in _decode_varints(pieces[2], None)[0].tolist())
+        delta = {}
+        for key_piece, values_piece in zip(pieces[3::2], pieces[4::2]):
+            key_columns = _decode_varints(key_piece, None)[0]
+            delta[keys[key_columns[0]]] = (np.cumsum(key_columns[1:]).astype(np.int32), tuple(_decode_series(values_piece.tobytes())))
+        deltas.append(delta)
+        key_changes.append((added, removed))
+    return covid19_vintages.Vintage_Store.restore(index["labels"], [datetime.datetime.fromisoformat(date) for date in index["dates"]],
+                                                  vintage_columns, base, deltas, key_changes)
@@ -1,16 +1,179 @@
+import bisect
+import collections
+import copy
 import csv
 import datetime
 import json
 import multiprocessing as mp
 import os
+import numpy as np
+import pandas as pd
 import requests
-import math
-import data_analysis
+import sys
+import weakref
 
+import covid19_metrics
+import covid19_series
+import covid19_vintages
+import data_analysis
 import github_directory_tree
 import matplotlib_gui
 
+# upper limit on the memory used by the derived series cached for all tree nodes combined
+DERIVED_SERIES_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+
+class Derived_Series_Cache:
+    """Description: Least recently used cache of derived data series (daily new cases, incident rates, moving averages, ...)
+    with one store per tree node.  Entries are keyed by metric name + parameters and are only valid for the data_version
+    of the node they were computed from, so ingesting new data into a node invalidates its entries.  Nodes are only
+    referenced weakly, so the store of a node is dropped together with the node (ie when a data set is reparsed) instead
+    of holding on to the discarded tree until the entries are evicted.
+    """
+    def __init__(self, max_bytes=DERIVED_SERIES_CACHE_MAX_BYTES):
+        """Description: Initialize an empty cache
+        Inputs: max_bytes - approximate upper limit on the memory used by all cached series
+        Outputs: Initializes data structures
+        """
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        # id(node) -> (weak reference to the node, {key: (version, series, size)})
+        self.__stores = {}
+        # (id(node), key) -> size of the entry, least recently used first
+        self.__entries = collections.OrderedDict()
+        # ids of nodes that were garbage collected, their stores are dropped on the next access of the cache
+        self.__collected = []
+
+    @staticmethod
+    def estimate_size(series):
+        """Description: Estimate the memory used by a cached series
+        Inputs: series - tuple of int / float / None values or None
+        Outputs: return - approximate number of bytes used by the tuple and the number objects it holds
+        """
+        if series is None:
+            return 0
+        return sys.getsizeof(series) + 24 * len(series)
+
+    def get_series(self, node, key, compute):
+        """Description: Get a derived series for a node, computing and caching it if it isn't cached for the node's
+            current data version
+        Inputs:
+            node - the Covid19_Tree_Node the series is derived from
+            key - hashable tuple identifying the metric and its parameters
+            compute - function with no arguments that calculates the series
+        Outputs:
+            return - the derived series as a tuple (shared by all callers, so it is immutable) or None if there is no data
+        """
+        store = self.__node_store(node)
+        entry = store[1].get(key) if store is not None else None
+        if entry is not None and entry[0] == node.data_version:
+            self.__entries.move_to_end((id(node), key))
+            return entry[1]
+
+        series = compute()
+        if series is not None:
+            series = tuple(series)
+        self.__store(node, key, series)
+        return series
+
+    def __store(self, node, key, series):
+        """Description: Add an entry to the store of a node and evict the least recently used entries until the cache is
+            under its limit
+        Inputs:
+            node - the Covid19_Tree_Node the series was computed from (for its current data_version)
+            key - hashable tuple identifying the metric and its parameters
+            series - the series to cache
+        Outputs: self.__stores, self.__entries and self.total_bytes are updated
+        """
+        self.__remove(id(node), key)
+        size = self.estimate_size(series)
+        if size > self.max_bytes:
+            return
+
+        store = self.__node_store(node)
+        if store is None:
+            # the callback only records the id, the store is dropped by the next caller (it may run in any thread)
+            store = (weakref.ref(node, lambda _, node_id=id(node): self.__collected.append(node_id)), {})
+            self.__stores[id(node)] = store
+        store[1][key] = (node.data_version, series, size)
+        self.__entries[(id(node), key)] = size
+        self.total_bytes = self.total_bytes + size
+        while self.total_bytes > self.max_bytes:
+            node_id, evicted_key = next(iter(self.__entries))
+            self.__remove(node_id, evicted_key)
+
+    def __remove(self, node_id, key):
+        """Description: Remove an entry from the cache if it is present
+        Inputs:
+            node_id - id of the node
+            key - hashable tuple identifying the metric and its parameters
+        Outputs: self.__stores, self.__entries and self.total_bytes are updated
+        """
+        size = self.__entries.pop((node_id, key), None)
+        if size is None:
+            return
+        self.total_bytes = self.total_bytes - size
+        entries = self.__stores[node_id][1]
+        del entries[key]
+        if not entries:
+            del self.__stores[node_id]
+
+    def __node_store(self, node):
+        """Description: Get the store of a node
+        Inputs: node - the Covid19_Tree_Node
+        Outputs: return - (weak reference, entries) of the node, None if nothing is cached for it
+        """
+        self.__drop_collected()
+        store = self.__stores.get(id(node))
+        if store is not None and store[0]() is not node:
+            # left by a garbage collected node whose id was reused
+            for key in list(store[1]):
+                self.__remove(id(node), key)
+            store = None
+        return store
+
+    def __drop_collected(self):
+        """Description: Remove the stores of nodes that were garbage collected
+        Inputs: None
+        Outputs: self.__stores, self.__entries and self.total_bytes are updated
+        """
+        while self.__collected:
+            node_id = self.__collected.pop()
+            store = self.__stores.get(node_id)
+            # the id may already belong to a new node if the store was emptied and recreated
+            if store is not None and store[0]() is None:
+                for key in list(store[1]):
+                    self.__remove(node_id, key)
+
+    def clear(self):
+        """Description: Remove all entries from the cache
+        Inputs: None
+        Outputs: the cache is emptied
+        """
+        self.__stores.clear()
+        self.__entries.clear()
+        self.__collected.clear()
+        self.total_bytes = 0
+
+    def __len__(self):
+        self.__drop_collected()
+        return len(self.__entries)
+
+
+derived_series_cache = Derived_Series_Cache()
+
+
 class Covid19_Tree_Node:
+    # names of the attributes holding the time series data arrays of a node
+    SERIES_ATTRIBUTES = (
+        "confirmed_cases_time_series_data",
+        "deaths_time_series_data",
+        "people_tested_time_series_data",
+        "incident_rate_time_series_data",
+        "active_cases_time_series_data",
+        "recovered_cases_time_series_data"
+        )
+
     def __init__(self, name):
         """Description: Initialize a tree node
         Inputs: None
@@ -30,6 +193,9 @@ class Covid19_Tree_Node:
         self.iso3 = None
         self.fips = None
         self.parent = None
+        self.frozen = False
+        # incremented every time the data of this node changes so cached derived series can be invalidated
+        self.data_version = 0
 
 
     def add_child(self, tree_node):
@@ -42,7 +208,10 @@ class Covid19_Tree_Node:
                 Returns True
             Else:
                 Returns False
+            Raises RuntimeError if this node has been frozen
         """
+        if self.frozen:
+            raise RuntimeError("can't add child " + tree_node.node_name + " to frozen node " + self.node_name)
         if self.get_child_node(tree_node.node_name) == None:
             self.child_nodes[tree_node.node_name] = tree_node
             tree_node.parent = self
@@ -68,6 +237,65 @@ class Covid19_Tree_Node:
             children_list.append(self.child_nodes[child])
         return children_list
 
+    def get_path(self):
+        """Description: get the names of the nodes on the path from the top of the tree down to this node
+        Inputs: None
+        Outputs: returns tuple of node names (ie ("US", "Ohio", "Franklin")) not including the root node, () for the root node
+        """
+        path = []
+        node = self
+        while node.parent != None:
+            path.append(node.node_name)
+            node = node.parent
+        return tuple(reversed(path))
+
+    def data_changed(self):
+        """Description: Record that the data of this node changed.  Must be called by anything that modifies the data
+            arrays or population of a node so derived series cached for the node are recalculated.
+        Inputs: None
+        Outputs: self.data_version is incremented
+        """
+        self.data_version = self.data_version + 1
+
+    def freeze(self):
+        """Description: Make this node and all of its descendants read-only so that they can be shared without copying
+        Inputs: None
+        Outputs:
+            The time series data arrays are converted to tuples (or made read-only if compact) so they can no longer be modified in place
+            self.frozen is set to True for this node and every node below it
+        """
+        if not self.frozen:
+            for attribute in self.SERIES_ATTRIBUTES:
+                series = getattr(self, attribute)
+                if isinstance(series, (covid19_series.Compact_Series, covid19_series.Sparse_Series)):
+                    series.freeze()
+                else:
+                    setattr(self, attribute, tuple(series))
+            self.frozen = True
+
+        for child in self.child_nodes.values():
+            child.freeze()
+
+    def thaw(self):
+        """Description: Make this node and all of its descendants writable again.  Only meant to be used on a private copy
+            of a frozen tree (see Covid19_Data.copy), never on a tree that is being shared.
+        Inputs: None
+        Outputs:
+            The time series data arrays are converted back to lists (or made writable again if compact)
+            self.frozen is set to False for this node and every node below it
+        """
+        if self.frozen:
+            for attribute in self.SERIES_ATTRIBUTES:
+                series = getattr(self, attribute)
+                if isinstance(series, (covid19_series.Compact_Series, covid19_series.Sparse_Series)):
+                    series.thaw()
+                else:
+                    setattr(self, attribute, list(series))
+            self.frozen = False
+
+        for child in self.child_nodes.values():
+            child.thaw()
+
     def initialize_confirmed_cases(self, length):
         """Description: Initialize the confirmed cases data array
         Inputs: length - number of data values to initailize
@@ -122,24 +350,31 @@ class Covid19_Tree_Node:
         for _ in range(0, length):
             self.recovered_cases_time_series_data.append(None)
 
+    def get_metric(self, name, **params):
+        """Description: Get the data series for a metric declared in the covid19_metrics registry.  Derived series are
+            calculated from their input metrics and cached in derived_series_cache until the node's data changes.
+        Inputs:
+            name - name of a registered metric (ie "CONFIRMED_CASES", "DAILY_NEW_CASES_INCIDENT_RATE")
+            params - optional overrides for the default parameters of the metric
+        Outputs:
+            return - the data series for the metric (a tuple for derived metrics), None if there is no valid data
+            Raises KeyError if the metric is not registered
+        """
+        metric = covid19_metrics.get_metric(name)
+        if metric.is_base():
+            return getattr(self, metric.attribute)
+
+        params = covid19_metrics.select_parameters(name, params)
+        key = (name,) + tuple(sorted(params.items()))
+        return derived_series_cache.get_series(self, key, lambda: covid19_metrics.calculate(self, name, Covid19_Tree_Node.get_metric, **params))
+
     def get_daily_new_cases(self):
         """Description: Calculate and return list of derived data
         Inputs: None
         Outputs: daily_new_cases[] where each element is defined as: self.confirmed_cases_time_series_data[i] - self.confirmed_cases_time_series_data[i-1]
                     and daily_new_cases[0] = None
         """
-        if self.confirmed_cases_time_series_data:
-            daily_new_cases = []
-            daily_new_cases.append(None)
-            for i in range(1, len(self.confirmed_cases_time_series_data)):
-                if self.confirmed_cases_time_series_data[i] != None and self.confirmed_cases_time_series_data[i-1] != None:
-                    val = self.confirmed_cases_time_series_data[i] - self.confirmed_cases_time_series_data[i-1]
-                else:
-                    val = None
-                daily_new_cases.append(val)
-            return daily_new_cases
-        else:
-            return None
+        return self.get_metric("DAILY_NEW_CASES")
 
     def get_daily_new_deaths(self):
         """Description: Calculate and return list of derived data
@@ -147,18 +382,7 @@ class Covid19_Tree_Node:
         Outputs: daily_new_deaths[] where each element is defined as: self.deaths_time_series_data[i] - self.deaths_time_series_data[i-1]
                     and daily_new_deaths[0] = None
         """
-        if self.deaths_time_series_data:
-            daily_new_deaths = []
-            daily_new_deaths.append(None)
-            for i in range(1, len(self.deaths_time_series_data)):
-                if self.deaths_time_series_data[i] != None and self.deaths_time_series_data[i-1] != None:
-                    val = self.deaths_time_series_data[i] - self.deaths_time_series_data[i-1]
-                else:
-                    val = None
-                daily_new_deaths.append(val)
-            return daily_new_deaths
-        else:
-            return None
+        return self.get_metric("DAILY_NEW_DEATHS")
 
     def get_daily_new_people_tested(self):
         """Description: Calculate and return list of derived data
@@ -166,52 +390,21 @@ class Covid19_Tree_Node:
         Outputs: daily_new_people_tested[] where each element is defined as: self.people_tested_time_series_data[i] - self.people_tested_time_series_data[i-1]
                     and daily_new_people_tested[0] = None
         """
-        if self.people_tested_time_series_data:
-            daily_new_people_tested = []
-            daily_new_people_tested.append(None)
-            for i in range(1, len(self.people_tested_time_series_data)):
-                if self.people_tested_time_series_data[i] != None and self.people_tested_time_series_data[i-1] != None:
-                    val = self.people_tested_time_series_data[i] - self.people_tested_time_series_data[i-1]
-                else:
-                    val = None
-                daily_new_people_tested.append(val)
-            return daily_new_people_tested
-        else:
-            return None
+        return self.get_metric("DAILY_NEW_PEOPLE_TESTED")
 
     def get_recovery_rate(self):
         """Description: Calculate and return list of derived data
         Inputs: None
         Outputs: recovery_rate[] where each element is defined as: self.recovered_cases_time_series_data[i] / self.confirmed_cases_time_series_data[i]
         """
-        if self.recovered_cases_time_series_data and self.confirmed_cases_time_series_data:
-            recovery_rate = []
-            for i in range(0, len(self.confirmed_cases_time_series_data)):
-                if self.recovered_cases_time_series_data[i] != None and self.confirmed_cases_time_series_data[i] != None and self.confirmed_cases_time_series_data[i] != 0:
-                    val = self.recovered_cases_time_series_data[i] / self.confirmed_cases_time_series_data[i]
-                else:
-                    val = None
-                recovery_rate.append(val)
-            return recovery_rate
-        else:
-            return None
+        return self.get_metric("RECOVERY_RATE")
 
     def get_ratio_confirmed_cases_to_people_tested(self):
         """Description: Calculate and return list of derived data
         Inputs: None
         Outputs: ratio[] where each element is defined as: self.confirmed_cases_time_series_data[i] / self.people_tested_time_series_data[i]
         """
-        if self.confirmed_cases_time_series_data and self.people_tested_time_series_data:
-            ratio = []
-            for i in range(0, len(self.people_tested_time_series_data)):
-                if self.confirmed_cases_time_series_data[i] != None and self.people_tested_time_series_data[i] != None and self.people_tested_time_series_data[i] != 0:
-                    val = self.confirmed_cases_time_series_data[i] / self.people_tested_time_series_data[i]
-                else:
-                    val = None
-                ratio.append(val)
-            return ratio
-        else:
-            return None
+        return self.get_metric("RATIO_CONFIRMED_CASES_TO_PEOPLE_TESTED")
 
     def get_daily_ratio_confirmed_cases_to_people_tested(self):
         """Description: Calculate and return list of derived data
@@ -220,19 +413,7 @@ class Covid19_Tree_Node:
             daily_confirmed = self.confirmed_cases_time_series_data[i] - self.confirmed_cases_time_series_data[i-1]
             daily_tested = self.people_tested_time_series_data[i] - self.people_tested_time_series_data[i-1]
         """
-        cases = self.get_daily_new_cases()
-        tested = self.get_daily_new_people_tested()
-        if cases and tested:
-            ratio = []
-            for i in range(0, len(cases)):
-                if cases[i] and tested[i] and tested[i] != 0:
-                    ratio.append(cases[i]/tested[i])
-                else:
-                    ratio.append(None)
-    
-            return ratio
-        else:
-            return None
+        return self.get_metric("DAILY_RATIO_CONFIRMED_CASES_TO_PEOPLE_TESTED")
 
     def get_case_fatality_rate(self):
         """
@@ -244,19 +425,7 @@ class Covid19_Tree_Node:
             list of fatality rates.
 
         """
-        if self.confirmed_cases_time_series_data and self.deaths_time_series_data:
-            fatality_rate = []
-            for cases, deaths in zip(self.confirmed_cases_time_series_data, self.deaths_time_series_data):
-                try:
-                    fatality_rate.append(deaths/cases)
-                except ZeroDivisionError:
-                    fatality_rate.append(0)
-                except TypeError:
-                    fatality_rate.append(None)
-    
-            return fatality_rate
-        else:
-            return None
+        return self.get_metric("CASE_FATALITY_RATE")
 
     def get_moving_window_case_fatality_rate(self):
         """
@@ -268,13 +437,8 @@ class Covid19_Tree_Node:
             list of fatality rates.
 
         """
-        if self.confirmed_cases_time_series_data and self.deaths_time_series_data:
-            moving_window_fatality_rate = data_analysis.moving_window_ratio(self.deaths_time_series_data, self.confirmed_cases_time_series_data, 30)
-    
-            return moving_window_fatality_rate
-        else:
-            return None
-        
+        return self.get_metric("MOVING_WINDOW_CASE_FATALITY_RATE")
+
     def get_calculated_cases_incident_rate(self):
         """
         calculates the case incident rate (cases per 100K of population) of a node as confirmed cases / population * 100000
@@ -285,17 +449,7 @@ class Covid19_Tree_Node:
             list of fatality rates.
 
         """
-        if self.confirmed_cases_time_series_data and self.population and self.population != 0:
-            rate = []
-            for i in range(0, len(self.confirmed_cases_time_series_data)):
-                if self.confirmed_cases_time_series_data[i]:
-                    value = self.confirmed_cases_time_series_data[i] / self.population * 100000
-                    rate.append(value)
-                else:
-                    rate.append(None)
-            return rate
-        else:
-            return None
+        return self.get_metric("CALCULATED_CASES_INCIDENT_RATE")
 
     def get_calculated_deaths_incident_rate(self):
         """
@@ -307,17 +461,7 @@ class Covid19_Tree_Node:
             list of fatality rates.
 
         """
-        if self.deaths_time_series_data and self.population and self.population != 0:
-            rate = []
-            for i in range(0, len(self.deaths_time_series_data)):
-                if self.deaths_time_series_data[i]:
-                    value = self.deaths_time_series_data[i] / self.population * 100000
-                    rate.append(value)
-                else:
-                    rate.append(None)
-            return rate
-        else:
-            return None
+        return self.get_metric("CALCULATED_DEATHS_INCIDENT_RATE")
 
     def get_calculated_people_tested_incident_rate(self):
         """
@@ -329,18 +473,8 @@ class Covid19_Tree_Node:
             list of test rates.
 
         """
-        if self.people_tested_time_series_data and self.population and self.population != 0:
-            rate = []
-            for i in range(0, len(self.people_tested_time_series_data)):
-                if self.people_tested_time_series_data[i]:
-                    value = self.people_tested_time_series_data[i] / self.population * 100000
-                    rate.append(value)
-                else:
-                    rate.append(None)
-            return rate
-        else:
-            return None
-        
+        return self.get_metric("CALCULATED_PEOPLE_TESTED_INCIDENT_RATE")
+
     def get_daily_new_cases_incident_rate(self):
         """
         Description: calculates the daily new cases incident rate (new cases per 100K of population) of a node as:
@@ -352,19 +486,7 @@ class Covid19_Tree_Node:
             list of new cases rates if valid data, None if no valid data.
 
         """
-        new_cases = self.get_daily_new_cases()
-        
-        if new_cases and self.population and self.population != 0:
-            rate = []
-            for i in range(0, len(new_cases)):
-                if new_cases[i]:
-                    value = new_cases[i] / self.population * 100000
-                    rate.append(value)
-                else:
-                    rate.append(None)
-            return rate
-        else:
-            return None
+        return self.get_metric("DAILY_NEW_CASES_INCIDENT_RATE")
 
     def get_daily_new_deaths_incident_rate(self):
         """
@@ -377,19 +499,7 @@ class Covid19_Tree_Node:
             list of new cases rates if valid data, None if no valid data.
 
         """
-        new_deaths = self.get_daily_new_deaths()
-        
-        if new_deaths and self.population and self.population != 0:
-            rate = []
-            for i in range(0, len(new_deaths)):
-                if new_deaths[i]:
-                    value = new_deaths[i] / self.population * 100000
-                    rate.append(value)
-                else:
-                    rate.append(None)
-            return rate
-        else:
-            return None
+        return self.get_metric("DAILY_NEW_DEATHS_INCIDENT_RATE")
 
     def get_log10_7day_moving_average_daily_new_cases_incident_rate(self):
         """
@@ -401,7 +511,7 @@ class Covid19_Tree_Node:
         -------
             list of log10 of 7 day moving average of new cases rates if valid data, None if no valid data
         """
-        return self.get_log_moving_average(self.get_daily_new_cases_incident_rate(), 7, log_base=10)
+        return self.get_metric("LOG10_7DAY_MOVING_AVERAGE_DAILY_NEW_CASES_INCIDENT_RATE")
 
     def get_log2_7day_moving_average_daily_new_cases_incident_rate(self):
         """
@@ -413,7 +523,7 @@ class Covid19_Tree_Node:
         -------
             list of log2 of 7 day moving average of new cases rates if valid data, None if no valid data
         """
-        return self.get_log_moving_average(self.get_daily_new_cases_incident_rate(), 7, log_base=2)
+        return self.get_metric("LOG2_7DAY_MOVING_AVERAGE_DAILY_NEW_CASES_INCIDENT_RATE")
 
     def get_log2_7day_moving_average_daily_new_deaths_incident_rate(self):
         """
@@ -425,8 +535,8 @@ class Covid19_Tree_Node:
         -------
             list of log2 of 7 day moving average of new deaths rates if valid data, None if no valid data
         """
-        return self.get_log_moving_average(self.get_daily_new_deaths_incident_rate(), 7, scale=100, log_base=2)
-        
+        return self.get_metric("LOG2_7DAY_MOVING_AVERAGE_DAILY_NEW_DEATHS_INCIDENT_RATE")
+
     def get_log_moving_average(self, data_set, days, scale=1, log_base=None):
         """
         Description: calculates the log base n of the moving average of the specified data set of a node as:
@@ -442,31 +552,143 @@ class Covid19_Tree_Node:
         rate : list
             list of log of moving average of new cases rates if valid data (bottoms out at 0 to focus range on high incident rate nodes), None if no valid data
         """
-        if data_set:
-            moving_average_data = data_analysis.moving_average(data_set, days)
-            rate = []
-            
-            for i in range(1,len(moving_average_data)):
-                value = moving_average_data[i] * scale
-                if value > 1:
-                    log_value = math.log(moving_average_data[i] * scale, log_base)
-                else:
-                    log_value = 0
-                rate.append(log_value)
+        return covid19_metrics.log_moving_average(data_set, days, scale, log_base)
 
-            return rate
+
+class Covid19_Region_Group(Covid19_Tree_Node):
+    """User defined region (continent, metro area, ...) made up of nodes anywhere in the data tree.  It can be used
+    anywhere a Covid19_Tree_Node is accepted: its data arrays are the sums of the member data arrays, calculated with
+    vectorized sums over the member rows of Covid19_Data.get_metric_array and recalculated only after the data of a
+    member changed.  The group is not part of the tree, its parent is the root node so it is labeled like a country.
+    """
+
+    def __init__(self, name, members, data):
+        """Description: Create a region group
+        Inputs:
+            name - name of the group
+            members - list of Covid19_Tree_Node from data's tree
+            data - the Covid19_Data the members belong to
+        Outputs:
+            Initializes data structures
+            Raises ValueError if a member is not part of data's tree
+        """
+        # storage behind the series / population properties, must exist before Covid19_Tree_Node.__init__ sets them
+        self.group_values = {}
+        super().__init__(name)
+        self.members = list(members)
+        self.data = data
+        self.parent = data.time_series_data_tree
+        self.member_versions = None
+        data.get_node_rows(self.members)
+
+    def refresh(self):
+        """Description: Recalculate the data arrays and population of the group if the data of a member changed
+        Inputs: None
+        Outputs:
+            The XYZ_time_series_data arrays are set to the sums of the member arrays for each date (None if no member has
+                a value for the date, [] if no member has data at all)
+            population is the sum of the member populations, None if a member has no population
+            self.data_version is incremented if anything was recalculated
+        """
+        versions = tuple(member.data_version for member in self.members)
+        if versions == self.member_versions:
+            return
+
+        rows = self.data.get_node_rows(self.members)
+        for name, attribute in covid19_metrics.get_base_attributes().items():
+            values, valid = self.data.get_metric_array(name)
+            member_values = values[rows[valid[rows]]]
+            if len(member_values) == 0:
+                self.group_values[attribute] = []
+                continue
+            sums = np.nansum(member_values, axis=0)
+            missing = np.isnan(member_values).all(axis=0).tolist()
+            if np.dtype(Covid19_Data.COMPACT_SERIES_DTYPES.get(attribute, np.int32)).kind == "f":
+                sums = sums.tolist()
+            else:
+                sums = sums.astype(np.int64).tolist()
+            self.group_values[attribute] = [None if is_missing else value for value, is_missing in zip(sums, missing)]
+
+        populations = self.data.get_populations()[rows]
+        if len(populations) and not np.isnan(populations).any():
+            self.group_values["population"] = int(populations.sum())
         else:
-            return None
+            self.group_values["population"] = None
 
+        self.member_versions = versions
+        self.data_changed()
 
-class Covid19_Data:
+    def get_metric(self, name, **params):
+        """Description: Same as Covid19_Tree_Node.get_metric, after bringing the group data up to date
+        """
+        self.refresh()
+        return super().get_metric(name, **params)
+
+
+def _region_group_property(attribute):
+    """Description: property for a data attribute of Covid19_Region_Group that is recalculated on access
+    """
+    def get_value(self):
+        self.refresh()
+        return self.group_values[attribute]
+
+    def set_value(self, value):
+        self.group_values[attribute] = value
+
+    return property(get_value, set_value)
+
+
+for _attribute in Covid19_Tree_Node.SERIES_ATTRIBUTES + ("population",):
+    setattr(Covid19_Region_Group, _attribute, _region_group_property(_attribute))
 
-    def __init__(self):
+
+class Covid19_Data:
+    # node attribute holding the data array for each data type used by the read_XYZ functions
+    DATA_TYPE_ATTRIBUTES = {
+        'CONFIRMED': "confirmed_cases_time_series_data",
+        'DEATHS': "deaths_time_series_data",
+        'TESTED': "people_tested_time_series_data",
+        'INCIDENT': "incident_rate_time_series_data",
+        'ACTIVE': "active_cases_time_series_data",
+        'RECOVERED': "recovered_cases_time_series_data"
+        }
+
+    # data types that are per node rates, the readers never sum them into the parent nodes
+    NON_AGGREGATED_DATA_TYPES = ('INCIDENT',)
+
+    # numpy type used for the data arrays with compact storage (int32 for anything not listed, promoted to int64 when a
+    # value doesn't fit)
+    COMPACT_SERIES_DTYPES = {
+        "incident_rate_time_series_data": np.float32
+        }
+
+    # data arrays that are only reported for some locations / dates (mostly missing at county level).  With sparse storage
+    # they start out as Sparse_Series that only store the reported values and are converted to dense storage once more
+    # than SPARSE_SERIES_MAX_FILL of the values are filled in.
+    SPARSE_SERIES_ATTRIBUTES = (
+        "people_tested_time_series_data",
+        "incident_rate_time_series_data",
+        "active_cases_time_series_data",
+        "recovered_cases_time_series_data"
+        )
+    SPARSE_SERIES_MAX_FILL = 1 / 16
+
+    # names used by memory_report for the levels of the data tree
+    TREE_LEVEL_NAMES = ("World", "Country", "State", "County")
+
+    def __init__(self, compact_storage=False, sparse_storage=False):
         """Description: Reads a DSM spreadsheet tab into a DSM data structure
-        Inputs: None
+        Inputs:
+            compact_storage - True to store the node data arrays as numpy backed Compact_Series (int32/int64 counts,
+                float32 rates, sentinel for missing values) instead of lists of python ints, see compact()
+            sparse_storage - True to store the mostly missing data arrays (SPARSE_SERIES_ATTRIBUTES) as Sparse_Series
+                until they are filled in, instead of allocating every value when the first one is set
         Outputs: Initializes data structures
         """
-        self.github_tree = github_directory_tree.GithubDirectoryTree("CSSEGISandData", "Covid-19")
+        # listing of the Johns Hopkins repository, only retrieved when daily reports are read (see github_tree)
+        self.__github_tree = None
+        # optional folder where downloaded daily report files are kept by content (git sha), see retrieve_url_data
+        self.download_cache = None
         self.time_series_dates = []
         self.time_series_data_tree = Covid19_Tree_Node("World")
         # initialize header to cell map values in time series data file (-1 for unknown)"""
@@ -530,6 +752,69 @@ class Covid19_Data:
                 "Denmark"
                 ]
 
+        self.frozen = False
+        self.compact_storage = compact_storage
+        self.sparse_storage = sparse_storage
+
+        # history of the data across revisions of the data files, see record_vintage
+        self.vintages = None
+
+        # user defined regions (continents, metro areas, ...) by name, see add_region_group
+        self.region_groups = {}
+
+        # incremented every time data in the tree changes so cached arrays can be invalidated
+        self.data_version = 0
+        self.__array_cache = {}
+        # metric arrays transposed to (dates x nodes) for queries across nodes on one date, see get_date_major_array
+        self.__date_major_cache = {}
+        # NaN-aware cumulative sums of the metric arrays for sums over any date range, see get_prefix_sums
+        self.__prefix_sum_cache = {}
+
+    @property
+    def github_tree(self):
+        """Description: Listing of the files in the Johns Hopkins repository, retrieved from github the first time it is
+            used so data sets that are loaded rather than parsed (ie from a snapshot) don't need the network
+        Inputs: None
+        Outputs:
+            return - GithubDirectoryTree
+        """
+        if self.__github_tree == None:
+            self.__github_tree = github_directory_tree.GithubDirectoryTree("CSSEGISandData", "Covid-19")
+        return self.__github_tree
+
+    def data_changed(self):
+        """Description: Record that data in the tree changed.  Must be called by anything that modifies the tree
+            (nodes, data arrays or populations) without going through the read_XYZ functions so cached arrays are rebuilt.
+        Inputs: None
+        Outputs: self.data_version is incremented
+        """
+        self.data_version = self.data_version + 1
+
+    def freeze(self):
+        """Description: Make the data set read-only so a single instance can be shared by every session without copying it.
+            Any changes have to be made on a private copy obtained with copy().
+        Inputs: None
+        Outputs:
+            self.time_series_dates and every node in self.time_series_data_tree are frozen
+            return - self, so the call can be chained
+        """
+        self.time_series_dates = tuple(self.time_series_dates)
+        self.time_series_data_tree.freeze()
+        self.frozen = True
+        return self
+
+    def copy(self):
+        """Description: Create a writable deep copy of the data set (copy-on-write for frozen data sets)
+        Inputs: None
+        Outputs:
+            return - new Covid19_Data object that shares no data with this one and is not frozen
+        """
+        data = copy.deepcopy(self)
+        data.time_series_dates = list(data.time_series_dates)
+        data.time_series_data_tree.thaw()
+        data.frozen = False
+        return data
+
     def __set_node_data_values(self, node, data_types, data_values, index, aggregate_to_parent, absolute):
         """Description: Sets the specified data values in the data arrays for a tree node at the specified index.
         Inputs:
@@ -543,59 +828,125 @@ class Covid19_Data:
         Outputs:
             node.XYZ_time_series_data[index] is initialized if it wasn't already
             node.XYZ_time_series_data[index] is set as specified
+            Raises RuntimeError if the node has been frozen
         """
-        i = 0
-        for data_type in data_types:
-            if data_type == 'DEATHS':
-                if not node.deaths_time_series_data:
-                    node.initialize_deaths(len(self.time_series_dates))
-                if absolute or node.deaths_time_series_data[index] == None:
-                    node.deaths_time_series_data[index] = data_values[i]
-                elif data_values[i]:
-                    node.deaths_time_series_data[index] = node.deaths_time_series_data[index] + data_values[i]
-            elif data_type == 'CONFIRMED':
-                if not node.confirmed_cases_time_series_data:
-                    node.initialize_confirmed_cases(len(self.time_series_dates))
-                if absolute or node.confirmed_cases_time_series_data[index] == None:
-                    node.confirmed_cases_time_series_data[index] = data_values[i]
-                elif data_values[i]:
-                    node.confirmed_cases_time_series_data[index] = node.confirmed_cases_time_series_data[index] + data_values[i]
-            elif data_type == 'TESTED':
-                if not node.people_tested_time_series_data:
-                    node.initialize_people_tested(len(self.time_series_dates))
-                if absolute or node.people_tested_time_series_data[index] == None:
-                    node.people_tested_time_series_data[index] = data_values[i]
-                elif data_values[i]:
-                    node.people_tested_time_series_data[index] = node.people_tested_time_series_data[index] + data_values[i]
-            elif data_type == 'INCIDENT':
-                if not node.incident_rate_time_series_data:
-                    node.initialize_incident_rate(len(self.time_series_dates))
-                if absolute or node.incident_rate_time_series_data[index] == None:
-                    node.incident_rate_time_series_data[index] = data_values[i]
-                elif data_values[i]:
-                    node.incident_rate_time_series_data[index] = node.incident_rate_time_series_data[index] + data_values[i]
-            elif data_type == 'ACTIVE':
-                if not node.active_cases_time_series_data:
-                    node.initialize_active_cases(len(self.time_series_dates))
-                if absolute or node.active_cases_time_series_data[index] == None:
-                    node.active_cases_time_series_data[index] = data_values[i]
-                elif data_values[i]:
-                    node.active_cases_time_series_data[index] = node.active_cases_time_series_data[index] + data_values[i]
-            elif data_type == 'RECOVERED':
-                if not node.recovered_cases_time_series_data:
-                    node.initialize_recovered_cases(len(self.time_series_dates))
-                if absolute or node.recovered_cases_time_series_data[index] == None:
-                    node.recovered_cases_time_series_data[index] = data_values[i]
-                elif data_values[i]:
-                    node.recovered_cases_time_series_data[index] = node.recovered_cases_time_series_data[index] + data_values[i]
-
-            i = i + 1
+        if node.frozen:
+            raise RuntimeError("can't set data values on frozen node " + node.node_name + ", use Covid19_Data.copy() to get a writable copy")
+
+        node.data_changed()
+        self.data_version = self.data_version + 1
+        for data_type, data_value in zip(data_types, data_values):
+            attribute = self.DATA_TYPE_ATTRIBUTES[data_type]
+            series = getattr(node, attribute)
+            if not series:
+                series = self.__new_series(attribute, len(self.time_series_dates))
+                setattr(node, attribute, series)
+            if absolute or series[index] == None:
+                series[index] = data_value
+            elif data_value:
+                series[index] = series[index] + data_value
+            if isinstance(series, covid19_series.Sparse_Series) and series.count() > len(series) * self.SPARSE_SERIES_MAX_FILL:
+                setattr(node, attribute, self.__dense_series(attribute, series))
 
         if aggregate_to_parent and node.parent != None:
             # recursive call for the parent node if we're supposed to aggregate.  Recursion ends when we get to the top of the tree since there is no parent.
             self.__set_node_data_values(node.parent, data_types, data_values, index, aggregate_to_parent, absolute=False)
 
 
+    def __new_series(self, attribute, length):
+        """Description: Create a data array with every value missing
+        Inputs:
+            attribute - name of the node attribute the array is for
+            length - number of data values
+        Outputs:
+            return - Sparse_Series for the attributes in SPARSE_SERIES_ATTRIBUTES if sparse storage is used, otherwise
+                Compact_Series if compact storage is used or a list of None
+        """
+        if self.sparse_storage and attribute in self.SPARSE_SERIES_ATTRIBUTES:
+            return covid19_series.Sparse_Series(length)
+        if self.compact_storage:
+            return covid19_series.Compact_Series.missing(length, self.COMPACT_SERIES_DTYPES.get(attribute, np.int32))
+        return [None] * length
+
+    def __dense_series(self, attribute, values):
+        """Description: Create a dense data array
+        Inputs:
+            attribute - name of the node attribute the array is for
+            values - the data values (None for missing values)
+        Outputs:
+            return - Compact_Series if compact storage is used, otherwise a list
+        """
+        if self.compact_storage:
+            return covid19_series.Compact_Series(values, self.COMPACT_SERIES_DTYPES.get(attribute, np.int32))
+        return list(values)
+
+    def compact(self):
+        """Description: Convert the data arrays of every node to Compact_Series (ie for a data set read from a pickle
+            created without compact storage).  Data added afterwards is stored compact as well.
+        Inputs: None
+        Outputs:
+            Every non empty, non sparse node data array is replaced with an equivalent Compact_Series, incident rates are stored as float32
+            so they are rounded to about 7 significant digits
+            Raises RuntimeError if the data set has been frozen
+        """
+        if self.frozen:
+            raise RuntimeError("can't compact a frozen data set, use Covid19_Data.copy() to get a writable copy")
+
+        self.compact_storage = True
+        for node in self.get_nodes():
+            for attribute in Covid19_Tree_Node.SERIES_ATTRIBUTES:
+                series = getattr(node, attribute)
+                if series and not isinstance(series, (covid19_series.Compact_Series, covid19_series.Sparse_Series)):
+                    setattr(node, attribute, self.__dense_series(attribute, series))
+            node.data_changed()
+        self.data_changed()
+
+    def memory_report(self):
+        """Description: Measure the memory used by the node data arrays, to size servers for the full world data set
+        Inputs: None
+        Outputs:
+            return - dictionary {level: {metric: bytes}} where level is one of TREE_LEVEL_NAMES or "TOTAL" (sum over all
+                levels) and metric is a base metric name (ie "CONFIRMED_CASES").  Values shared by several lists (small
+                ints) are only counted once.
+        """
+        metric_names = {attribute: name for name, attribute in covid19_metrics.get_base_attributes().items()}
+
+        report = {"TOTAL": dict.fromkeys(metric_names.values(), 0)}
+        seen = set()
+        stack = [(self.time_series_data_tree, 0)]
+        while stack:
+            node, level = stack.pop()
+            if level < len(self.TREE_LEVEL_NAMES):
+                level_name = self.TREE_LEVEL_NAMES[level]
+            else:
+                level_name = "Level " + str(level)
+            level_report = report.setdefault(level_name, dict.fromkeys(metric_names.values(), 0))
+            for attribute, name in metric_names.items():
+                nbytes = covid19_series.series_nbytes(getattr(node, attribute), seen)
+                level_report[name] = level_report[name] + nbytes
+                report["TOTAL"][name] = report["TOTAL"][name] + nbytes
+            stack.extend((child, level + 1) for child in node.get_children())
+
+        return report
+
+    def record_vintage(self, label):
+        """Description: Save the current contents of the tree as a vintage of the data set so it can be compared with later
+            revisions of the data.  The first vintage is stored as a snapshot, later ones only store the values that changed.
+            To keep a history across parses of the data files, set self.vintages to the store of the previous data set
+            before recording.
+        Inputs:
+            label - unique name of the vintage (ie the date / time the data was parsed)
+        Outputs:
+            self.vintages - Vintage_Store (created if None) with the new vintage added.  Use self.vintages.get_series,
+                get_value and diff for "as of" queries and to list what changed between two vintages.
+            return - number of data values stored for the vintage
+            Raises ValueError if the label was already used
+        """
+        if self.vintages == None:
+            self.vintages = covid19_vintages.Vintage_Store()
+        nodes = [(node.get_path(), node) for node in self.get_nodes()]
+        return self.vintages.record(label, nodes, self.time_series_dates)
+
     def read_time_series_data(self, url, filename=None):
         """Description: Reads the Johns Hopkins COVID-19 time series CSV file into the time_series_data dictionary
         Inputs:
@@ -680,29 +1031,8 @@ class Covid19_Data:
                     # this is a world data time series file so there is no county data
                     county = None
 
-                # add the country to the base tree if it's not already there
-                country_node = self.time_series_data_tree.get_child_node(country)
-                if country_node == None:
-                    country_node = Covid19_Tree_Node(country)
-                    self.time_series_data_tree.add_child(country_node)
-
-                # add the state to the country tree node if it's not already there
-                if state != "":
-                    state_node = country_node.get_child_node(state)
-                    if state_node == None:
-                        state_node = Covid19_Tree_Node(state)
-                        country_node.add_child(state_node)
-                else:
-                    state_node = None
-
-                # add the county to the state tree node if it's not already there
-                if county != None and county != "":
-                    county_node = state_node.get_child_node(county)
-                    if county_node == None:
-                        county_node = Covid19_Tree_Node(county)
-                        state_node.add_child(county_node)
-                else:
-                    county_node = None
+                # add the country / state / county to the tree if they're not already there
+                node, aggregate_to_parent, _ = self.__add_time_series_node(country, state, county)
 
                 # add data to the apprpriate entry in the tree for country/state/county and aggregate for whole state, and aggregate for whole country
                 i = 0
@@ -710,15 +1040,7 @@ class Covid19_Data:
                     j = self.time_series_dates.index(date_list[i])
                     data_val = [int(float(row[col]))]
 
-                    if county_node != None:
-                        self.__set_node_data_values(county_node, data_types, data_val, index=j, aggregate_to_parent=True, absolute=True)
-                    elif state_node != None:
-                        if country_node.node_name not in self.__world_country_state_aggregration_exclusions_list:
-                            self.__set_node_data_values(state_node, data_types, data_val, index=j, aggregate_to_parent=True, absolute=True)
-                        else:
-                            self.__set_node_data_values(state_node, data_types, data_val, index=j, aggregate_to_parent=False, absolute=True)
-                    elif country_node != None:
-                        self.__set_node_data_values(country_node, data_types, data_val, index=j, aggregate_to_parent=False, absolute=True)
+                    self.__set_node_data_values(node, data_types, data_val, index=j, aggregate_to_parent=aggregate_to_parent, absolute=True)
 
                     i = i + 1
 
@@ -729,6 +1051,177 @@ class Covid19_Data:
 
         return header_row_found
 
+    def __add_time_series_node(self, country, state, county):
+        """Description: Get the tree node for a location in the time series data, adding the country / state / county
+            nodes to the tree if they're not already there
+        Inputs:
+            country - country name
+            state - state name, "" for country level data
+            county - county name, None or "" for country or state level data
+        Outputs:
+            return - (node, aggregate_to_parent, added) where
+                node - the Covid19_Tree_Node for the location
+                aggregate_to_parent - True if the data for the location is to be summed into its parents
+                added - True if a node was added to the tree
+        """
+        added = False
+        country_node = self.time_series_data_tree.get_child_node(country)
+        if country_node == None:
+            country_node = Covid19_Tree_Node(country)
+            self.time_series_data_tree.add_child(country_node)
+            added = True
+
+        if state != None and state != "":
+            state_node = country_node.get_child_node(state)
+            if state_node == None:
+                state_node = Covid19_Tree_Node(state)
+                country_node.add_child(state_node)
+                added = True
+        else:
+            return country_node, False, added
+
+        if county != None and county != "":
+            county_node = state_node.get_child_node(county)
+            if county_node == None:
+                county_node = Covid19_Tree_Node(county)
+                state_node.add_child(county_node)
+                added = True
+            return county_node, True, added
+
+        return state_node, country_node.node_name not in self.__world_country_state_aggregration_exclusions_list, added
+
+    def append_day(self, date, records):
+        """Description: Add the data for one new date at the end of the time series without re-reading the data files.
+            The node data arrays grow in place (amortized O(1) per node), the reported values are written to their nodes
+            and summed into the ancestors of those nodes only, and the cached metric arrays (see get_metric_array) are
+            extended by calculating just the new column instead of being rebuilt.
+        Inputs:
+            date - datetime of the new day, must be after the last date in self.time_series_dates
+            records - list of (country, state, county, data_types, data_values) with the data reported for the day, where
+                state and county are "" or None for country or state level data and data_types / data_values are the same
+                as for __set_node_data_values (ie ['CONFIRMED', 'DEATHS'], [1234, 56]).  Values are summed into the
+                ancestors of a location following the same rules as read_time_series_data, after all records are written.
+                Rates (NON_AGGREGATED_DATA_TYPES, ie 'INCIDENT') are only written to the location itself, like the daily
+                report readers do.
+        Outputs:
+            self.time_series_dates and every non empty node data array are one element longer
+            nodes are added to the tree for locations that aren't in it yet (same as read_time_series_data)
+            Raises RuntimeError if the data set has been frozen, ValueError if date isn't after the last date
+        """
+        if self.frozen:
+            raise RuntimeError("can't append data to a frozen data set, use Covid19_Data.copy() to get a writable copy")
+        if self.time_series_dates and date <= self.time_series_dates[-1]:
+            raise ValueError("append_day - " + str(date) + " is not after the last date " + str(self.time_series_dates[-1]))
+
+        index = len(self.time_series_dates)
+        self.time_series_dates.append(date)
+        for node in self.get_nodes():
+            for attribute in Covid19_Tree_Node.SERIES_ATTRIBUTES:
+                series = getattr(node, attribute)
+                if series:
+                    series.append(None)
+            node.data_changed()
+        self.data_changed()
+
+        # write the records, then add their sums to each affected ancestor once instead of walking up the tree per record
+        nodes_added = False
+        ancestor_sums = {}
+        for country, state, county, data_types, data_values in records:
+            node, aggregate_to_parent, added = self.__add_time_series_node(country, state, county)
+            nodes_added = nodes_added or added
+            self.__set_node_data_values(node, data_types, data_values, index, aggregate_to_parent=False, absolute=True)
+            parent = node.parent if aggregate_to_parent else None
+            while parent != None:
+                sums = ancestor_sums.setdefault(id(parent), (parent, {}))[1]
+                for data_type, data_value in zip(data_types, data_values):
+                    if data_value != None and data_type not in self.NON_AGGREGATED_DATA_TYPES:
+                        sums[data_type] = sums.get(data_type, 0) + data_value
+                parent = parent.parent
+
+        for parent, sums in ancestor_sums.values():
+            self.__set_node_data_values(parent, list(sums.keys()), list(sums.values()), index, aggregate_to_parent=False, absolute=False)
+
+        if nodes_added:
+            # the rows of the arrays changed, rebuild them on demand
+            self.__array_cache = {}
+        else:
+            self.__extend_array_cache(index)
+
+    def __extend_array_cache(self, first_column):
+        """Description: Bring the cached metric arrays up to date after days were appended to the time series.  Only
+            the new columns are calculated, derived metrics use the last columns of their (already extended) inputs as
+            far back as their registered lookback requires.  Moving window metrics are recalculated from their extended
+            inputs over every date, so their values are bit for bit the same as for a data set that was read from scratch.
+            Arrays that can't be extended are dropped and rebuilt on demand.
+        Inputs:
+            first_column - index of the first appended date
+        Outputs:
+            self.__array_cache holds the extended arrays, stamped with the current data_version
+        """
+        cache = self.__array_cache
+        self.__array_cache = {}
+        if "NODES" not in cache:
+            return
+        _, nodes, rows = cache["NODES"]
+        self.__array_cache["NODES"] = (self.data_version, nodes, rows)
+
+        length = len(self.time_series_dates)
+        populations = self.get_populations()
+        keys = [key for key in cache if key != "NODES"]
+        order = covid19_metrics.dependency_order([key[0] for key in keys])
+        keys.sort(key=lambda key: order.index(key[0]))
+        for key in keys:
+            _, values, valid, buffer = cache[key]
+            if values.shape[1] != first_column:
+                continue
+            name = key[0]
+            params = dict(key[1:])
+            metric = covid19_metrics.get_metric(name)
+
+            if metric.is_base():
+                tail = np.full((len(nodes), length - first_column), np.nan)
+                valid = valid.copy()
+                data_rows = []
+                data_values = []
+                for row, node in enumerate(nodes):
+                    series = getattr(node, metric.attribute)
+                    if series:
+                        data_rows.append(row)
+                        data_values.append(series[first_column:length])
+                if data_rows:
+                    tail[data_rows] = np.array(data_values, dtype=float)
+                    valid[data_rows] = True
+            else:
+                lookback = covid19_metrics.lookback(name, **params)
+                start = 0 if lookback is None else first_column - lookback - 1
+                if start < 0:
+                    continue
+
+                def resolve(input_name, **input_params):
+                    _, input_values, input_valid, _ = self.__array_cache[self.__array_cache_key(input_name, input_params)]
+                    return input_values[:, start:], input_valid
+
+                try:
+                    tail, tail_valid = covid19_metrics.calculate_array(name, resolve, populations, **params)
+                except KeyError:
+                    # an input wasn't cached (or couldn't be extended)
+                    continue
+                if (tail_valid & ~valid).any():
+                    # nodes that had no valid data before need every column calculated
+                    continue
+                tail = tail[:, first_column - start:]
+                valid = tail_valid
+
+            if buffer.shape[1] < length or not buffer.flags.writeable:
+                # grow by 1/8 so appending days one at a time is amortized O(nodes) per day
+                new_buffer = np.full((len(nodes), max(length, first_column + first_column // 8)), np.nan)
+                new_buffer[:, :first_column] = values
+                buffer = new_buffer
+            buffer[:, first_column:length] = tail
+            values = buffer[:, :length]
+            values.flags.writeable = False
+            self.__array_cache[key] = (self.data_version, values, valid, buffer)
+
     def read_us_daily_report_file(self, reader_obj, data_index):
         """Description: Reads the Johns Hopkins COVID-19 daily report CSV file into the time_series_data dictionary
         Inputs:
@@ -984,6 +1477,8 @@ class Covid19_Data:
                     node_to_update.longitude = longitude
                     node_to_update.fips = fips
                     node_to_update.iso3 = iso3
+                    node_to_update.data_changed()
+                    self.data_version = self.data_version + 1
                 
             row_count = row_count + 1
 
@@ -1010,6 +1505,16 @@ class Covid19_Data:
 
         """
         file_date_val = datetime.datetime.strptime(self.github_tree.split_file(filename),'%m-%d-%Y')
+
+        # files are cached under their git sha, so a cached copy is only used while the file is unchanged on github
+        cache_file = None
+        sha = self.github_tree.get_sha(filename)
+        if self.download_cache != None and sha != None:
+            cache_file = os.path.join(self.download_cache, sha + ".csv")
+            if os.path.isfile(cache_file):
+                with open(cache_file, "r", encoding="utf-8") as f:
+                    return (f.read().splitlines(), file_date_val)
+
         print("retrieving data for ", filename, " - ", file_date_val)
 
         url = "https://raw.githubusercontent.com/CSSEGISandData/COVID-19/master/"
@@ -1019,9 +1524,18 @@ class Covid19_Data:
         response = requests.get(url)
         end1 = time.time()
         start2 = time.time()
-        lines = response.content.decode("utf-8").splitlines()
+        contents = response.content.decode("utf-8")
+        lines = contents.splitlines()
         end2 = time.time()
         print("\n\n", "retrieve:", end1 - start1, "parse:", end2 - start2)
+
+        if cache_file != None and response.ok:
+            os.makedirs(self.download_cache, exist_ok=True)
+            # write under a temporary name first, the pool processes may be retrieving the same file
+            temporary_file = cache_file + "." + str(os.getpid())
+            with open(temporary_file, "w", encoding="utf-8") as f:
+                f.write(contents)
+            os.replace(temporary_file, cache_file)
         
 
         # reader_obj = csv.reader(lines)
@@ -1438,28 +1952,508 @@ class Covid19_Data:
 
         return node
         
+    def add_region_group(self, name, members):
+        """Description: Register a user defined region made up of nodes from the tree (ie a continent from its countries or
+            a metro area from its counties).  Groups don't change the data in the tree so they can be added to frozen data.
+        Inputs:
+            name - name of the group, replaces a group with the same name
+            members - list of Covid19_Tree_Node from the tree
+        Outputs:
+            return - the Covid19_Region_Group, which can be used anywhere a Covid19_Tree_Node is accepted
+            Raises ValueError if a member is not part of the tree
+        """
+        group = Covid19_Region_Group(name, members, self)
+        self.region_groups[name] = group
+        return group
+
+    def get_region_group(self, name):
+        """Description: accessor function for a registered region group
+        Inputs: name - name of the group
+        Outputs: returns the Covid19_Region_Group, None if there is no group with that name
+        """
+        return self.region_groups.get(name)
+
+    def get_region_groups(self):
+        """Description: get a list of all registered region groups
+        Inputs: None
+        Outputs: returns list of Covid19_Region_Group
+        """
+        return list(self.region_groups.values())
+
+    def get_nodes(self):
+        """Description: Get every node in the data tree in a fixed order (depth first starting with World).  This order
+            defines the rows of the arrays returned by get_metric_array and compute.
+        Inputs: None
+        Outputs:
+            return - list of Covid19_Tree_Node
+        """
+        entry = self.__array_cache.get("NODES")
+        if entry is not None and entry[0] == self.data_version:
+            return entry[1]
+
+        nodes = []
+        stack = [self.time_series_data_tree]
+        while stack:
+            node = stack.pop()
+            nodes.append(node)
+            stack.extend(reversed(node.get_children()))
+
+        rows = {id(node): row for row, node in enumerate(nodes)}
+        self.__array_cache["NODES"] = (self.data_version, nodes, rows)
+        return nodes
+
+    def get_node_rows(self, nodes):
+        """Description: Get the array rows of a list of nodes
+        Inputs:
+            nodes - list of Covid19_Tree_Node from this data set
+        Outputs:
+            return - numpy array with the row index of each node in the arrays returned by get_metric_array
+            Raises ValueError if a node is not part of the data tree
+        """
+        self.get_nodes()
+        rows = self.__array_cache["NODES"][2]
+        try:
+            return np.array([rows[id(node)] for node in nodes], dtype=np.intp)
+        except KeyError:
+            raise ValueError("node is not part of the data tree")
+
+    def get_populations(self):
+        """Description: Get the population of every node
+        Inputs: None
+        Outputs:
+            return - numpy float array in get_nodes() order, NaN for nodes without a (non zero) population
+        """
+        populations = np.array([node.population if node.population else np.nan for node in self.get_nodes()], dtype=float)
+        return populations
+
+    def get_metric_array(self, name, **params):
+        """Description: Get a metric for every node in the tree as a single array.  Base metrics are stacked from the node
+            data arrays, derived metrics are calculated with one vectorized pass over their input arrays.  The arrays are
+            cached until the data in the tree changes.
+        Inputs:
+            name - name of a registered metric
+            params - optional overrides for the parameters of the metric or its inputs (ie window=14)
+        Outputs:
+            return - (values, valid) where
+                values - read-only (nodes x dates) float array in get_nodes() order, NaN where the node series is None
+                valid - boolean array, False for nodes whose series is None (no data at all)
+            Raises KeyError if the metric is not registered
+        """
+        metric = covid19_metrics.get_metric(name)
+        params = covid19_metrics.select_parameters(name, params)
+        key = self.__array_cache_key(name, params)
+        entry = self.__array_cache.get(key)
+        if entry is not None and entry[0] == self.data_version:
+            return entry[1], entry[2]
+
+        if metric.is_base():
+            values, valid = self.__stack_series(metric.attribute, self.get_nodes())
+        else:
+            resolve = lambda input_name, **input_params: self.get_metric_array(input_name, **input_params)
+            values, valid = covid19_metrics.calculate_array(name, resolve, self.get_populations(), **params)
+
+        values.flags.writeable = False
+        self.__array_cache[key] = (self.data_version, values, valid, values)
+        return values, valid
+
+    def __stack_series(self, attribute, nodes):
+        """Description: Stack a data array of many nodes into a single array
+        Inputs:
+            attribute - name of the node attribute holding the data array
+            nodes - list of Covid19_Tree_Node
+        Outputs:
+            return - (values, valid) (nodes x dates) float array with NaN for missing values and boolean array, False for
+                nodes without the data array
+        """
+        values = np.full((len(nodes), len(self.time_series_dates)), np.nan)
+        valid = np.zeros(len(nodes), dtype=bool)
+        for row, node in enumerate(nodes):
+            series = getattr(node, attribute)
+            if isinstance(series, (covid19_series.Compact_Series, covid19_series.Sparse_Series)):
+                series = series.to_array()[:values.shape[1]]
+                values[row, :len(series)] = series
+                valid[row] = True
+            elif series:
+                series = np.array(series[:values.shape[1]], dtype=float)
+                values[row, :len(series)] = series
+                valid[row] = True
+        return values, valid
+
+    def calculate_metric_rows(self, names, nodes):
+        """Description: Calculate metrics for some of the nodes without caching anything, so the memory used only grows with
+            the number of nodes (ie to process the whole tree a chunk of nodes at a time).  Metric arrays that are already
+            cached (ie loaded from a snapshot) are sliced instead of calculated.
+        Inputs:
+            names - list of names of registered metrics, calculated with their default parameters
+            nodes - list of Covid19_Tree_Node from this data set
+        Outputs:
+            return - {name: (values, valid)} with the rows of the nodes of the arrays returned by get_metric_array (the
+                values are the same, every row is calculated on its own)
+            Raises KeyError if a metric is not registered, ValueError if a node is not part of the data tree
+        """
+        rows = self.get_node_rows(nodes)
+        populations = np.array([node.population if node.population else np.nan for node in nodes], dtype=float)
+        arrays = {}
+        resolve = lambda input_name, **input_params: arrays[input_name]
+        for name in covid19_metrics.dependency_order(names):
+            metric = covid19_metrics.get_metric(name)
+            entry = self.__array_cache.get(self.__array_cache_key(name, {}))
+            if entry is not None and entry[0] == self.data_version:
+                arrays[name] = (entry[1][rows], entry[2][rows])
+            elif metric.is_base():
+                arrays[name] = self.__stack_series(metric.attribute, nodes)
+            else:
+                arrays[name] = covid19_metrics.calculate_array(name, resolve, populations)
+        return {name: arrays[name] for name in names}
+
+    def set_metric_array(self, name, values, valid, **params):
+        """Description: Store a precomputed metric array (ie from a snapshot) so get_metric_array returns it without
+            calculating anything.  It is dropped like any cached array when the data in the tree changes.
+        Inputs:
+            name - name of a registered metric
+            values - (nodes x dates) float array in get_nodes() order, NaN where the node series is None
+            valid - boolean array, False for nodes whose series is None
+            params - parameter overrides the array was calculated with
+        Outputs:
+            the array is cached, raises KeyError if the metric is not registered or ValueError if the shape of the arrays
+            doesn't match the tree
+        """
+        covid19_metrics.get_metric(name)
+        if values.shape != (len(self.get_nodes()), len(self.time_series_dates)) or valid.shape != (values.shape[0],):
+            raise ValueError("array doesn't match the nodes and dates of the data set")
+        values = values.view()
+        values.flags.writeable = False
+        self.__array_cache[self.__array_cache_key(name, params)] = (self.data_version, values, valid, values)
+
+    def __array_cache_key(self, name, params):
+        """Description: Key of a metric array in self.__array_cache
+        Inputs:
+            name - name of a registered metric
+            params - parameter overrides for the metric
+        Outputs:
+            return - tuple of the name and the parameters that apply to the metric
+        """
+        params = covid19_metrics.select_parameters(name, params)
+        return (name,) + tuple(sorted(params.items()))
+
+    def compute(self, metric, nodes=None, window=None, start_date=None, end_date=None, step=1):
+        """Description: Calculate a metric for many nodes at once with vectorized numpy operations instead of calling the
+            per node get_XYZ functions in a loop.
+        Inputs:
+            metric - name of a registered metric (ie "DAILY_NEW_CASES", "MOVING_WINDOW_CASE_FATALITY_RATE")
+            nodes - optional list of Covid19_Tree_Node to calculate the metric for (default is every node, in get_nodes() order)
+            window - optional number of days for windowed metrics (moving averages, moving window ratios), overrides the
+                registered default
+            start_date, end_date, step - optional date range, see get_date_slice (default is every date)
+        Outputs:
+            return - (nodes x dates) read-only float array with NaN wherever the per node series has None (whole rows are NaN
+                for nodes where the per node function returns None).  Columns are aligned with self.time_series_dates,
+                for the log moving average metrics (whose per node series skip the first date) column 0 is NaN and the
+                remaining columns match the per node series.  Without nodes the result is a view of the cached array so
+                selecting a date range doesn't copy anything, with nodes only the selected rows and dates are copied.
+        """
+        params = {}
+        if window is not None:
+            params["window"] = window
+        values, _ = self.get_metric_array(metric, **params)
+        columns = self.get_date_slice(start_date, end_date, step)
+        if nodes is None:
+            return values[:, columns]
+        return values[self.get_node_rows(nodes), columns]
+
+    def get_date_slice(self, start_date=None, end_date=None, step=1):
+        """Description: Get the columns of a date range in the arrays returned by get_metric_array and compute
+        Inputs:
+            start_date - optional first date of the range (default is the first date)
+            end_date - optional last date of the range, inclusive (default is the last date)
+            step - optional, only use every step-th date counting back from the end of the range (the last date of the
+                range is always included)
+        Outputs:
+            return - slice of the date columns, indexing a numpy array with it returns a view
+        """
+        start = 0
+        stop = len(self.time_series_dates)
+        if start_date != None:
+            start = bisect.bisect_left(self.time_series_dates, start_date)
+        if end_date != None:
+            stop = bisect.bisect_right(self.time_series_dates, end_date)
+        if step > 1 and stop > start:
+            start = start + (stop - 1 - start) % step
+        return slice(start, stop, step)
+
+    def get_node_window(self, node, metric, start_date=None, end_date=None, step=1, window=None):
+        """Description: Get a date range of a metric for one node without copying the data
+        Inputs:
+            node - Covid19_Tree_Node from the tree or a region group
+            metric - name of a registered metric
+            start_date, end_date, step - optional date range, see get_date_slice (default is every date)
+            window - optional number of days for windowed metrics
+        Outputs:
+            return - read-only numpy view of the node's row in the cached metric array (NaN for missing values, aligned with
+                self.time_series_dates like compute), None if the node has no data for the metric
+        """
+        params = {}
+        if window is not None:
+            params["window"] = window
+        columns = self.get_date_slice(start_date, end_date, step)
+        try:
+            row = self.get_node_rows([node])[0]
+        except ValueError:
+            # not part of the tree (ie a region group), use the node's own series
+            series = node.get_metric(metric, **params)
+            if not series:
+                return None
+            values = np.full(len(self.time_series_dates), np.nan)
+            values[len(values) - len(series):] = np.array(series, dtype=float)
+            values.flags.writeable = False
+            return values[columns]
+
+        values, valid = self.get_metric_array(metric, **params)
+        if not valid[row]:
+            return None
+        return values[row, columns]
+
+    def get_date_major_array(self, name, **params):
+        """Description: Get a metric for every node in the tree with one row per date, so the values of every node on a
+            date are contiguous in memory (pie charts, bar charts and maps read one date across thousands of nodes).
+            Built from the array of get_metric_array the first time it is needed and cached until that array changes.
+        Inputs:
+            name - name of a registered metric
+            params - optional overrides for the parameters of the metric or its inputs (ie window=14)
+        Outputs:
+            return - read-only (dates x nodes) float array, columns in get_nodes() order, NaN where the node has no value
+        """
+        return self.__get_date_major_entry(name, params)[1]
+
+    def __get_date_major_entry(self, name, params):
+        """Description: Get the cached date major layout of a metric, building it if the metric array changed
+        Inputs:
+            name - name of a registered metric
+            params - parameter overrides for the metric
+        Outputs:
+            return - (metric array, transposed array, latest values, latest columns) where the latest value of a node is its
+                last value that isn't NaN and latest columns holds its date column (-1 if the node has no value at all)
+        """
+        values, _ = self.get_metric_array(name, **params)
+        key = self.__array_cache_key(name, params)
+        entry = self.__date_major_cache.get(key)
+        # the metric arrays are read-only and replaced whenever the data changes, so the array identifies the data
+        if entry is not None and entry[0] is values:
+            return entry
+
+        transposed = np.ascontiguousarray(values.T)
+        transposed.flags.writeable = False
+        latest = np.full(transposed.shape[1], np.nan)
+        latest_columns = np.full(transposed.shape[1], -1, dtype=np.intp)
+        if len(transposed):
+            reported = ~np.isnan(transposed)
+            has_value = reported.any(axis=0)
+            last = len(transposed) - 1 - np.argmax(reported[::-1], axis=0)
+            latest_columns[has_value] = last[has_value]
+            latest[has_value] = transposed[last[has_value], np.flatnonzero(has_value)]
+        latest.flags.writeable = False
+        latest_columns.flags.writeable = False
+
+        entry = (values, transposed, latest, latest_columns)
+        self.__date_major_cache[key] = entry
+        return entry
+
+    def get_prefix_sums(self, name, **params):
+        """Description: Get the NaN-aware cumulative sums of a metric for every node in the tree, so sums and means over
+            any date range or window length are a single subtraction per node.  Cached until the metric array changes.
+        Inputs:
+            name - name of a registered metric
+            params - optional overrides for the parameters of the metric or its inputs (ie window=14)
+        Outputs:
+            return - data_analysis.Prefix_Sums over the rows of the get_metric_array array (nodes x dates)
+        """
+        values, _ = self.get_metric_array(name, **params)
+        key = self.__array_cache_key(name, params)
+        entry = self.__prefix_sum_cache.get(key)
+        if entry is not None and entry[0] is values:
+            return entry[1]
+
+        prefix_sums = data_analysis.Prefix_Sums(values)
+        self.__prefix_sum_cache[key] = (values, prefix_sums)
+        return prefix_sums
+
+    def get_range_sums(self, metric, start_date=None, end_date=None, nodes=None, window=None):
+        """Description: Sum a metric over a date range for many nodes at once
+        Inputs:
+            metric - name of a registered metric
+            start_date, end_date - optional first and last (inclusive) date of the range (default is every date)
+            nodes - optional list of Covid19_Tree_Node (default is every node, in get_nodes() order)
+            window - optional number of days for windowed metrics
+        Outputs:
+            return - (sums, counts) float array with the sum of each node's values in the range (missing values count as 0)
+                and int array with the number of values that aren't missing
+        """
+        prefix_sums, rows, columns = self.__get_range(metric, start_date, end_date, nodes, window)
+        sums = prefix_sums.sum(columns.start, columns.stop)
+        counts = prefix_sums.count(columns.start, columns.stop)
+        if rows is None:
+            return sums, counts
+        return sums[rows], counts[rows]
+
+    def get_range_means(self, metric, start_date=None, end_date=None, nodes=None, window=None):
+        """Description: Average a metric over a date range for many nodes at once, see get_range_sums
+        Inputs:
+            metric - name of a registered metric
+            start_date, end_date - optional first and last (inclusive) date of the range (default is every date)
+            nodes - optional list of Covid19_Tree_Node (default is every node, in get_nodes() order)
+            window - optional number of days for windowed metrics
+        Outputs:
+            return - float array with the mean of each node's values in the range that aren't missing, NaN if there are none
+        """
+        prefix_sums, rows, columns = self.__get_range(metric, start_date, end_date, nodes, window)
+        means = prefix_sums.mean(columns.start, columns.stop)
+        if rows is None:
+            return means
+        return means[rows]
+
+    def __get_range(self, metric, start_date, end_date, nodes, window):
+        """Description: Look up the prefix sums, rows and date columns for get_range_sums and get_range_means
+        Inputs: see get_range_sums
+        Outputs:
+            return - (prefix sums, rows of the nodes or None for every node, slice of the date columns)
+        """
+        params = {}
+        if window is not None:
+            params["window"] = window
+        prefix_sums = self.get_prefix_sums(metric, **params)
+        columns = self.get_date_slice(start_date, end_date)
+        columns = slice(columns.start, max(columns.start, columns.stop))
+        rows = None
+        if nodes is not None:
+            rows = self.get_node_rows(nodes)
+        return prefix_sums, rows, columns
+
+    def get_cross_section(self, metric, date=None, nodes=None, window=None):
+        """Description: Get the values of a metric for many nodes on one date
+        Inputs:
+            metric - name of a registered metric
+            date - optional date (default is the last date)
+            nodes - optional list of Covid19_Tree_Node (default is every node, in get_nodes() order)
+            window - optional number of days for windowed metrics
+        Outputs:
+            return - (values, valid) where
+                values - float array with the value of each node on the date, NaN if missing.  Without nodes this is a
+                    read-only view of a row of the date major array, nothing is copied
+                valid - boolean array, False for nodes that have no data for the metric at all
+            Raises ValueError if there is no data for the date
+        """
+        params = {}
+        if window is not None:
+            params["window"] = window
+        transposed = self.get_date_major_array(metric, **params)
+        _, valid = self.get_metric_array(metric, **params)
+
+        if date is None:
+            column = len(self.time_series_dates) - 1
+        else:
+            column = bisect.bisect_left(self.time_series_dates, date)
+        if column < 0 or column >= len(self.time_series_dates) or (date != None and self.time_series_dates[column] != date):
+            raise ValueError("no data for " + str(date))
+
+        if nodes is None:
+            return transposed[column], valid
+        rows = self.get_node_rows(nodes)
+        return transposed[column, rows], valid[rows]
+
+    def get_latest_values(self, metric, nodes=None, window=None):
+        """Description: Get the most recent value of a metric for many nodes, skipping trailing dates that have no data
+            (ie people tested reported a few days late)
+        Inputs:
+            metric - name of a registered metric
+            nodes - optional list of Covid19_Tree_Node (default is every node, in get_nodes() order)
+            window - optional number of days for windowed metrics
+        Outputs:
+            return - (values, dates) where
+                values - float array with the last value of each node that isn't missing, NaN if the node has none
+                dates - list with the date of each of those values, None if the node has none
+        """
+        params = {}
+        if window is not None:
+            params["window"] = window
+        _, _, latest, latest_columns = self.__get_date_major_entry(metric, params)
+        if nodes is not None:
+            rows = self.get_node_rows(nodes)
+            latest = latest[rows]
+            latest_columns = latest_columns[rows]
+        dates = [self.time_series_dates[column] if column >= 0 else None for column in latest_columns.tolist()]
+        return latest, dates
+
+    def to_frame(self, metrics, nodes=None, start_date=None, end_date=None, step=1, layout="long", window=None):
+        """Description: Get metrics for many nodes as a pandas DataFrame built directly from the metric arrays (see compute)
+        Inputs:
+            metrics - name of a registered metric or list of names
+            nodes - optional list of Covid19_Tree_Node or region groups (default is every node, in get_nodes() order)
+            start_date, end_date, step - optional date range, see get_date_slice (default is every date)
+            layout - "long" for one row per node and date with the columns "region", "date" and one column per metric
+                (rows grouped by node), "wide" for one row per date (DatetimeIndex named "date") and one column per node,
+                with a list of metrics the columns are a (metric, region) MultiIndex
+            window - optional number of days for windowed metrics
+        Outputs:
+            return - DataFrame with NaN for missing values (whole regions are NaN for nodes without data for a metric).  Region
+                labels are the node names stored as categoricals.  The wide layout of a single metric for every node is a
+                view of the cached metric array, the long layout shares the metric columns with it when every date is
+                selected.  Raises ValueError for an unknown layout.
+        """
+        if layout not in ("long", "wide"):
+            raise ValueError("unknown layout " + str(layout))
+        names = [metrics] if isinstance(metrics, str) else list(metrics)
+        if nodes is None:
+            nodes = self.get_nodes()
+        columns = self.get_date_slice(start_date, end_date, step)
+        dates = pd.DatetimeIndex(np.array(self.time_series_dates, dtype="datetime64[ns]")[columns], name="date")
+
+        blocks = []
+        for name in names:
+            try:
+                values = self.compute(name, None if nodes is self.get_nodes() else nodes, window, start_date, end_date, step)
+            except ValueError:
+                # region groups aren't part of the metric arrays, stack the rows of every node instead
+                values = np.full((len(nodes), len(dates)), np.nan)
+                for row, node in enumerate(nodes):
+                    node_values = self.get_node_window(node, name, start_date, end_date, step, window)
+                    if node_values is not None:
+                        values[row] = node_values
+            blocks.append(values)
+
+        # nodes in different states can have the same name, so the codes are assigned per name
+        region_names = [node.node_name for node in nodes]
+        categories = list(dict.fromkeys(region_names))
+        category_codes = {name: code for code, name in enumerate(categories)}
+        codes = np.array([category_codes[name] for name in region_names], dtype=np.int32)
+
+        if layout == "wide":
+            regions = pd.CategoricalIndex(pd.Categorical.from_codes(codes, categories), name="region")
+            if isinstance(metrics, str):
+                return pd.DataFrame(blocks[0].T, index=dates, columns=regions, copy=False)
+            metric_labels = pd.Categorical.from_codes(np.repeat(np.arange(len(names), dtype=np.int32), len(nodes)), names)
+            columns_index = pd.MultiIndex.from_arrays([metric_labels, pd.Categorical.from_codes(np.tile(codes, len(names)), categories)], names=["metric", "region"])
+            return pd.DataFrame(np.concatenate(blocks).T, index=dates, columns=columns_index, copy=False)
+
+        frame = {
+            "region": pd.Categorical.from_codes(np.repeat(codes, len(dates)), categories),
+            "date": np.tile(dates.values, len(nodes)),
+            }
+        for name, values in zip(names, blocks):
+            frame[name] = values.reshape(-1)
+        return pd.DataFrame(frame, copy=False)
+
     def plot_data(self, country_list, state_list, county_list, plot_type):
         """Description: function to create an XY plot of specified state/county pairs for the specified plot type
         Inputs:
             country_list - list of countries in country / state / county path
             state_list - optional, list of states in country / state / county path
             county_list - optional, list of counties in country / state / county path
-            plot_type - string identifying the plot type from:
+            plot_type - name of a metric in the covid19_metrics registry, for example:
                 "CONFIRMED_CASES"
                 "DEATHS"
-                "PEOPLE_TESTED"
-                "ACTIVE_CASES"
-                "RECOVERED_CASES"
                 "DAILY_NEW_CASES"
-                "DAILY_NEW_DEATHS"
-                "DAILY_NEW_PEOPLE_TESTED"
-                "RECOVERY_RATE"
-                "RATIO_CONFIRMED_CASES_TO_PEOPLE_TESTED"
                 "DAILY_RATIO_CONFIRMED_CASES_TO_PEOPLE_TESTED"
-                "CASE_FATALITY_RATE"
                 "CALCULATED_CASES_INCIDENT_RATE"
-                "CALCULATED_DEATHS_INCIDENT_RATE"
-                "CALCULATED_PEOPLE_TESTED_INCIDENT_RATE"
                 "DAILY_NEW_CASES_INCIDENT_RATE"
 
         Outputs:
@@ -1490,57 +2484,12 @@ class Covid19_Data:
                     plot_node = county_node
                     label_string = country_list[i] + ", " + state_list[i] + ", " + county_list[i]
 
-            if plot_type == "CONFIRMED_CASES":
-                y = plot_node.confirmed_cases_time_series_data
-                plot_label = "Confirmed Cases"
-            elif plot_type == "DEATHS":
-                y = plot_node.deaths_time_series_data
-                plot_label = "Deaths"
-            elif plot_type == "PEOPLE_TESTED":
-                y = plot_node.people_tested_time_series_data
-                plot_label = "People Tested"
-            elif plot_type == "ACTIVE_CASES":
-                y = plot_node.active_cases_time_series_data
-                plot_label = "Active Cases"
-            elif plot_type == "RECOVERED_CASES":
-                y = plot_node.recovered_cases_time_series_data
-                plot_label = "Recovered Cases"
-            elif plot_type == "DAILY_NEW_CASES":
-                y = plot_node.get_daily_new_cases()
-                plot_label = "Daily New Cases"
-            elif plot_type == "DAILY_NEW_DEATHS":
-                y = plot_node.get_daily_new_deaths()
-                plot_label = "Daily New Deaths"
-            elif plot_type == "DAILY_NEW_PEOPLE_TESTED":
-                y = plot_node.get_daily_new_people_tested()
-                plot_label = "Daily New People Tested"
-            elif plot_type == "RECOVERY_RATE":
-                y = plot_node.get_recovery_rate()
-                plot_label = "Recovery Rate"
-            elif plot_type == "RATIO_CONFIRMED_CASES_TO_PEOPLE_TESTED":
-                y = plot_node.get_ratio_confirmed_cases_to_people_tested()
-                plot_label = "Ratio of Confirmed Cases to People Tested"
-            elif plot_type == "DAILY_RATIO_CONFIRMED_CASES_TO_PEOPLE_TESTED":
-                y = plot_node.get_daily_ratio_confirmed_cases_to_people_tested()
-                plot_label = "Daily Ratio of Confirmed Cases to People Tested"
-            elif plot_type == "CASE_FATALITY_RATE":
-                y = plot_node.get_case_fatality_rate()
-                plot_lable = "Case Fatality Rate"
-            elif plot_type == "CALCULATED_CASES_INCIDENT_RATE":
-                y = plot_node.get_calculated_cases_incident_rate()
-                plot_label = "Cases per 100K Population"
-            elif plot_type == "CALCULATED_DEATHS_INCIDENT_RATE":
-                y = plot_node.get_calculated_deaths_incident_rate()
-                plot_label = "Deaths per 100K Population"
-            elif plot_type == "CALCULATED_PEOPLE_TESTED_INCIDENT_RATE":
-                y = plot_node.get_calculated_people_tested_incident_rate()
-                plot_label = "People Tested per 100K Population"
-            elif plot_type == "DAILY_NEW_CASES_INCIDENT_RATE":
-                y = plot_node.get_daily_new_cases_incident_rate()
-                plot_label = "Daily New Cases per 100K Population"
-            else:
+            try:
+                plot_label = covid19_metrics.get_metric(plot_type).label
+            except KeyError:
                 print("ERROR: plot_data - invalid plot_type: ", plot_type)
                 return False
+            y = plot_node.get_metric(plot_type)
 
             if y:
                 x = self.time_series_dates
@@ -1574,20 +2523,70 @@ class Covid19_Data:
         while gui.mainloop(): pass
 
 
+def iterate_tree(node, breadth_first=False, min_level=0, max_level=None, predicate=None):
+    """Description: Walk a tree without recursion, yielding the nodes one at a time
+    Inputs:
+        node - Covid19_Tree_Node to start the walk at (level 0)
+        breadth_first - optional, walk level by level instead of depth first (default is depth first, parents before
+            their children in child order, the order of Covid19_Data.get_nodes)
+        min_level - optional, only yield nodes at this level or deeper (ie 1 to skip the start node)
+        max_level - optional, don't go deeper than this level (ie 1 for the start node and its children)
+        predicate - optional function(node) returning True for the nodes to yield, the walk still continues below
+            nodes that are filtered out
+    Outputs:
+        yields (node, path) where path is the tuple of node names from below the start node down to the node (so walking
+            from World gives the same paths as Covid19_Tree_Node.get_path)
+    """
+    pending = collections.deque([(node, ())])
+    while pending:
+        if breadth_first:
+            current, path = pending.popleft()
+        else:
+            current, path = pending.pop()
+        level = len(path)
+        if level >= min_level and (predicate is None or predicate(current)):
+            yield current, path
+
+        if max_level is None or level < max_level:
+            children = [(child, path + (child.node_name,)) for child in current.get_children()]
+            if breadth_first:
+                pending.extend(children)
+            else:
+                pending.extend(reversed(children))
+
+
+# keys of the node time series in the "data" object of a tree file line -> Covid19_Tree_Node attribute
+TREE_FILE_SERIES = (
+    ("confirmed_cases", "confirmed_cases_time_series_data"),
+    ("deaths", "deaths_time_series_data"),
+    ("people_tested", "people_tested_time_series_data"),
+    ("incident_rate", "incident_rate_time_series_data"),
+    ("active_cases", "active_cases_time_series_data"),
+    ("recovered_cases", "recovered_cases_time_series_data"),
+    )
+
+# other node attributes stored in the "data" object of a tree file line
+TREE_FILE_ATTRIBUTES = ("population", "latitude", "longitude", "iso3", "fips")
+
+
 def dump_tree_to_file(node, file_location):
-    if node.get_children():
-        for child_node in node.get_children():
-            node_data = {
-                "confirmed_cases":child_node.confirmed_cases_time_series_data,
-                "deaths":child_node.deaths_time_series_data,
-                "people_tested":child_node.people_tested_time_series_data,
-                "incident_rate": child_node.incident_rate_time_series_data,
-                "active_cases":child_node.active_cases_time_series_data,
-                "recovered_cases":child_node.recovered_cases_time_series_data,
-                "population":child_node.population,
-                "latitude":child_node.latitude,
-                "longitude":child_node.longitude,
-            }
+    """Description: Append every node below node to a file, one JSON object per line (parents before children)
+    Inputs:
+        node - Covid19_Tree_Node at the top of the tree, it isn't written itself
+        file_location - path of the file, opened once for the whole tree
+    Outputs:
+        return - True if any nodes were written, False if node has no children
+    """
+    if not node.get_children():
+        return False
+
+    with open(file_location, "a") as f:
+        for child_node, path in iterate_tree(node, min_level=1):
+            node_data = {}
+            for key, attribute in TREE_FILE_SERIES:
+                node_data[key] = list(getattr(child_node, attribute))
+            for attribute in TREE_FILE_ATTRIBUTES:
+                node_data[attribute] = getattr(child_node, attribute)
 
             try:
                 parent_node = child_node.parent.node_name
@@ -1596,96 +2595,98 @@ def dump_tree_to_file(node, file_location):
             data = {
                 "node_name":child_node.node_name,
                 "parent_node":parent_node,
-                "children_nodes":child_node.get_children(),
+                "path":list(path),
+                "children_nodes":[grandchild.node_name for grandchild in child_node.get_children()],
                 "data":node_data
             }
 
-            with open(file_location, "a") as f:
-                json.dump(data, f)
-                f.write("\n")
-
-            dump_tree_to_file(child_node, file_location)
-
-        return True
+            f.write(json.dumps(data))
+            f.write("\n")
 
-    return False
+    return True
 
 
 def read_tree_from_file(file_location):
+    """Description: Read a tree written by dump_tree_to_file in a single pass over the file.  Nodes are looked up by
+        their path, so a line can come before the line of its parent (the parent is created when the first of its
+        children is read and filled in when its own line is read).  Files written without paths are linked by parent
+        name, which relies on parents being written before their children.
+    Inputs:
+        file_location - path of the file
+    Outputs:
+        return - Covid19_Tree_Node "World" at the top of the tree read from the file.  When a node is listed more than
+            once the first line is used.
+    """
     root_node = Covid19_Tree_Node("World")
-
-    # contents = []
-    # with open(file_location, "r") as json_file:
-    #     for line in json_file:
-    #         contents.append(json.loads(line))
-    contents = [json.loads(line) for line in open(file_location, 'r')]
-
-    countries = [area for area in contents if area.get("parent_node") == "World"]
-
-    for country in countries:
-        country_node = Covid19_Tree_Node(country.get("node_name"))
-
-        country_node.confirmed_cases_time_series_data = country["data"].get("confirmed_cases")
-        country_node.deaths_time_series_data = country["data"].get("deaths")
-        country_node.people_tested_time_series_data = country["data"].get("people_tested")
-        country_node.incident_rate_time_series_data = country["data"].get("incident_rate")
-        country_node.active_cases_time_series_data = country["data"].get("active_cases")
-        country_node.recovered_cases_time_series_data = country["data"].get("recovered_cases")
-        country_node.population = country["data"].get("population")
-        country_node.latitude = country["data"].get("latitude")
-        country_node.longitude = country["data"].get("longitude")
-
-
-        if not country.get("node_name") in [i.node_name for i in root_node.get_children()]:
-            root_node.add_child(country_node)
-
-        states = [area for area in contents if area.get("parent_node") == country.get("node_name")]
-
-        for state in states:
-            state_node = Covid19_Tree_Node(state.get("node_name"))
-
-            state_node.confirmed_cases_time_series_data = state["data"].get("confirmed_cases")
-            state_node.deaths_time_series_data = state["data"].get("deaths")
-            state_node.people_tested_time_series_data = state["data"].get("people_tested")
-            state_node.incident_rate_time_series_data = state["data"].get("incident_rate")
-            state_node.active_cases_time_series_data = state["data"].get("active_cases")
-            state_node.recovered_cases_time_series_data = state["data"].get("recovered_cases")
-            state_node.population = state["data"].get("population")
-            state_node.latitude = state["data"].get("latitude")
-            state_node.longitude = state["data"].get("longitude")
-
-            if not state.get("node_name") in [i.node_name for i in country_node.get_children()]:
-                country_node.add_child(state_node)
-
-            counties = [area for area in contents if area.get("parent_node") == state.get("node_name")]
-
-            for county in counties:
-                county_node = Covid19_Tree_Node(county.get("node_name"))
-
-                county_node.confirmed_cases_time_series_data = county["data"].get("confirmed_cases")
-                county_node.deaths_time_series_data = county["data"].get("deaths")
-                county_node.people_tested_time_series_data = county["data"].get("people_tested")
-                county_node.incident_rate_time_series_data = county["data"].get("incident_rate")
-                county_node.active_cases_time_series_data = county["data"].get("active_cases")
-                county_node.recovered_cases_time_series_data = county["data"].get("recovered_cases")
-                county_node.population = county["data"].get("population")
-                county_node.latitude = county["data"].get("latitude")
-                county_node.longitude = county["data"].get("longitude")
-
-                if not state.get("node_name") in [i.node_name for i in state_node.get_children()]:
-                    state_node.add_child(county_node)
-
+    # path -> node, placeholders holds the paths of parents that were created before their own line was read
+    nodes = {(): root_node}
+    placeholders = set()
+    # for files without paths: the last node read with each name, and the nodes waiting for a parent with that name
+    named_nodes = {"World": root_node}
+    orphans = {}
+
+    with open(file_location, "r") as json_file:
+        for line in json_file:
+            if not line.strip():
+                continue
+            area = json.loads(line)
+
+            path = area.get("path")
+            if path is not None:
+                path = tuple(path)
+                node = nodes.get(path)
+                if node is None:
+                    node = Covid19_Tree_Node(area.get("node_name"))
+                    nodes[path] = node
+                    parent_path = path[:-1]
+                    child = node
+                    # create any missing ancestors so the node is linked to the tree right away
+                    while parent_path not in nodes:
+                        parent = Covid19_Tree_Node(parent_path[-1])
+                        nodes[parent_path] = parent
+                        placeholders.add(parent_path)
+                        parent.add_child(child)
+                        child = parent
+                        parent_path = parent_path[:-1]
+                    nodes[parent_path].add_child(child)
+                elif path in placeholders:
+                    placeholders.discard(path)
+                else:
+                    continue
+            else:
+                node = Covid19_Tree_Node(area.get("node_name"))
+                parent = named_nodes.get(area.get("parent_node"))
+                if parent is None:
+                    orphans.setdefault(area.get("parent_node"), []).append(node)
+                elif not parent.add_child(node):
+                    continue
+                named_nodes[node.node_name] = node
+                for orphan in orphans.pop(node.node_name, []):
+                    node.add_child(orphan)
+
+            node_data = area.get("data", {})
+            for key, attribute in TREE_FILE_SERIES:
+                setattr(node, attribute, node_data.get(key, []))
+            for attribute in TREE_FILE_ATTRIBUTES:
+                setattr(node, attribute, node_data.get(attribute))
+
+    if orphans:
+        print("ERROR: read_tree_from_file - no parent found for", sum(len(i) for i in orphans.values()), "nodes")
 
     return root_node
 
 
 def print_tree(node, file, node_level=0):
-    prepend = (node_level * "    ")
+    """Description: Append the names of node and every node below it to a file, indented by level
+    Inputs:
+        node - Covid19_Tree_Node at the top of the tree
+        file - path of the file, opened once for the whole tree
+        node_level - optional, indentation level of node
+    Outputs:
+        the tree is written to the file
+    """
     with open(file, "a") as f:
-        f.write(prepend)
-        f.write(node.node_name)
-        f.write("\n")
-
-    if node.get_children():
-        for child in node.get_children():
-            print_tree(child, file, node_level + 1)
+        for tree_node, path in iterate_tree(node):
+            f.write((node_level + len(path)) * "    ")
+            f.write(tree_node.node_name)
+            f.write("\n")
@@ -0,0 +1,667 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Registry of the metrics that can be plotted / displayed for a Covid19_Tree_Node.
+
+Every metric is declared once here with its label, the metrics it is derived
+from and its parameters.  Base metrics read a time series attribute of the
+node, derived metrics are calculated from the series of their input metrics,
+so the registry forms a dependency graph, for example:
+
+    CONFIRMED_CASES -> DAILY_NEW_CASES -> DAILY_NEW_CASES_INCIDENT_RATE
+        -> 7DAY_MOVING_AVERAGE_DAILY_NEW_CASES_INCIDENT_RATE
+        -> LOG2_7DAY_MOVING_AVERAGE_DAILY_NEW_CASES_INCIDENT_RATE
+"""
+import math
+import numpy as np
+
+import data_analysis
+
+
+class Metric:
+    """
+    declaration of a single metric in the registry
+    """
+    def __init__(self, name, label, attribute=None, inputs=(), function=None, params=None, array_function=None, per_capita=False, lookback=0):
+        """
+        Parameters
+        ----------
+        name : str
+            unique identifier of the metric (ie "DAILY_NEW_CASES").
+        label : str
+            human readable label used for plot axes and UI selections.
+        attribute : str, optional
+            for base metrics, the Covid19_Tree_Node attribute holding the data.
+        inputs : tuple of str, optional
+            for derived metrics, names of the metrics the calculation is based on.
+        function : function, optional
+            for derived metrics, function(node, *input_series, **params) returning
+            the derived list or None if there is no valid data.
+        params : dict, optional
+            default keyword parameters passed to function.
+        array_function : function, optional
+            for derived metrics, vectorized version of function that calculates the
+            metric for many nodes at once: array_function(populations, *input_arrays, **params)
+            where each input is a (nodes x dates) float array with NaN for missing values.
+        per_capita : bool, optional
+            True if the metric can only be calculated for nodes with a population.
+        lookback : int or str, optional
+            number of earlier dates of the inputs each value depends on (1 for a
+            daily change), or the name of the window length parameter for moving
+            window metrics.  Used to update only the tail of a metric when a day
+            is appended (moving window metrics are recalculated over every date,
+            see lookback).  The default is 0.
+
+        """
+        if (attribute is None) == (function is None):
+            raise ValueError(name + " must have either an attribute or a function")
+
+        self.name = name
+        self.label = label
+        self.attribute = attribute
+        self.inputs = tuple(inputs)
+        self.function = function
+        self.params = dict(params or {})
+        self.array_function = array_function
+        self.per_capita = per_capita
+        self.lookback = lookback
+
+    def is_base(self):
+        """
+        Returns
+        -------
+        bool
+            True if the metric is read directly from a node attribute.
+
+        """
+        return self.attribute is not None
+
+
+METRICS = {}
+
+
+def register_metric(metric):
+    """
+    Adds a metric to the registry
+
+    Parameters
+    ----------
+    metric : Metric
+        the metric to add, all of its inputs must already be registered.
+
+    Raises
+    ------
+    ValueError
+        Raised if the name is already registered or an input is unknown.
+
+    Returns
+    -------
+    metric : Metric
+        the registered metric.
+
+    """
+    if metric.name in METRICS:
+        raise ValueError(metric.name + " is already a registered metric")
+    for input_name in metric.inputs:
+        if input_name not in METRICS:
+            raise ValueError(metric.name + " depends on unknown metric " + input_name)
+
+    METRICS[metric.name] = metric
+    return metric
+
+
+def get_metric(name):
+    """
+    Parameters
+    ----------
+    name : str
+        name of a registered metric.
+
+    Raises
+    ------
+    KeyError
+        Raised if the metric is not registered.
+
+    Returns
+    -------
+    Metric
+        the registered metric.
+
+    """
+    try:
+        return METRICS[name]
+    except KeyError:
+        raise KeyError(str(name) + " is not a registered metric")
+
+
+def get_labels():
+    """
+    Returns
+    -------
+    dict
+        mapping of metric label to metric name for all registered metrics.
+
+    """
+    return {metric.label: metric.name for metric in METRICS.values()}
+
+
+def get_base_attributes():
+    """
+    Returns
+    -------
+    dict
+        mapping of base metric name to the Covid19_Tree_Node attribute holding
+        its data (ie "CONFIRMED_CASES": "confirmed_cases_time_series_data").
+
+    """
+    return {metric.name: metric.attribute for metric in METRICS.values() if metric.is_base()}
+
+
+def dependency_order(names):
+    """
+    Orders the requested metrics and everything they depend on so that each
+    metric comes after all of its inputs
+
+    Parameters
+    ----------
+    names : list of str
+        names of the requested metrics.
+
+    Returns
+    -------
+    order : list of str
+        every metric needed to evaluate the request, each listed once.
+
+    """
+    order = []
+    visited = set()
+
+    def visit(name):
+        if name not in visited:
+            visited.add(name)
+            for input_name in get_metric(name).inputs:
+                visit(input_name)
+            order.append(name)
+
+    for name in names:
+        visit(name)
+    return order
+
+
+def parameter_names(name):
+    """
+    Parameters
+    ----------
+    name : str
+        name of a registered metric.
+
+    Returns
+    -------
+    set
+        names of all parameters that change the result of the metric, including
+        the parameters of the metrics it is derived from (ie "window" for the log
+        of a moving average).
+
+    """
+    names = set()
+    for metric_name in dependency_order([name]):
+        names.update(get_metric(metric_name).params)
+    return names
+
+
+def select_parameters(name, params):
+    """
+    Parameters
+    ----------
+    name : str
+        name of a registered metric.
+    params : dict
+        parameter overrides for a request.
+
+    Returns
+    -------
+    dict
+        the overrides that apply to the metric or one of its inputs.
+
+    """
+    names = parameter_names(name)
+    return {key: value for key, value in params.items() if key in names}
+
+
+def lookback(name, **params):
+    """
+    Parameters
+    ----------
+    name : str
+        name of a registered metric.
+    **params :
+        overrides for the default parameters of the metric.
+
+    Returns
+    -------
+    int
+        number of earlier dates of its inputs that a value of the metric depends
+        on, the values for the last n dates can be recalculated from the last
+        n + lookback dates of the inputs.  None for moving window metrics, their
+        running sums start at the first date and round differently when they
+        are started later, so only recalculating every date gives the same
+        values as calculating the metric from scratch.
+
+    """
+    metric = get_metric(name)
+    if isinstance(metric.lookback, str):
+        return None
+    return metric.lookback
+
+
+def _metric_kwargs(metric, params):
+    kwargs = dict(metric.params)
+    kwargs.update({key: value for key, value in params.items() if key in metric.params})
+    return kwargs
+
+
+def calculate(node, name, resolve, **params):
+    """
+    Calculates a metric for a node from its inputs
+
+    Parameters
+    ----------
+    node : Covid19_Tree_Node
+        node to calculate the metric for.
+    name : str
+        name of the metric.
+    resolve : function
+        function(node, name, **params) that returns the series of an input metric.
+    **params :
+        overrides for the default parameters of the metric or of its inputs.
+
+    Returns
+    -------
+    list
+        the metric series or None if there is no valid data.
+
+    """
+    metric = get_metric(name)
+    if metric.is_base():
+        return getattr(node, metric.attribute)
+
+    inputs = [resolve(node, input_name, **params) for input_name in metric.inputs]
+    return metric.function(node, *inputs, **_metric_kwargs(metric, params))
+
+
+def calculate_array(name, resolve, populations, **params):
+    """
+    Calculates a derived metric for many nodes at once from the arrays of its inputs
+
+    Parameters
+    ----------
+    name : str
+        name of a derived metric.
+    resolve : function
+        function(name, **params) that returns (values, valid) for an input metric
+        where values is a (nodes x dates) float array with NaN for missing values
+        and valid is a boolean array that is False for nodes with no data at all.
+    populations : numpy array
+        population of each node, NaN if unknown.
+    **params :
+        overrides for the default parameters of the metric or of its inputs.
+
+    Returns
+    -------
+    values : numpy array
+        (nodes x dates) array of the metric, NaN where the per node series is None.
+    valid : numpy array
+        False for the nodes whose per node series would be None.
+
+    """
+    metric = get_metric(name)
+    if metric.array_function is None:
+        raise ValueError(name + " has no vectorized implementation")
+
+    inputs = [resolve(input_name, **params) for input_name in metric.inputs]
+    valid = np.ones(len(populations), dtype=bool)
+    for _, input_valid in inputs:
+        valid = valid & input_valid
+    if metric.per_capita:
+        valid = valid & ~np.isnan(populations)
+
+    values = metric.array_function(populations, *[input_values for input_values, _ in inputs], **_metric_kwargs(metric, params))
+    if values is None:
+        # the calculation is not possible for this date range (ie window longer than the data set)
+        values = np.full((len(populations), inputs[0][0].shape[1]), np.nan)
+        valid = np.zeros(len(populations), dtype=bool)
+    values[~valid] = np.nan
+    return values, valid
+
+
+def evaluate(nodes, names):
+    """
+    Evaluates several metrics for several nodes.  The dependency graph of the
+    request is walked once in dependency order so intermediate results (ie daily
+    new cases for both the incident rate and the moving averages) are only
+    calculated once per node.
+
+    Parameters
+    ----------
+    nodes : list of Covid19_Tree_Node
+        the nodes to evaluate.
+    names : list of str
+        the requested metrics.
+
+    Returns
+    -------
+    results : dict
+        {name: [series for each node]} for the requested metrics.
+
+    """
+    order = dependency_order(names)
+    results = {name: [] for name in names}
+    for node in nodes:
+        for name in order:
+            series = node.get_metric(name)
+            if name in results:
+                results[name].append(series)
+    return results
+
+
+def log_moving_average(data_set, days, scale=1, log_base=None):
+    """
+    Description: calculates the log base n of the moving average of the specified data set as:
+        logn((data[i] + data[i-1] + ... + data[i-days-1])/days)
+    Inputs:
+        data_set - the set of points to calculate the log moving average on
+        days - number of days for moving average
+        scale - optional, factor to multiply each data point by (the log function only works for values above 1, so if a data set has many values below
+           1, it needs to be scaled for useful plots to be created)
+        log_base - optional, the base of the logarithm to use (if None then natural log is used)
+    Returns
+    -------
+    rate : list
+        list of log of moving average values if valid data (bottoms out at 0 to focus range on high incident rate nodes), None if no valid data
+    """
+    if data_set:
+        return log_scale(data_analysis.moving_average(data_set, days), scale, log_base)
+    else:
+        return None
+
+
+def log_scale(moving_average_data, scale=1, log_base=None):
+    """
+    Description: calculates the log base n of an already calculated moving average.  The first point is skipped because
+        it is not an average.
+    Inputs:
+        moving_average_data - list of moving average values
+        scale - optional, factor to multiply each data point by before taking the log
+        log_base - optional, the base of the logarithm to use (if None then natural log is used)
+    Returns
+    -------
+    rate : list
+        list of log values (bottoms out at 0), None if no valid data
+    """
+    if not moving_average_data:
+        return None
+
+    rate = []
+    for i in range(1, len(moving_average_data)):
+        value = moving_average_data[i] * scale
+        if value > 1:
+            if log_base:
+                log_value = math.log(value, log_base)
+            else:
+                log_value = math.log(value)
+        else:
+            log_value = 0
+        rate.append(log_value)
+
+    return rate
+
+
+def _daily_change(node, data):
+    """
+    Outputs: daily[] where each element is defined as: data[i] - data[i-1] and daily[0] = None
+    """
+    if data:
+        daily = []
+        daily.append(None)
+        for i in range(1, len(data)):
+            if data[i] != None and data[i-1] != None:
+                val = data[i] - data[i-1]
+            else:
+                val = None
+            daily.append(val)
+        return daily
+    else:
+        return None
+
+
+def _ratio(node, numerator, denominator):
+    """
+    Outputs: ratio[] where each element is defined as: numerator[i] / denominator[i]
+    """
+    if numerator and denominator:
+        ratio = []
+        for i in range(0, len(denominator)):
+            if numerator[i] != None and denominator[i] != None and denominator[i] != 0:
+                val = numerator[i] / denominator[i]
+            else:
+                val = None
+            ratio.append(val)
+        return ratio
+    else:
+        return None
+
+
+def _daily_ratio(node, cases, tested):
+    """
+    Outputs: ratio[] where each element is defined as: daily_confirmed[i] / daily_tested[i]
+    """
+    if cases and tested:
+        ratio = []
+        for i in range(0, len(cases)):
+            if cases[i] and tested[i] and tested[i] != 0:
+                ratio.append(cases[i]/tested[i])
+            else:
+                ratio.append(None)
+
+        return ratio
+    else:
+        return None
+
+
+def _case_fatality_rate(node, cases, deaths):
+    """
+    Outputs: fatality_rate[] where each element is deaths[i] / cases[i] (0 if there are no cases)
+    """
+    if cases and deaths:
+        fatality_rate = []
+        for case_count, death_count in zip(cases, deaths):
+            try:
+                fatality_rate.append(death_count/case_count)
+            except ZeroDivisionError:
+                fatality_rate.append(0)
+            except TypeError:
+                fatality_rate.append(None)
+
+        return fatality_rate
+    else:
+        return None
+
+
+def _moving_window_ratio(node, numerator, denominator, window):
+    """
+    Outputs: ratio of the sums of numerator and denominator over a moving window of window days
+    """
+    if numerator and denominator:
+        return data_analysis.moving_window_ratio(numerator, denominator, window)
+    else:
+        return None
+
+
+def _per_100k(node, data):
+    """
+    Outputs: rate[] where each element is defined as: data[i] / population * 100000
+    """
+    if data and node.population and node.population != 0:
+        rate = []
+        for i in range(0, len(data)):
+            if data[i]:
+                value = data[i] / node.population * 100000
+                rate.append(value)
+            else:
+                rate.append(None)
+        return rate
+    else:
+        return None
+
+
+def _moving_average(node, data, window):
+    """
+    Outputs: backward moving average over window points, None if no valid data
+    """
+    if data:
+        return data_analysis.moving_average(data, window)
+    else:
+        return None
+
+
+def _log_scale(node, moving_average_data, scale=1, log_base=None):
+    """
+    Outputs: log of the scaled moving average values, None if no valid data
+    """
+    return log_scale(moving_average_data, scale, log_base)
+
+
+def _daily_change_array(populations, data):
+    values = np.full(data.shape, np.nan)
+    values[:, 1:] = data[:, 1:] - data[:, :-1]
+    return values
+
+
+def _ratio_array(populations, numerator, denominator):
+    values = np.full(numerator.shape, np.nan)
+    np.divide(numerator, denominator, out=values, where=(denominator != 0))
+    return values
+
+
+def _daily_ratio_array(populations, cases, tested):
+    values = np.full(cases.shape, np.nan)
+    np.divide(cases, tested, out=values, where=(cases != 0) & (tested != 0))
+    return values
+
+
+def _case_fatality_rate_array(populations, cases, deaths):
+    values = np.zeros(cases.shape)
+    np.divide(deaths, cases, out=values, where=(cases != 0))
+    values[np.isnan(cases) | np.isnan(deaths)] = np.nan
+    return values
+
+
+def _moving_window_ratio_array(populations, numerator, denominator, window):
+    return data_analysis.moving_window_ratio(numerator, denominator, window)
+
+
+def _per_100k_array(populations, data):
+    values = np.full(data.shape, np.nan)
+    np.divide(data, populations[:, np.newaxis], out=values, where=(data != 0))
+    return values * 100000
+
+
+def _moving_average_array(populations, data, window):
+    return data_analysis.moving_average(data, window)
+
+
+def _log_scale_array(populations, moving_average_data, scale=1, log_base=None):
+    scaled = moving_average_data * scale
+    values = np.zeros(scaled.shape)
+    np.log(scaled, out=values, where=(scaled > 1))
+    if log_base:
+        values = values / math.log(log_base)
+    # the per node series skips the first point, keep the columns aligned with the dates instead
+    values[:, 0] = np.nan
+    return values
+
+
+# base metrics read directly from the node data arrays
+register_metric(Metric("CONFIRMED_CASES", "Confirmed Cases", attribute="confirmed_cases_time_series_data"))
+register_metric(Metric("DEATHS", "Deaths", attribute="deaths_time_series_data"))
+register_metric(Metric("PEOPLE_TESTED", "Testing", attribute="people_tested_time_series_data"))
+register_metric(Metric("INCIDENT_RATE", "Confirmed Cases Incident", attribute="incident_rate_time_series_data"))
+register_metric(Metric("ACTIVE_CASES", "Active Cases", attribute="active_cases_time_series_data"))
+register_metric(Metric("RECOVERED_CASES", "Recovered Cases", attribute="recovered_cases_time_series_data"))
+
+# derived metrics
+register_metric(Metric("DAILY_NEW_CASES", "Daily New Confirmed Cases", inputs=["CONFIRMED_CASES"], function=_daily_change, array_function=_daily_change_array, lookback=1))
+register_metric(Metric("DAILY_NEW_DEATHS", "Daily New Deaths", inputs=["DEATHS"], function=_daily_change, array_function=_daily_change_array, lookback=1))
+register_metric(Metric("DAILY_NEW_PEOPLE_TESTED", "Daily New People Tested", inputs=["PEOPLE_TESTED"], function=_daily_change, array_function=_daily_change_array, lookback=1))
+register_metric(Metric("RECOVERY_RATE", "Recovery Rate", inputs=["RECOVERED_CASES", "CONFIRMED_CASES"], function=_ratio, array_function=_ratio_array))
+register_metric(Metric(
+    "RATIO_CONFIRMED_CASES_TO_PEOPLE_TESTED",
+    "Confirmed Cases to People Tested Ratio",
+    inputs=["CONFIRMED_CASES", "PEOPLE_TESTED"],
+    function=_ratio,
+    array_function=_ratio_array
+    ))
+register_metric(Metric(
+    "DAILY_RATIO_CONFIRMED_CASES_TO_PEOPLE_TESTED",
+    "New Confirmed Cases to People Tested Ratio",
+    inputs=["DAILY_NEW_CASES", "DAILY_NEW_PEOPLE_TESTED"],
+    function=_daily_ratio,
+    array_function=_daily_ratio_array
+    ))
+register_metric(Metric("CASE_FATALITY_RATE", "Case Fatality Rate", inputs=["CONFIRMED_CASES", "DEATHS"], function=_case_fatality_rate, array_function=_case_fatality_rate_array))
+register_metric(Metric(
+    "MOVING_WINDOW_CASE_FATALITY_RATE",
+    "30 Day Moving Window Case Fatality Rate",
+    inputs=["DEATHS", "CONFIRMED_CASES"],
+    function=_moving_window_ratio,
+    params={"window": 30},
+    array_function=_moving_window_ratio_array,
+    lookback="window"
+    ))
+register_metric(Metric("CALCULATED_CASES_INCIDENT_RATE", "Confirmed Cases Incident - Calculated", inputs=["CONFIRMED_CASES"], function=_per_100k, array_function=_per_100k_array, per_capita=True))
+register_metric(Metric("CALCULATED_DEATHS_INCIDENT_RATE", "Deaths Incident", inputs=["DEATHS"], function=_per_100k, array_function=_per_100k_array, per_capita=True))
+register_metric(Metric("CALCULATED_PEOPLE_TESTED_INCIDENT_RATE", "Testing Incident", inputs=["PEOPLE_TESTED"], function=_per_100k, array_function=_per_100k_array, per_capita=True))
+register_metric(Metric("DAILY_NEW_CASES_INCIDENT_RATE", "Daily New Confirmed Cases Incident", inputs=["DAILY_NEW_CASES"], function=_per_100k, array_function=_per_100k_array, per_capita=True))
+register_metric(Metric("DAILY_NEW_DEATHS_INCIDENT_RATE", "Daily New Deaths Incident", inputs=["DAILY_NEW_DEATHS"], function=_per_100k, array_function=_per_100k_array, per_capita=True))
+register_metric(Metric(
+    "7DAY_MOVING_AVERAGE_DAILY_NEW_CASES_INCIDENT_RATE",
+    "mvg_avg(Daily New Confirmed Cases Incident)",
+    inputs=["DAILY_NEW_CASES_INCIDENT_RATE"],
+    function=_moving_average,
+    params={"window": 7},
+    array_function=_moving_average_array,
+    lookback="window"
+    ))
+register_metric(Metric(
+    "7DAY_MOVING_AVERAGE_DAILY_NEW_DEATHS_INCIDENT_RATE",
+    "mvg_avg(Daily New Deaths Incident)",
+    inputs=["DAILY_NEW_DEATHS_INCIDENT_RATE"],
+    function=_moving_average,
+    params={"window": 7},
+    array_function=_moving_average_array,
+    lookback="window"
+    ))
+register_metric(Metric(
+    "LOG10_7DAY_MOVING_AVERAGE_DAILY_NEW_CASES_INCIDENT_RATE",
+    "Log10(mvg_avg(Daily New Confirmed Cases Incident))",
+    inputs=["7DAY_MOVING_AVERAGE_DAILY_NEW_CASES_INCIDENT_RATE"],
+    function=_log_scale,
+    params={"log_base": 10},
+    array_function=_log_scale_array
+    ))
+register_metric(Metric(
+    "LOG2_7DAY_MOVING_AVERAGE_DAILY_NEW_CASES_INCIDENT_RATE",
+    "Log2(mvg_avg(Daily New Confirmed Cases Incident))",
+    inputs=["7DAY_MOVING_AVERAGE_DAILY_NEW_CASES_INCIDENT_RATE"],
+    function=_log_scale,
+    params={"log_base": 2},
+    array_function=_log_scale_array
+    ))
+register_metric(Metric(
+    "LOG2_7DAY_MOVING_AVERAGE_DAILY_NEW_DEATHS_INCIDENT_RATE",
+    "Log2(mvg_avg(100*Daily New Deaths Incident))",
+    inputs=["7DAY_MOVING_AVERAGE_DAILY_NEW_DEATHS_INCIDENT_RATE"],
+    function=_log_scale,
+    params={"scale": 100, "log_base": 2},
+    array_function=_log_scale_array
+    ))
@@ -0,0 +1,473 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Compact storage for the time series data arrays of a Covid19_Tree_Node.
+
+A Python list of ints uses 8 bytes per slot plus 28+ bytes per int object.
+Compact_Series keeps the values in a numpy array instead (int32 for counts,
+float32 for rates) and marks missing values with a sentinel, while still
+behaving like the list it replaces: indexing returns an int / float or None,
+len(), iteration and truth testing work the same way.  Sparse_Series does the
+same for series that are mostly missing by only storing the reported values.
+"""
+import sys
+import numpy as np
+
+
+# sentinel stored in integer arrays for missing (None) values
+def missing_value(dtype):
+    """
+    Parameters
+    ----------
+    dtype : numpy dtype
+        data type of a series array.
+
+    Returns
+    -------
+    int or float
+        value used to mark missing data in arrays of that type (the smallest
+        integer for integer types, NaN for floating point types).
+
+    """
+    dtype = np.dtype(dtype)
+    if dtype.kind == "f":
+        return np.nan
+    return np.iinfo(dtype).min
+
+
+def is_integral(values):
+    """
+    Parameters
+    ----------
+    values : numpy array
+        float values of a metric, NaN for missing values.
+
+    Returns
+    -------
+    bool
+        True if every value is a whole number or NaN, so the metric can be
+        written as integers (ie by the exporters).
+
+    """
+    return bool(np.all(np.isnan(values) | (np.isfinite(values) & (values == np.floor(values)))))
+
+
+class Compact_Series:
+    """
+    list-like time series backed by a numpy array with a sentinel for missing values
+    """
+    def __init__(self, values=(), dtype=np.int32):
+        """
+        Parameters
+        ----------
+        values : list, optional
+            initial values, None for missing data.  The default is empty.
+        dtype : numpy dtype, optional
+            storage type.  Integer series are promoted to int64 when a value does
+            not fit and to float64 when a float is stored.  The default is int32.
+
+        """
+        self.frozen = False
+        # the values are stored in the first length elements of buffer, the rest is spare capacity for append
+        values = list(values)
+        self.buffer = np.full(len(values), missing_value(dtype), dtype=dtype)
+        self.length = len(values)
+        present = [i for i, value in enumerate(values) if value is not None]
+        if present:
+            data = np.array([values[i] for i in present])
+            if data.dtype.kind not in "iuf":
+                # ints too large for int64 etc, let __setitem__ deal with them one at a time
+                for i in present:
+                    self[i] = values[i]
+                return
+            self.__promote(data.dtype.type(data.max()))
+            self.__promote(data.dtype.type(data.min()))
+            self.buffer[present] = data
+
+    @classmethod
+    def missing(cls, length, dtype=np.int32):
+        """
+        Parameters
+        ----------
+        length : int
+            number of values.
+        dtype : numpy dtype, optional
+            storage type.  The default is int32.
+
+        Returns
+        -------
+        Compact_Series
+            series of length values that are all missing.
+
+        """
+        series = cls(dtype=dtype)
+        series.buffer = np.full(length, missing_value(dtype), dtype=dtype)
+        series.length = length
+        return series
+
+    @classmethod
+    def from_array(cls, values):
+        """
+        Wraps an existing array without copying it (ie a row of a memory mapped
+        snapshot, see covid19_snapshot)
+
+        Parameters
+        ----------
+        values : numpy array
+            the values, with the sentinel of missing_value for missing data.
+
+        Returns
+        -------
+        Compact_Series
+            series backed by values, frozen if values is read-only.
+
+        """
+        # skip __init__, this is called for every node series when a snapshot is loaded
+        series = cls.__new__(cls)
+        series.buffer = values
+        series.length = len(values)
+        series.frozen = not values.flags.writeable
+        return series
+
+    @property
+    def values(self):
+        """
+        Returns
+        -------
+        numpy array
+            view of the stored values (missing values hold the sentinel).
+
+        """
+        return self.buffer[:self.length]
+
+    def append(self, value):
+        """
+        Adds a value at the end of the series.  The capacity of the buffer is
+        doubled when it is full so appending is amortized O(1).
+
+        Parameters
+        ----------
+        value : int, float or None
+            the value to add.
+
+        Returns
+        -------
+        None.
+
+        """
+        if self.frozen:
+            raise TypeError("Compact_Series is frozen")
+        if self.length == len(self.buffer):
+            buffer = np.full(max(2 * len(self.buffer), 1), missing_value(self.buffer.dtype), dtype=self.buffer.dtype)
+            buffer[:self.length] = self.values
+            self.buffer = buffer
+        self.length = self.length + 1
+        self[self.length - 1] = value
+
+    def is_missing(self):
+        """
+        Returns
+        -------
+        numpy array
+            boolean mask that is True for the missing values.
+
+        """
+        if self.values.dtype.kind == "f":
+            return np.isnan(self.values)
+        return self.values == missing_value(self.values.dtype)
+
+    def to_array(self):
+        """
+        Returns
+        -------
+        numpy array
+            float64 copy of the values with NaN for missing values.
+
+        """
+        array = self.values.astype(np.float64)
+        array[self.is_missing()] = np.nan
+        return array
+
+    def tolist(self):
+        """
+        Returns
+        -------
+        list
+            the values as python ints / floats with None for missing values.
+
+        """
+        missing = self.is_missing()
+        return [None if is_missing else value for value, is_missing in zip(self.values.tolist(), missing.tolist())]
+
+    @property
+    def nbytes(self):
+        """
+        Returns
+        -------
+        int
+            number of bytes used by the series (including spare capacity).
+
+        """
+        return sys.getsizeof(self) + self.buffer.nbytes
+
+    def freeze(self):
+        """
+        Makes the series read-only
+
+        Returns
+        -------
+        None.
+
+        """
+        if self.buffer.flags.writeable or len(self.buffer) != self.length:
+            self.buffer = self.values.copy()
+            self.buffer.flags.writeable = False
+        self.frozen = True
+
+    def thaw(self):
+        """
+        Makes the series writable again (only for private copies of frozen data)
+
+        Returns
+        -------
+        None.
+
+        """
+        if not self.buffer.flags.writeable:
+            self.buffer = self.buffer.copy()
+        self.frozen = False
+
+    def __promote(self, value):
+        """
+        Changes the storage type if value can't be stored in the current one
+        """
+        dtype = self.values.dtype
+        if dtype.kind == "f":
+            return
+        if isinstance(value, (float, np.floating)):
+            new_dtype = np.dtype(np.float64)
+        else:
+            info = np.iinfo(dtype)
+            if info.min < value <= info.max:
+                return
+            new_dtype = np.dtype(np.int64)
+            if dtype == new_dtype:
+                raise OverflowError(str(value) + " does not fit in a Compact_Series")
+
+        values = self.values
+        missing = self.is_missing()
+        self.buffer = np.full(len(self.buffer), missing_value(new_dtype), dtype=new_dtype)
+        self.buffer[:self.length][~missing] = values[~missing]
+
+    def __len__(self):
+        return self.length
+
+    def __bool__(self):
+        return self.length > 0
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return Compact_Series.from_array(self.values[index]).tolist()
+        value = self.values[index]
+        if self.values.dtype.kind == "f":
+            if np.isnan(value):
+                return None
+            return float(value)
+        if value == missing_value(self.values.dtype):
+            return None
+        return int(value)
+
+    def __setitem__(self, index, value):
+        if self.frozen:
+            raise TypeError("Compact_Series is frozen")
+        if value is None:
+            self.values[index] = missing_value(self.values.dtype)
+        else:
+            self.__promote(value)
+            self.values[index] = value
+
+    def __iter__(self):
+        return iter(self.tolist())
+
+    def __eq__(self, other):
+        try:
+            return list(self) == list(other)
+        except TypeError:
+            return NotImplemented
+
+    def __repr__(self):
+        return "Compact_Series(" + repr(self.tolist()) + ")"
+
+
+class Sparse_Series:
+    """
+    list-like time series that only stores the values that aren't missing, for
+    data that is reported for few dates / locations (ie people tested at county level)
+    """
+    def __init__(self, length=0):
+        """
+        Parameters
+        ----------
+        length : int, optional
+            number of values, all missing.  The default is 0.
+
+        """
+        self.frozen = False
+        self.length = length
+        self.data = {}
+
+    def count(self):
+        """
+        Returns
+        -------
+        int
+            number of values that aren't missing.
+
+        """
+        return len(self.data)
+
+    def append(self, value):
+        """
+        Adds a value at the end of the series
+
+        Parameters
+        ----------
+        value : int, float or None
+            the value to add.
+
+        Returns
+        -------
+        None.
+
+        """
+        if self.frozen:
+            raise TypeError("Sparse_Series is frozen")
+        self.length = self.length + 1
+        self[self.length - 1] = value
+
+    def to_array(self):
+        """
+        Returns
+        -------
+        numpy array
+            float64 array of the values with NaN for missing values.
+
+        """
+        array = np.full(self.length, np.nan)
+        if self.data:
+            array[list(self.data.keys())] = list(self.data.values())
+        return array
+
+    def tolist(self):
+        """
+        Returns
+        -------
+        list
+            the values with None for missing values.
+
+        """
+        values = [None] * self.length
+        for index, value in self.data.items():
+            values[index] = value
+        return values
+
+    @property
+    def nbytes(self):
+        """
+        Returns
+        -------
+        int
+            approximate number of bytes used by the series.
+
+        """
+        return sys.getsizeof(self) + sys.getsizeof(self.data) + sum(sys.getsizeof(value) for value in self.data.values())
+
+    def freeze(self):
+        """
+        Makes the series read-only
+
+        Returns
+        -------
+        None.
+
+        """
+        self.frozen = True
+
+    def thaw(self):
+        """
+        Makes the series writable again (only for private copies of frozen data)
+
+        Returns
+        -------
+        None.
+
+        """
+        self.frozen = False
+
+    def __index(self, index):
+        if index < 0:
+            index = index + self.length
+        if index < 0 or index >= self.length:
+            raise IndexError("Sparse_Series index out of range")
+        return index
+
+    def __len__(self):
+        return self.length
+
+    def __bool__(self):
+        # same as a list of None: a series that was allocated is true even if every value is missing
+        return self.length > 0
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.data.get(i) for i in range(*index.indices(self.length))]
+        return self.data.get(self.__index(index))
+
+    def __setitem__(self, index, value):
+        if self.frozen:
+            raise TypeError("Sparse_Series is frozen")
+        index = self.__index(index)
+        if value is None:
+            self.data.pop(index, None)
+        else:
+            self.data[index] = value
+
+    def __iter__(self):
+        return iter(self.tolist())
+
+    def __eq__(self, other):
+        try:
+            return list(self) == list(other)
+        except TypeError:
+            return NotImplemented
+
+    def __repr__(self):
+        return "Sparse_Series(" + repr(self.tolist()) + ")"
+
+
+def series_nbytes(series, seen=None):
+    """
+    Parameters
+    ----------
+    series : list, tuple, Compact_Series or Sparse_Series
+        a node time series.
+    seen : set, optional
+        ids of the value objects that were already counted (small ints and values
+        shared between lists are only counted once).  The default is None.
+
+    Returns
+    -------
+    int
+        approximate number of bytes used by the series and the values it holds.
+
+    """
+    if isinstance(series, (Compact_Series, Sparse_Series)):
+        return series.nbytes
+    if seen is None:
+        seen = set()
+    nbytes = sys.getsizeof(series)
+    for value in series:
+        if value is not None and id(value) not in seen:
+            seen.add(id(value))
+            nbytes = nbytes + sys.getsizeof(value)
+    return nbytes
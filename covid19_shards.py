@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Static files of a Covid19_Data set for serving without python.
+
+build_shards writes one shard per node with its attributes and the values of
+the selected metrics, as compact json or as a binary float64 matrix.  Every
+node that has children also gets an index file listing the shards (and index
+files) of its children.  Shards and index files are named after the hash of
+their content, so they never change and can be cached forever, and a rebuild
+only writes the files whose content changed.  The only file with a fixed name
+is index.json, which holds the dates, the metrics and the index file of World.
+
+The shards are built by a pool of worker processes:
+
+    python covid19_shards.py snapshot public DAILY_NEW_CASES CASE_FATALITY_RATE
+"""
+import hashlib
+import json
+import multiprocessing as mp
+import os
+
+import numpy as np
+
+import covid19_metrics
+import covid19_series
+
+
+ROOT_INDEX = "index.json"
+
+FORMATS = ("json", "binary")
+
+# number of nodes written per worker task
+CHUNK_NODES = 256
+
+# number of hex digits of the content hash in the file names
+HASH_DIGITS = 16
+
+# settings of a build_shards worker process: (data, metrics, integral, folder, file_format)
+_shard_build = None
+
+
+def _write_content(folder, content, extension):
+    """
+    Outputs: name of the content addressed file holding content (bytes), the file is only written if it doesn't exist yet
+    """
+    filename = hashlib.sha256(content).hexdigest()[:HASH_DIGITS] + extension
+    path = os.path.join(folder, filename)
+    if not os.path.exists(path):
+        temporary = path + ".tmp" + str(os.getpid())
+        with open(temporary, "wb") as content_file:
+            content_file.write(content)
+        os.replace(temporary, path)
+    return filename
+
+
+def _json_bytes(value):
+    """
+    Outputs: compact utf-8 json of a value
+    """
+    return json.dumps(value, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+
+def _json_values(values, integral):
+    """
+    Outputs: list of the values of a metric array row, None for NaN and ints if the metric only has whole numbers
+    """
+    missing = np.isnan(values)
+    if integral:
+        cells = np.where(missing, 0, values).astype(np.int64).astype(object)
+    else:
+        cells = values.astype(object)
+    cells[missing] = None
+    return cells.tolist()
+
+
+def _init_shard_worker(settings):
+    """
+    Outputs: sets the settings of a build_shards worker process
+    """
+    global _shard_build
+    _shard_build = settings
+
+
+def _write_shards(rows):
+    """
+    Outputs: list of the shard file names of a range of node rows, written by a build_shards worker process
+    """
+    data, metrics, integral, folder, file_format = _shard_build
+    nodes = data.get_nodes()
+    arrays = [data.get_metric_array(name)[0] for name in metrics]
+    filenames = []
+    for row in range(rows.start, rows.stop):
+        node = nodes[row]
+        if file_format == "json":
+            shard = {
+                "name": node.node_name,
+                "path": list(node.get_path()),
+                "population": node.population,
+                "iso3": node.iso3,
+                "fips": node.fips,
+                "series": {name: _json_values(values[row], is_integral) for name, values, is_integral in zip(metrics, arrays, integral)},
+                }
+            filenames.append(_write_content(folder, _json_bytes(shard), ".json"))
+        else:
+            # (metrics x dates) little endian float64, NaN for missing values
+            matrix = np.stack([values[row] for values in arrays]).astype("<f8")
+            filenames.append(_write_content(folder, matrix.tobytes(), ".bin"))
+    return filenames
+
+
+def build_shards(data, folder, metrics=None, file_format="json", processes=None):
+    """
+    Writes the static shard and index files of a data set
+
+    Parameters
+    ----------
+    data : Covid19_Data
+        the data set.
+    folder : str
+        output folder, created if it doesn't exist.  Files of earlier builds
+        are kept (clients may still hold an old index.json).
+    metrics : list of str, optional
+        names of registered metrics stored in every shard.  The default is
+        every base metric.
+    file_format : str, optional
+        "json" or "binary" shards.  Binary shards hold only the (metrics x
+        dates) float64 matrix, the node attributes are in the index files.
+        The default is "json".
+    processes : int, optional
+        number of worker processes.  The default is the number of CPUs.
+
+    Raises
+    ------
+    ValueError
+        Raised if the format is unknown.
+    KeyError
+        Raised if a metric isn't registered.
+
+    Returns
+    -------
+    str
+        name of the index file of World.
+
+    """
+    if file_format not in FORMATS:
+        raise ValueError("unknown shard format " + str(file_format))
+    if metrics is None:
+        metrics = list(covid19_metrics.get_base_attributes())
+    os.makedirs(folder, exist_ok=True)
+    # calculated before the workers are started, so they share the cached arrays instead of calculating them again
+    arrays = [data.get_metric_array(name)[0] for name in metrics]
+    integral = [covid19_series.is_integral(values) for values in arrays]
+    nodes = data.get_nodes()
+    settings = (data, list(metrics), integral, folder, file_format)
+
+    chunks = [range(start, min(start + CHUNK_NODES, len(nodes))) for start in range(0, len(nodes), CHUNK_NODES)]
+    if processes is None:
+        processes = os.cpu_count() or 1
+    if min(processes, len(chunks)) <= 1:
+        _init_shard_worker(settings)
+        shards = [filename for chunk in chunks for filename in _write_shards(chunk)]
+    else:
+        with mp.Pool(min(processes, len(chunks)), initializer=_init_shard_worker, initargs=(settings,)) as pool:
+            shards = [filename for filenames in pool.map(_write_shards, chunks) for filename in filenames]
+
+    # index files are named after their content, which includes the names of the index files of the children, so they
+    # are written bottom up (get_nodes lists parents before their children)
+    rows = {id(node): row for row, node in enumerate(nodes)}
+    index_files = {}
+    for row in range(len(nodes) - 1, -1, -1):
+        node = nodes[row]
+        children = node.get_children()
+        if not children:
+            continue
+        entries = []
+        for child in children:
+            child_row = rows[id(child)]
+            entry = {"name": child.node_name, "shard": shards[child_row]}
+            if file_format == "binary":
+                entry.update({"population": child.population, "iso3": child.iso3, "fips": child.fips})
+            if child_row in index_files:
+                entry["index"] = index_files[child_row]
+            entries.append(entry)
+        index = {"name": node.node_name, "path": list(node.get_path()), "shard": shards[row], "children": entries}
+        index_files[row] = _write_content(folder, _json_bytes(index), ".json")
+
+    root = {
+        "dates": [date.strftime("%Y-%m-%d") for date in data.time_series_dates],
+        "metrics": list(metrics),
+        "format": file_format,
+        "index": index_files.get(0),
+        "shard": shards[0],
+        }
+    temporary = os.path.join(folder, ROOT_INDEX + ".tmp")
+    with open(temporary, "wb") as root_file:
+        root_file.write(_json_bytes(root))
+    os.replace(temporary, os.path.join(folder, ROOT_INDEX))
+    return index_files.get(0)
+
+
+if __name__ == "__main__":
+    import sys
+
+    import covid19_snapshot
+
+    if len(sys.argv) < 3:
+        print("usage: covid19_shards.py snapshot_folder output_folder [metric ...]")
+        sys.exit(1)
+
+    snapshot_data = covid19_snapshot.load_snapshot(sys.argv[1])
+    if snapshot_data is None:
+        print("ERROR: no snapshot in", sys.argv[1])
+        sys.exit(1)
+    root_index = build_shards(snapshot_data, sys.argv[2], sys.argv[3:] or None)
+    print("wrote", len(snapshot_data.get_nodes()), "shards to", sys.argv[2], "- World index", root_index)
@@ -0,0 +1,623 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Binary snapshot of a parsed Covid19_Data set.
+
+Pickling the data set stores every value of every node series as a python
+object, so loading it rebuilds millions of ints.  A snapshot stores each node
+series attribute as one (nodes x dates) .npy matrix instead (only nodes that
+have the series get a row), plus an index.json table with the dates, the tree
+structure and the matrix row of each node series.  Loading maps the matrices
+with np.load(mmap_mode="r") and every node series becomes a read-only
+Compact_Series view of its row, so only the pages of the nodes that are
+actually used are ever read from disk.
+
+Every save writes its matrices to a new build subfolder and then replaces
+index.json, which names that subfolder, in a single step.  A reader always
+gets an index and matrices of the same build, even while a new snapshot is
+being saved.
+
+A snapshot can be saved with a manifest of the source files it was parsed
+from (their git shas), load_snapshot then only returns it while the sources
+are unchanged, so the cache invalidates itself when the data is updated.
+
+A snapshot can also hold a metric cube: the (nodes x dates) array of every
+registered metric, calculated in parallel by build_metric_cube when the
+snapshot is built.  Loading puts those arrays straight into the metric array
+cache of the data set, so views read precomputed values instead of
+calculating derived metrics on every request.
+
+publish_shared / attach_shared use the same layout in a block of shared
+memory instead of files, so several server processes can share one copy.
+"""
+import datetime
+import hashlib
+import json
+import multiprocessing as mp
+import os
+import shutil
+import tempfile
+import uuid
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+import covid19_data
+import covid19_metrics
+import covid19_series
+
+
+# incremented whenever the layout of the snapshot files or the way the data is parsed changes, older snapshots are ignored
+SNAPSHOT_VERSION = 4
+
+INDEX_FILE = "index.json"
+
+# prefix of the subfolders holding the matrices of each build of a snapshot
+BUILD_PREFIX = "build."
+
+# alignment of the matrices in a shared memory block
+SHARED_ALIGNMENT = 64
+
+# shared memory blocks this process is attached to by name, they must stay open while their data is used
+_attached_blocks = {}
+
+# blocks that were replaced by a newer block of the same name, closed once their data is no longer used
+_retired_blocks = []
+
+# names of the shared memory blocks created by this process with publish_shared
+_published_blocks = set()
+
+# prefix of the matrix names of the metric cube
+METRIC_PREFIX = "metric."
+
+# number of nodes a build_metric_cube worker process calculates per task
+CUBE_CHUNK_NODES = 512
+
+# settings of a build_metric_cube worker process: (base metric arrays, populations, metrics in dependency order, requested metrics)
+_cube_build = None
+
+
+def _matrix_dtype(values):
+    """
+    Outputs: smallest storage type that holds every value of a (nodes x dates) float array exactly (int32, int64 or float64)
+    """
+    present = values[~np.isnan(values)]
+    if present.size and not np.array_equal(present, np.round(present)):
+        return np.dtype(np.float64)
+    for dtype in (np.int32, np.int64):
+        info = np.iinfo(dtype)
+        if not present.size or (info.min < present.min() and present.max() <= info.max):
+            return np.dtype(dtype)
+    return np.dtype(np.float64)
+
+
+def source_manifest(github_tree, paths):
+    """
+    Describes the source files of a data set by content
+
+    Parameters
+    ----------
+    github_tree : GithubDirectoryTree
+        listing of the repository the files are read from.
+    paths : list of str
+        paths of the source files in the repository.
+
+    Returns
+    -------
+    dict
+        {"version": SNAPSHOT_VERSION, "sources": {path: git sha}, "hash": hash of
+        both} where the sha is None for files that aren't in the repository.
+
+    """
+    sources = {path: github_tree.get_sha(path) for path in sorted(paths)}
+    manifest = {"version": SNAPSHOT_VERSION, "sources": sources}
+    manifest["hash"] = hashlib.sha256(json.dumps(manifest, sort_keys=True).encode("utf-8")).hexdigest()
+    return manifest
+
+
+def clear_snapshot(folder):
+    """
+    Deletes a snapshot folder so the next load_snapshot returns None
+
+    Parameters
+    ----------
+    folder : str
+        the snapshot folder.
+
+    Returns
+    -------
+    None.
+
+    """
+    shutil.rmtree(folder, ignore_errors=True)
+
+
+def _init_cube_worker(settings):
+    """
+    Outputs: sets the settings of a build_metric_cube worker process
+    """
+    global _cube_build
+    _cube_build = settings
+
+
+def _cube_rows(rows):
+    """
+    Outputs: (rows, {name: (values, valid)}) of the requested metrics for a range of node rows, calculated by a
+    build_metric_cube worker process from the rows of the base metric arrays
+    """
+    base_arrays, populations, order, names = _cube_build
+    arrays = {name: (values[rows], valid[rows]) for name, (values, valid) in base_arrays.items()}
+    resolve = lambda input_name, **input_params: arrays[input_name]
+    for name in order:
+        if name not in arrays:
+            # every row is calculated on its own, so the values are the same as for the whole array
+            arrays[name] = covid19_metrics.calculate_array(name, resolve, populations[rows])
+    return rows, {name: arrays[name] for name in names}
+
+
+def build_metric_cube(data, names=None, processes=None):
+    """
+    Calculates the arrays of many metrics for every node and date
+
+    Parameters
+    ----------
+    data : Covid19_Data
+        the data set.
+    names : list of str, optional
+        names of registered metrics.  The default is every registered metric.
+    processes : int, optional
+        number of worker processes.  The default is the number of CPUs, 1
+        calculates the metrics in this process (and returns arrays that are
+        already cached by data, ie loaded from a snapshot, without copying).
+        The base metrics are read from the node series once, in this process,
+        and each worker calculates every derived metric (and its inputs) for
+        ranges of CUBE_CHUNK_NODES nodes.
+
+    Returns
+    -------
+    dict
+        {name: (values, valid)} as returned by data.get_metric_array with the
+        default parameters of each metric.
+
+    """
+    if names is None:
+        names = list(covid19_metrics.METRICS)
+    # every input is calculated before the metrics that use it
+    order = covid19_metrics.dependency_order(names)
+    names = [name for name in order if name in names]
+    node_count = len(data.get_nodes())
+    chunks = [slice(start, min(start + CUBE_CHUNK_NODES, node_count)) for start in range(0, node_count, CUBE_CHUNK_NODES)]
+    if processes is None:
+        processes = os.cpu_count() or 1
+    processes = min(processes, len(chunks))
+
+    if processes <= 1:
+        return {name: data.get_metric_array(name) for name in names}
+    base_arrays = {name: data.get_metric_array(name) for name in order if covid19_metrics.get_metric(name).is_base()}
+    cube = {name: base_arrays[name] for name in names if name in base_arrays}
+    derived = [name for name in names if name not in base_arrays]
+    for name in derived:
+        cube[name] = (np.empty((node_count, len(data.time_series_dates))), np.empty(node_count, dtype=bool))
+    settings = (base_arrays, data.get_populations(), order, derived)
+    with mp.Pool(processes, initializer=_init_cube_worker, initargs=(settings,)) as pool:
+        for rows, arrays in pool.imap_unordered(_cube_rows, chunks):
+            for name, (values, valid) in arrays.items():
+                cube[name][0][rows] = values
+                cube[name][1][rows] = valid
+    for values, _ in cube.values():
+        values.flags.writeable = False
+    return {name: cube[name] for name in names}
+
+
+def _build_snapshot(data, manifest, metrics=None, processes=None):
+    """
+    Outputs: (index, matrices) where index is the json table of the snapshot and matrices is {matrix name: matrix}, the
+    node series matrices are named after their attribute and the metric cube matrices METRIC_PREFIX + metric name
+    """
+    nodes = data.get_nodes()
+    rows = {id(node): row for row, node in enumerate(nodes)}
+
+    index = {
+        "version": SNAPSHOT_VERSION,
+        "dates": [date.isoformat() for date in data.time_series_dates],
+        "nodes": [],
+        "series": {},
+        "metrics": {},
+        "manifest_hash": manifest["hash"] if manifest else None,
+        }
+    for node in nodes:
+        entry = {"name": node.node_name, "parent": rows[id(node.parent)] if node.parent is not None else -1}
+        for attribute in covid19_data.TREE_FILE_ATTRIBUTES:
+            entry[attribute] = getattr(node, attribute)
+        index["nodes"].append(entry)
+
+    matrices = {}
+    for attribute in covid19_data.Covid19_Tree_Node.SERIES_ATTRIBUTES:
+        node_series = [(row, getattr(node, attribute)) for row, node in enumerate(nodes) if getattr(node, attribute)]
+        values = np.full((len(node_series), len(data.time_series_dates)), np.nan)
+        # [node row, series length] for each row of the matrix
+        series_rows = []
+        for matrix_row, (row, series) in enumerate(node_series):
+            if isinstance(series, (covid19_series.Compact_Series, covid19_series.Sparse_Series)):
+                series = series.to_array()
+            else:
+                series = np.array(series, dtype=float)
+            series = series[:values.shape[1]]
+            values[matrix_row, :len(series)] = series
+            series_rows.append([row, len(series)])
+
+        dtype = _matrix_dtype(values)
+        matrix = np.full(values.shape, covid19_series.missing_value(dtype), dtype=dtype)
+        present = ~np.isnan(values)
+        matrix[present] = values[present]
+        matrices[attribute] = matrix
+        index["series"][attribute] = series_rows
+
+    if metrics:
+        for name, (values, valid) in build_metric_cube(data, metrics, processes).items():
+            # metric arrays are stored as they are so loading them doesn't have to convert anything
+            matrices[METRIC_PREFIX + name] = np.asarray(values, dtype=np.float64)
+            index["metrics"][name] = np.flatnonzero(valid).tolist()
+    return index, matrices
+
+
+def _matrix_names(index):
+    """
+    Outputs: names of the matrices of a snapshot index
+    """
+    return list(index["series"]) + [METRIC_PREFIX + name for name in index["metrics"]]
+
+
+def _is_current(index, manifest):
+    """
+    Outputs: True if a snapshot index has the current SNAPSHOT_VERSION and was built from the sources of manifest
+    """
+    if index.get("version") != SNAPSHOT_VERSION:
+        return False
+    return not manifest or index.get("manifest_hash") == manifest["hash"]
+
+
+def _read_index(folder):
+    """
+    Outputs: the index of the snapshot in a folder, None if it can't be read
+    """
+    try:
+        with open(os.path.join(folder, INDEX_FILE), "r") as index_file:
+            return json.load(index_file)
+    except (OSError, ValueError):
+        return None
+
+
+def _load_data(index, matrices):
+    """
+    Outputs: Covid19_Data with the tree of a snapshot index, every node series is a Compact_Series view of its matrix row
+    """
+    data = covid19_data.Covid19_Data(compact_storage=True)
+    data.time_series_dates = [datetime.datetime.fromisoformat(date) for date in index["dates"]]
+
+    nodes = []
+    for entry in index["nodes"]:
+        if entry["parent"] < 0:
+            node = data.time_series_data_tree
+        else:
+            node = covid19_data.Covid19_Tree_Node(entry["name"])
+            nodes[entry["parent"]].add_child(node)
+        for attribute in covid19_data.TREE_FILE_ATTRIBUTES:
+            setattr(node, attribute, entry.get(attribute))
+        nodes.append(node)
+
+    for attribute, series_rows in index["series"].items():
+        matrix = matrices[attribute]
+        for matrix_row, (row, length) in enumerate(series_rows):
+            setattr(nodes[row], attribute, covid19_series.Compact_Series.from_array(matrix[matrix_row, :length]))
+
+    data.data_changed()
+    for name, valid_rows in index["metrics"].items():
+        # metrics that were removed since the snapshot was built are calculated from the series again
+        if name in covid19_metrics.METRICS:
+            valid = np.zeros(len(nodes), dtype=bool)
+            valid[valid_rows] = True
+            data.set_metric_array(name, matrices[METRIC_PREFIX + name], valid)
+    return data
+
+
+def save_snapshot(data, folder, manifest=None, metrics=None, processes=None):
+    """
+    Writes a data set to a snapshot folder
+
+    Parameters
+    ----------
+    data : Covid19_Data
+        the data set.
+    folder : str
+        folder to write the snapshot to, created if it doesn't exist.  An
+        existing snapshot in the folder is replaced.
+    manifest : dict, optional
+        source_manifest of the files the data set was parsed from.  The
+        default is None.
+    metrics : list of str, optional
+        names of registered metrics to store in the metric cube of the
+        snapshot, see build_metric_cube.  The default is None (no cube).
+    processes : int, optional
+        number of worker processes that calculate the metric cube, see
+        build_metric_cube.
+
+    Returns
+    -------
+    None.
+
+    """
+    os.makedirs(folder, exist_ok=True)
+    previous = _read_index(folder)
+    index, matrices = _build_snapshot(data, manifest, metrics, processes)
+    build_folder = tempfile.mkdtemp(prefix=BUILD_PREFIX, dir=folder)
+    # mkdtemp only gives access to the owner, readers may run as another user like the files of earlier versions
+    os.chmod(build_folder, 0o755)
+    for matrix_name, matrix in matrices.items():
+        np.save(os.path.join(build_folder, matrix_name + ".npy"), matrix)
+    index["build"] = os.path.basename(build_folder)
+
+    # replacing the index switches readers to the new build in one step
+    temporary = os.path.join(folder, INDEX_FILE + ".tmp")
+    with open(temporary, "w") as index_file:
+        json.dump(index, index_file)
+    os.replace(temporary, os.path.join(folder, INDEX_FILE))
+
+    # the previous build is kept for readers that read its index just before it was replaced, older ones are removed
+    keep = {index["build"], previous.get("build") if previous else None}
+    for entry in os.listdir(folder):
+        path = os.path.join(folder, entry)
+        if entry.startswith(BUILD_PREFIX) and entry not in keep:
+            shutil.rmtree(path, ignore_errors=True)
+        elif entry.endswith(".npy"):
+            # matrices of a snapshot version before build folders
+            os.remove(path)
+
+
+def load_snapshot(folder, manifest=None):
+    """
+    Loads a data set from a snapshot folder without reading the node series
+
+    Parameters
+    ----------
+    folder : str
+        folder the snapshot was written to with save_snapshot.
+    manifest : dict, optional
+        source_manifest of the current source files.  The default is None,
+        which doesn't check the sources.
+
+    Returns
+    -------
+    Covid19_Data
+        the data set with compact storage, every node series is a read-only
+        view of the memory mapped matrices and the arrays of the metric cube
+        are cached by get_metric_array.  None if the folder doesn't hold a
+        snapshot of the current SNAPSHOT_VERSION, or if it was parsed from
+        different source files than manifest.
+
+    """
+    index = _read_index(folder)
+    if index is None or not _is_current(index, manifest):
+        return None
+
+    matrices = {}
+    for matrix_name in _matrix_names(index):
+        try:
+            matrix = np.load(os.path.join(folder, index["build"], matrix_name + ".npy"), mmap_mode="r")
+        except (OSError, ValueError):
+            return None
+        # plain ndarray view of the mapped file, slicing a np.memmap is much slower
+        matrices[matrix_name] = matrix.view(np.ndarray)
+    return _load_data(index, matrices)
+
+
+def publish_shared(data, name, manifest=None, metrics=None, processes=None):
+    """
+    Copies a data set into a block of shared memory that other processes on
+    the same machine can attach to with attach_shared, so several server
+    processes share a single copy of the data
+
+    Parameters
+    ----------
+    data : Covid19_Data
+        the data set.
+    name : str
+        name of the shared memory block.
+    manifest : dict, optional
+        source_manifest of the files the data set was parsed from.  The
+        default is None.
+    metrics : list of str, optional
+        names of registered metrics to publish in the metric cube, see
+        save_snapshot.  The default is None (no cube).
+    processes : int, optional
+        number of worker processes that calculate the metric cube.
+
+    Raises
+    ------
+    FileExistsError
+        Raised if a block with the same name already exists.
+
+    Returns
+    -------
+    SharedMemory
+        the block.  It has to be kept open for as long as the data is
+        published, call close() and unlink() on it to remove it.
+
+    """
+    index, matrices = _build_snapshot(data, manifest, metrics, processes)
+    # tells attach_shared that a block of the same name was published again, even with the same data
+    index["publication"] = uuid.uuid4().hex
+    # the block starts with the length of the index and the json index, followed by the matrices at aligned offsets
+    offset = 0
+    index["matrices"] = {}
+    for matrix_name, matrix in matrices.items():
+        index["matrices"][matrix_name] = {"offset": offset, "dtype": matrix.dtype.str, "shape": list(matrix.shape)}
+        offset = offset + (matrix.nbytes + SHARED_ALIGNMENT - 1) // SHARED_ALIGNMENT * SHARED_ALIGNMENT
+    index_bytes = json.dumps(index).encode("utf-8")
+    header_size = (8 + len(index_bytes) + SHARED_ALIGNMENT - 1) // SHARED_ALIGNMENT * SHARED_ALIGNMENT
+
+    block = shared_memory.SharedMemory(name=name, create=True, size=max(header_size + offset, 1))
+    _published_blocks.add(block.name)
+    block.buf[:8] = len(index_bytes).to_bytes(8, "little")
+    block.buf[8:8 + len(index_bytes)] = index_bytes
+    for matrix_name, matrix in matrices.items():
+        layout = index["matrices"][matrix_name]
+        target = np.ndarray(matrix.shape, dtype=matrix.dtype, buffer=block.buf, offset=header_size + layout["offset"])
+        target[...] = matrix
+    return block
+
+
+class _Attached_Block(shared_memory.SharedMemory):
+    """
+    shared memory block attached to by attach_shared
+    """
+    def __del__(self):
+        try:
+            self.close()
+        except (OSError, BufferError):
+            # still used by a data set (ie when the process exits), the memory is unmapped once that is released
+            pass
+
+
+def _open_shared(name):
+    """
+    Outputs: _Attached_Block of that name that isn't removed when this process exits, None if there is no such block
+    """
+    try:
+        try:
+            return _Attached_Block(name=name, track=False)
+        except TypeError:
+            block = _Attached_Block(name=name)
+    except FileNotFoundError:
+        return None
+    # python < 3.13 always tracks the block and would remove it when this process exits.  A block created by this
+    # process stays registered, its registration is removed by unlink() in the publishing code.
+    if os.name == "posix" and block.name not in _published_blocks:
+        resource_tracker.unregister("/" + block.name, "shared_memory")
+    return block
+
+
+def _shared_index_bytes(block):
+    """
+    Outputs: json index at the start of a block written by publish_shared
+    """
+    index_size = int.from_bytes(bytes(block.buf[:8]), "little")
+    return bytes(block.buf[8:8 + index_size])
+
+
+def _retire_block(name):
+    """
+    Outputs: the block attached by name (if any) is no longer used for new data sets and closed as soon as possible
+    """
+    block = _attached_blocks.pop(name, None)
+    if block is not None:
+        _retired_blocks.append(block)
+        _close_retired_blocks()
+
+
+def _close_retired_blocks():
+    """
+    Outputs: closes the retired blocks that no data set uses anymore
+    """
+    for block in list(_retired_blocks):
+        try:
+            block.close()
+        except BufferError:
+            # the node series of a data set attached earlier are still views of the block
+            continue
+        _retired_blocks.remove(block)
+
+
+def attach_shared(name, manifest=None):
+    """
+    Attaches to a data set published with publish_shared without copying it
+
+    Parameters
+    ----------
+    name : str
+        name of the shared memory block.
+    manifest : dict, optional
+        source_manifest of the current source files.  The default is None,
+        which doesn't check the sources.
+
+    Returns
+    -------
+    Covid19_Data
+        the data set with compact storage, every node series is a read-only
+        view of the shared memory and the arrays of the metric cube are
+        cached by get_metric_array.  None if there is no block with that name
+        or if it holds a different version or different sources.
+
+    """
+    _close_retired_blocks()
+    # opened by name on every call, the loader may have replaced the block since this process attached to it
+    block = _open_shared(name)
+    if block is None:
+        _retire_block(name)
+        return None
+    index_bytes = _shared_index_bytes(block)
+    attached = _attached_blocks.get(name)
+    if attached is not None and _shared_index_bytes(attached) == index_bytes:
+        # still the same publication, keep using the block that is already mapped
+        block.close()
+        block = attached
+    else:
+        _retire_block(name)
+        _attached_blocks[name] = block
+
+    index = json.loads(index_bytes.decode("utf-8"))
+    if not _is_current(index, manifest):
+        _retire_block(name)
+        return None
+    header_size = (8 + len(index_bytes) + SHARED_ALIGNMENT - 1) // SHARED_ALIGNMENT * SHARED_ALIGNMENT
+
+    matrices = {}
+    for matrix_name, layout in index["matrices"].items():
+        # frombuffer keeps the buffer of the block exported while any view of the matrix exists, so the block can't be
+        # closed (see _close_retired_blocks) while a data set still uses it
+        matrix = np.frombuffer(block.buf, dtype=np.dtype(layout["dtype"]), count=int(np.prod(layout["shape"])), offset=header_size + layout["offset"])
+        matrix = matrix.reshape(layout["shape"])
+        matrix.flags.writeable = False
+        matrices[matrix_name] = matrix
+    return _load_data(index, matrices)
+
+
+if __name__ == "__main__":
+    # build: add the metric cube of every registered metric to a snapshot folder (offline, in parallel)
+    # loader process: publish a snapshot folder for the server processes and keep it published until interrupted
+    import signal
+    import sys
+    import time
+
+    if len(sys.argv) != 3:
+        print("usage: covid19_snapshot.py build snapshot_folder")
+        print("       covid19_snapshot.py snapshot_folder shared_memory_name")
+        sys.exit(1)
+
+    snapshot_folder = sys.argv[2] if sys.argv[1] == "build" else sys.argv[1]
+    snapshot_data = load_snapshot(snapshot_folder)
+    if snapshot_data is None:
+        print("ERROR: no snapshot in", snapshot_folder)
+        sys.exit(1)
+    snapshot_index = _read_index(snapshot_folder)
+    manifest_hash = snapshot_index.get("manifest_hash")
+    snapshot_manifest = {"hash": manifest_hash} if manifest_hash else None
+
+    if sys.argv[1] == "build":
+        save_snapshot(snapshot_data, snapshot_folder, snapshot_manifest, list(covid19_metrics.METRICS))
+        print("added", len(covid19_metrics.METRICS), "metrics to", snapshot_folder)
+        sys.exit(0)
+
+    # the metric arrays of the snapshot are already cached, so they are published without calculating anything
+    block = publish_shared(snapshot_data, sys.argv[2], snapshot_manifest, [name for name in snapshot_index["metrics"] if name in covid19_metrics.METRICS], processes=1)
+    print("published", sys.argv[1], "as", sys.argv[2], "-", block.size, "bytes")
+    # remove the block when the loader is stopped with SIGTERM as well
+    signal.signal(signal.SIGTERM, lambda signal_number, frame: sys.exit(0))
+    try:
+        while True:
+            time.sleep(60)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        block.close()
+        block.unlink()
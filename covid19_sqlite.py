@@ -0,0 +1,366 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+SQLite storage for a Covid19_Data set.
+
+save_database writes the tree to a single file with a nodes table (path,
+FIPS, ISO3, population, coordinates), a dates table and a series table with
+one row per (metric, node, date) value.  Covid19_Database answers queries
+(the children of a node, one metric for a few nodes over a date range, every
+node on one date) from the indexes, so tools that only need a slice of the
+data don't have to load the whole tree.  load_database rebuilds the full
+Covid19_Data set from the file.
+"""
+import datetime
+import json
+import os
+import sqlite3
+
+import numpy as np
+
+import covid19_data
+import covid19_metrics
+import covid19_series
+
+
+SCHEMA = """
+CREATE TABLE nodes (
+    id INTEGER PRIMARY KEY,
+    parent_id INTEGER,
+    name TEXT NOT NULL,
+    path TEXT NOT NULL UNIQUE,
+    population INTEGER,
+    latitude REAL,
+    longitude REAL,
+    iso3 TEXT,
+    fips TEXT
+);
+CREATE TABLE dates (
+    id INTEGER PRIMARY KEY,
+    date TEXT NOT NULL UNIQUE
+);
+CREATE TABLE series (
+    metric TEXT NOT NULL,
+    node_id INTEGER NOT NULL,
+    date_id INTEGER NOT NULL,
+    value NUMERIC NOT NULL,
+    PRIMARY KEY (metric, node_id, date_id)
+) WITHOUT ROWID;
+CREATE TABLE series_lengths (
+    metric TEXT NOT NULL,
+    node_id INTEGER NOT NULL,
+    length INTEGER NOT NULL,
+    PRIMARY KEY (metric, node_id)
+) WITHOUT ROWID;
+"""
+
+# created after the rows are inserted, building an index once is faster than updating it for every row
+INDEXES = """
+CREATE INDEX nodes_parent ON nodes (parent_id);
+CREATE INDEX nodes_fips ON nodes (fips);
+CREATE INDEX nodes_iso3 ON nodes (iso3);
+CREATE INDEX series_date ON series (metric, date_id);
+"""
+
+
+def _path_key(path):
+    """
+    Outputs: text stored in the path column for a tuple of node names (see Covid19_Tree_Node.get_path)
+    """
+    return json.dumps(list(path), ensure_ascii=False)
+
+
+def save_database(data, filename):
+    """
+    Writes a data set to a SQLite file
+
+    Parameters
+    ----------
+    data : Covid19_Data
+        the data set.
+    filename : str
+        path of the database file.  An existing file is replaced once the new
+        one is complete.
+
+    Returns
+    -------
+    None.
+
+    """
+    temporary = filename + ".tmp"
+    if os.path.exists(temporary):
+        os.remove(temporary)
+
+    connection = sqlite3.connect(temporary)
+    try:
+        # the file is only moved into place once it is complete, so a crash can't leave a half written database behind
+        connection.execute("PRAGMA journal_mode = OFF")
+        connection.execute("PRAGMA synchronous = OFF")
+        connection.executescript(SCHEMA)
+        nodes = data.get_nodes()
+        rows = {id(node): row for row, node in enumerate(nodes)}
+        connection.executemany(
+            "INSERT INTO nodes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            ((row, rows[id(node.parent)] if node.parent is not None else None, node.node_name, _path_key(node.get_path()),
+              node.population, node.latitude, node.longitude, node.iso3, node.fips) for row, node in enumerate(nodes))
+            )
+        connection.executemany("INSERT INTO dates VALUES (?, ?)", enumerate(date.isoformat() for date in data.time_series_dates))
+
+        for metric, attribute in covid19_metrics.get_base_attributes().items():
+            for row, node in enumerate(nodes):
+                series = getattr(node, attribute)
+                if not series:
+                    continue
+                if isinstance(series, (covid19_series.Compact_Series, covid19_series.Sparse_Series)):
+                    series = series.tolist()
+                connection.execute("INSERT INTO series_lengths VALUES (?, ?, ?)", (metric, row, len(series)))
+                connection.executemany(
+                    "INSERT INTO series VALUES (?, ?, ?, ?)",
+                    ((metric, row, column, value) for column, value in enumerate(series) if value is not None)
+                    )
+        connection.executescript(INDEXES)
+        connection.commit()
+    finally:
+        connection.close()
+    os.replace(temporary, filename)
+
+
+class Covid19_Database:
+    """
+    read-only queries on a database written by save_database
+    """
+    def __init__(self, filename):
+        """
+        Parameters
+        ----------
+        filename : str
+            path of the database file.
+
+        Raises
+        ------
+        sqlite3.OperationalError
+            Raised if the file can't be opened.
+
+        """
+        self.connection = sqlite3.connect("file:" + filename + "?mode=ro", uri=True)
+        self.dates = [datetime.datetime.fromisoformat(date) for (date,) in self.connection.execute("SELECT date FROM dates ORDER BY id")]
+
+    def close(self):
+        """
+        Closes the database file
+
+        Returns
+        -------
+        None.
+
+        """
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __node(self, row):
+        node_id, name, path, population, latitude, longitude, iso3, fips = row
+        return {
+            "id": node_id,
+            "name": name,
+            "path": tuple(json.loads(path)),
+            "population": population,
+            "latitude": latitude,
+            "longitude": longitude,
+            "iso3": iso3,
+            "fips": fips,
+            }
+
+    def get_node(self, path):
+        """
+        Parameters
+        ----------
+        path : tuple of str
+            path of the node, () for World.
+
+        Returns
+        -------
+        dict
+            the node's id, name, path, population, latitude, longitude, iso3 and
+            fips, None if there is no node with that path.
+
+        """
+        row = self.connection.execute(
+            "SELECT id, name, path, population, latitude, longitude, iso3, fips FROM nodes WHERE path = ?", (_path_key(path),)
+            ).fetchone()
+        if row is None:
+            return None
+        return self.__node(row)
+
+    def get_children(self, path):
+        """
+        Parameters
+        ----------
+        path : tuple of str
+            path of the node, () for World.
+
+        Raises
+        ------
+        KeyError
+            Raised if there is no node with that path.
+
+        Returns
+        -------
+        list of dict
+            the children of the node in the order of the tree, see get_node.
+
+        """
+        parent = self.get_node(path)
+        if parent is None:
+            raise KeyError("no node " + str(path))
+        cursor = self.connection.execute(
+            "SELECT id, name, path, population, latitude, longitude, iso3, fips FROM nodes WHERE parent_id = ? ORDER BY id", (parent["id"],)
+            )
+        return [self.__node(row) for row in cursor]
+
+    def __date_range(self, start_date, end_date):
+        start = 0
+        stop = len(self.dates)
+        if start_date is not None:
+            start = next((column for column, date in enumerate(self.dates) if date >= start_date), len(self.dates))
+        if end_date is not None:
+            stop = next((column for column, date in enumerate(self.dates) if date > end_date), len(self.dates))
+        return start, max(start, stop)
+
+    def query(self, metric, paths, start_date=None, end_date=None):
+        """
+        Reads one base metric for a few nodes over a date range
+
+        Parameters
+        ----------
+        metric : str
+            name of a base metric (ie "CONFIRMED_CASES").
+        paths : list of tuple of str
+            paths of the nodes.
+        start_date : datetime, optional
+            first date of the range.  The default is the first date.
+        end_date : datetime, optional
+            last date of the range (inclusive).  The default is the last date.
+
+        Raises
+        ------
+        KeyError
+            Raised if the metric isn't a base metric or a node doesn't exist.
+
+        Returns
+        -------
+        dates : list of datetime
+            the dates of the columns.
+        values : numpy array
+            (nodes x dates) float array in the order of paths, NaN for missing
+            values and for nodes that have no data for the metric.
+
+        """
+        if metric not in covid19_metrics.get_base_attributes():
+            raise KeyError(str(metric) + " is not a base metric")
+        node_ids = []
+        for path in paths:
+            node = self.get_node(path)
+            if node is None:
+                raise KeyError("no node " + str(path))
+            node_ids.append(node["id"])
+        start, stop = self.__date_range(start_date, end_date)
+
+        values = np.full((len(node_ids), stop - start), np.nan)
+        for row, node_id in enumerate(node_ids):
+            cursor = self.connection.execute(
+                "SELECT date_id, value FROM series WHERE metric = ? AND node_id = ? AND date_id >= ? AND date_id < ?",
+                (metric, node_id, start, stop)
+                )
+            cells = np.array(cursor.fetchall(), dtype=float).reshape(-1, 2)
+            values[row, cells[:, 0].astype(np.intp) - start] = cells[:, 1]
+        return self.dates[start:stop], values
+
+    def query_date(self, metric, date, parent_path=None):
+        """
+        Reads one base metric for every node (or every child of a node) on one date
+
+        Parameters
+        ----------
+        metric : str
+            name of a base metric.
+        date : datetime
+            the date.
+        parent_path : tuple of str, optional
+            only read the children of this node.  The default is every node.
+
+        Raises
+        ------
+        KeyError
+            Raised if the metric isn't a base metric, the date isn't in the
+            database or the parent node doesn't exist.
+
+        Returns
+        -------
+        paths : list of tuple of str
+            paths of the nodes that have a value on the date.
+        values : numpy array
+            the value of each of those nodes.
+
+        """
+        if metric not in covid19_metrics.get_base_attributes():
+            raise KeyError(str(metric) + " is not a base metric")
+        if date not in self.dates:
+            raise KeyError("no data for " + str(date))
+        query = "SELECT nodes.path, series.value FROM series JOIN nodes ON nodes.id = series.node_id WHERE series.metric = ? AND series.date_id = ?"
+        parameters = [metric, self.dates.index(date)]
+        if parent_path is not None:
+            parent = self.get_node(parent_path)
+            if parent is None:
+                raise KeyError("no node " + str(parent_path))
+            query = query + " AND nodes.parent_id = ?"
+            parameters.append(parent["id"])
+        rows = self.connection.execute(query + " ORDER BY nodes.id", parameters).fetchall()
+        return [tuple(json.loads(path)) for path, _ in rows], np.array([value for _, value in rows], dtype=float)
+
+
+def load_database(filename):
+    """
+    Reads a complete data set from a database written by save_database
+
+    Parameters
+    ----------
+    filename : str
+        path of the database file.
+
+    Returns
+    -------
+    Covid19_Data
+        the data set, node series are lists.
+
+    """
+    data = covid19_data.Covid19_Data()
+    with Covid19_Database(filename) as database:
+        data.time_series_dates = list(database.dates)
+        nodes = {}
+        cursor = database.connection.execute("SELECT id, parent_id, name, population, latitude, longitude, iso3, fips FROM nodes ORDER BY id")
+        for node_id, parent_id, name, population, latitude, longitude, iso3, fips in cursor:
+            if parent_id is None:
+                node = data.time_series_data_tree
+            else:
+                node = covid19_data.Covid19_Tree_Node(name)
+                nodes[parent_id].add_child(node)
+            node.population = population
+            node.latitude = latitude
+            node.longitude = longitude
+            node.iso3 = iso3
+            node.fips = fips
+            nodes[node_id] = node
+
+        attributes = covid19_metrics.get_base_attributes()
+        for metric, node_id, length in database.connection.execute("SELECT metric, node_id, length FROM series_lengths"):
+            setattr(nodes[node_id], attributes[metric], [None] * length)
+        for metric, node_id, date_id, value in database.connection.execute("SELECT metric, node_id, date_id, value FROM series"):
+            getattr(nodes[node_id], attributes[metric])[date_id] = value
+
+    data.data_changed()
+    return data
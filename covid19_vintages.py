@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+History of the values in a Covid19_Data tree across data revisions.
+
+Johns Hopkins regularly revises old numbers, so every parse of the data files
+is a new vintage of the data set.  Vintage_Store keeps the first vintage as a
+base snapshot and every later vintage as a delta that only holds the cells
+(node path, metric, date) whose value changed, so old vintages can be queried
+and compared without keeping full copies of the tree.
+"""
+import numpy as np
+
+import covid19_metrics
+import covid19_series
+
+
+def _to_array(series):
+    """
+    Outputs: float64 array of a node time series with NaN for missing values
+    """
+    if isinstance(series, (covid19_series.Compact_Series, covid19_series.Sparse_Series)):
+        return series.to_array()
+    return np.array(series, dtype=float)
+
+
+class Vintage_Store:
+    """
+    base snapshot plus per vintage deltas of the node time series of a data set
+    """
+    def __init__(self):
+        self.labels = []
+        # date columns of each vintage, cells are stored by column so vintages with different date lists can be compared
+        self.vintage_columns = []
+        self.dates = []
+        self.date_columns = {}
+        # (path, attribute) -> Compact_Series with the values of the first vintage
+        self.base = {}
+        # for every vintage after the first: {(path, attribute): (sorted columns, values)} of the changed cells
+        self.deltas = []
+        # for every vintage after the first: (keys added, keys removed) where a key is a (path, attribute) series
+        self.key_changes = []
+        self.__keys = set()
+        # (path, attribute) -> {column: value} latest value of every cell changed since the base snapshot
+        self.__changes = {}
+
+    @classmethod
+    def restore(cls, labels, dates, vintage_columns, base, deltas, key_changes):
+        """
+        Rebuilds a store from its public attributes (ie read back from an
+        archive, see covid19_archive.save_vintages)
+
+        Parameters
+        ----------
+        labels, dates, vintage_columns, base, deltas, key_changes
+            the attributes of the same name of the saved store.
+
+        Returns
+        -------
+        Vintage_Store
+            the store, new vintages can be recorded as usual.
+
+        """
+        store = cls()
+        store.labels = list(labels)
+        store.dates = list(dates)
+        store.date_columns = {date: column for column, date in enumerate(store.dates)}
+        store.vintage_columns = list(vintage_columns)
+        store.base = dict(base)
+        store.deltas = list(deltas)
+        store.key_changes = list(key_changes)
+        keys = set(store.base)
+        for added, removed in store.key_changes:
+            keys = (keys | added) - removed
+        store.__keys = keys
+        for delta in store.deltas:
+            for key, (columns, values) in delta.items():
+                store.__changes.setdefault(key, {}).update(zip(columns.tolist(), values))
+        return store
+
+    def __column(self, date):
+        column = self.date_columns.get(date)
+        if column is None:
+            column = len(self.dates)
+            self.dates.append(date)
+            self.date_columns[date] = column
+        return column
+
+    def __index(self, label):
+        try:
+            return self.labels.index(label)
+        except ValueError:
+            raise KeyError("unknown vintage " + str(label))
+
+    def record(self, label, nodes, dates):
+        """
+        Adds the current values of a data tree as a new vintage
+
+        Parameters
+        ----------
+        label : hashable
+            unique name of the vintage (ie the date the data was parsed).
+        nodes : list of (path, Covid19_Tree_Node)
+            every node of the tree with the path returned by node.get_path().
+        dates : list of datetime
+            the dates of the node time series.
+
+        Raises
+        ------
+        ValueError
+            Raised if a vintage with the same label was already recorded.
+
+        Returns
+        -------
+        int
+            number of cells stored for the vintage.
+
+        """
+        if label in self.labels:
+            raise ValueError("vintage " + str(label) + " already recorded")
+
+        columns = np.array([self.__column(date) for date in dates], dtype=np.intp)
+        current = {}
+        for path, node in nodes:
+            for attribute in covid19_metrics.get_base_attributes().values():
+                series = getattr(node, attribute)
+                if series:
+                    current[(path, attribute)] = series
+
+        cell_count = 0
+        if not self.labels:
+            for key, series in current.items():
+                values = [None] * len(self.dates)
+                for column, value in zip(columns.tolist(), series):
+                    values[column] = value
+                base = covid19_series.Compact_Series(values)
+                base.freeze()
+                self.base[key] = base
+                cell_count = cell_count + len(series)
+        else:
+            delta = {}
+            for key in self.__keys | current.keys():
+                previous = self.__latest_values(key)
+                values = np.full(len(self.dates), np.nan)
+                series = current.get(key)
+                if series:
+                    values[columns[:len(series)]] = _to_array(series)[:len(columns)]
+                changed = np.flatnonzero(~((previous == values) | (np.isnan(previous) & np.isnan(values))))
+                if changed.size:
+                    positions = {column: i for i, column in enumerate(columns.tolist())}
+                    changed_values = tuple(series[positions[column]] if series and column in positions else None for column in changed.tolist())
+                    delta[key] = (changed.astype(np.int32), changed_values)
+                    self.__changes.setdefault(key, {}).update(zip(changed.tolist(), changed_values))
+                    cell_count = cell_count + changed.size
+            self.deltas.append(delta)
+            self.key_changes.append((frozenset(current.keys() - self.__keys), frozenset(self.__keys - current.keys())))
+
+        self.__keys = set(current.keys())
+        self.labels.append(label)
+        self.vintage_columns.append(columns)
+        return cell_count
+
+    def __latest_values(self, key):
+        """
+        Outputs: float array over every date column with the values of the series in the latest vintage (NaN if missing)
+        """
+        values = np.full(len(self.dates), np.nan)
+        base = self.base.get(key)
+        if base is not None:
+            values[:len(base)] = base.to_array()
+        for column, value in self.__changes.get(key, {}).items():
+            values[column] = np.nan if value is None else value
+        return values
+
+    def __has_series(self, key, index):
+        for added, removed in reversed(self.key_changes[:index]):
+            if key in added:
+                return True
+            if key in removed:
+                return False
+        return key in self.base
+
+    def __cell(self, key, column, index):
+        for delta in reversed(self.deltas[:index]):
+            changes = delta.get(key)
+            if changes is not None:
+                position = np.searchsorted(changes[0], column)
+                if position < len(changes[0]) and changes[0][position] == column:
+                    return changes[1][position]
+        base = self.base.get(key)
+        if base is not None and column < len(base):
+            return base[column]
+        return None
+
+    def get_series(self, label, path, metric):
+        """
+        Parameters
+        ----------
+        label : hashable
+            the vintage.
+        path : tuple of str
+            (country, state, county) path of the node, see Covid19_Tree_Node.get_path.
+        metric : str
+            name of a base metric (ie "CONFIRMED_CASES").
+
+        Raises
+        ------
+        KeyError
+            Raised if the vintage or the metric is unknown.
+
+        Returns
+        -------
+        list
+            the series as of the vintage aligned with the dates of that vintage,
+            None if the node had no data for the metric in that vintage.
+
+        """
+        index = self.__index(label)
+        key = (tuple(path), covid19_metrics.get_base_attributes()[metric])
+        if not self.__has_series(key, index):
+            return None
+
+        base = self.base.get(key)
+        values = base.tolist() if base is not None else []
+        values = values + [None] * (len(self.dates) - len(values))
+        for delta in self.deltas[:index]:
+            changes = delta.get(key)
+            if changes is not None:
+                for column, value in zip(changes[0].tolist(), changes[1]):
+                    values[column] = value
+        return [values[column] for column in self.vintage_columns[index].tolist()]
+
+    def get_value(self, label, path, metric, date):
+        """
+        Parameters
+        ----------
+        label : hashable
+            the vintage.
+        path : tuple of str
+            (country, state, county) path of the node.
+        metric : str
+            name of a base metric.
+        date : datetime
+            date of the value.
+
+        Raises
+        ------
+        KeyError
+            Raised if the vintage or the metric is unknown.
+
+        Returns
+        -------
+        int or float
+            the value as of the vintage, None if it was missing.
+
+        """
+        index = self.__index(label)
+        key = (tuple(path), covid19_metrics.get_base_attributes()[metric])
+        column = self.date_columns.get(date)
+        if column is None or column not in self.vintage_columns[index] or not self.__has_series(key, index):
+            return None
+        return self.__cell(key, column, index)
+
+    def diff(self, from_label, to_label):
+        """
+        Parameters
+        ----------
+        from_label : hashable
+            the older vintage.
+        to_label : hashable
+            the newer vintage.
+
+        Raises
+        ------
+        KeyError
+            Raised if a vintage is unknown.
+
+        Returns
+        -------
+        changes : dict
+            {(path, metric): {date: (old value, new value)}} for every cell whose
+            value differs between the two vintages.
+
+        """
+        from_index = self.__index(from_label)
+        to_index = self.__index(to_label)
+        if from_index > to_index:
+            from_index, to_index = to_index, from_index
+        metric_names = {attribute: name for name, attribute in covid19_metrics.get_base_attributes().items()}
+
+        cells = {}
+        for delta in self.deltas[from_index:to_index]:
+            for key, (columns, _) in delta.items():
+                cells.setdefault(key, set()).update(columns.tolist())
+
+        changes = {}
+        for key, columns in cells.items():
+            for column in sorted(columns):
+                old = self.__cell(key, column, from_index)
+                new = self.__cell(key, column, to_index)
+                if old != new:
+                    changes.setdefault((key[0], metric_names[key[1]]), {})[self.dates[column]] = (old, new)
+        return changes
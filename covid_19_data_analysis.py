@@ -85,7 +85,7 @@ while (choice.upper() != 'Q'):
     elif (choice.upper() == "DEBUG1"):
         print("Debug 1 command")
         node = c19_data.get_tree_node("US", None, None)
-        print(node.get_log_moving_average_daily_new_cases_incident_rate(7))
+        print(node.get_metric("LOG10_7DAY_MOVING_AVERAGE_DAILY_NEW_CASES_INCIDENT_RATE"))
     elif (choice.upper() == "DEBUG2"):
         print("Debug 2 command")
     elif (choice.upper() == 'M'):
@@ -173,13 +173,113 @@ def derivative(x_data, y_data):
     
     return dx, dy
 
+class Prefix_Sums:
+    """
+    NaN-aware cumulative sums of a data set (or of every row of a 2d array of
+    data sets), so the sum, count or mean of any range of points is a single
+    subtraction instead of a pass over the range
+    """
+    def __init__(self, data):
+        """
+        Parameters
+        ----------
+        data : list or numpy array
+            data values along the last axis, None / NaN values are skipped
+            (they count as 0 in sums and are not counted in means).
+
+        """
+        values = np.asarray(data, dtype=float)
+        reported = ~np.isnan(values)
+        shape = values.shape[:-1] + (values.shape[-1] + 1,)
+        # sums[..., i] is the sum of the first i points, so the sum of points start to stop-1 is sums[..., stop] - sums[..., start]
+        self.sums = np.zeros(shape)
+        np.cumsum(np.where(reported, values, 0.0), axis=-1, out=self.sums[..., 1:])
+        self.counts = np.zeros(shape, dtype=np.int32)
+        np.cumsum(reported, axis=-1, out=self.counts[..., 1:])
+
+    def __len__(self):
+        return self.sums.shape[-1] - 1
+
+    def sum(self, start, stop):
+        """
+        Parameters
+        ----------
+        start : int or numpy array of int
+            index of the first point of the range.
+        stop : int or numpy array of int
+            index after the last point of the range.
+
+        Returns
+        -------
+        float or numpy array
+            sum of the points in the range (0 if every point is missing).
+
+        """
+        return self.sums[..., stop] - self.sums[..., start]
+
+    def count(self, start, stop):
+        """
+        Returns
+        -------
+        int or numpy array
+            number of points in the range that aren't missing, see sum.
+
+        """
+        return self.counts[..., stop] - self.counts[..., start]
+
+    def mean(self, start, stop):
+        """
+        Returns
+        -------
+        float or numpy array
+            mean of the points in the range that aren't missing, NaN if there
+            are none, see sum.
+
+        """
+        sums = np.asarray(self.sum(start, stop), dtype=float)
+        counts = self.count(start, stop)
+        return np.divide(sums, counts, out=np.full(sums.shape, np.nan), where=(counts != 0))
+
+
+def running_window_sums(values, window_len):
+    """
+    Calculates the backward sum over window_len points ending at every point
+    the same way as a running sum that adds the newest point and then
+    subtracts the oldest one, so the results are bit for bit the same as that
+    loop (prefix sum differences round differently for float data).  The
+    additions and subtractions are interleaved in one array so the whole
+    running sum is a single cumulative sum.
+
+    Parameters
+    ----------
+    values : numpy array
+        data values along the last axis (1d or 2d), without NaN.
+    window_len : int
+        number of points in each window, less than the number of points.
+
+    Returns
+    -------
+    numpy array
+        the window sums, the first window_len-1 values are the partial sums
+        of the points so far.
+
+    """
+    length = values.shape[-1]
+    steps = np.empty(values.shape[:-1] + (2 * length - window_len,))
+    steps[..., :window_len] = values[..., :window_len]
+    steps[..., window_len::2] = values[..., window_len:]
+    steps[..., window_len+1::2] = -values[..., :length-window_len]
+    sums = np.cumsum(steps, axis=-1)
+    return np.concatenate((sums[..., :window_len], sums[..., window_len+1::2]), axis=-1)
+
+
 def moving_average(y_data, window_len):
     """
     calculates the backward moving average over the specified number of data points for the specified data set
 
     Parameters
     ----------
-    y_data : list of data values (int or float)
+    y_data : list of data values (int or float), or a 2d numpy array with one data set per row (ie regions x dates)
     window_len : integer with number of data points to include in moving average ()
 
     Raises
@@ -188,35 +288,20 @@ def moving_average(y_data, window_len):
     Returns
     -------
     moving_average : list
-        list of moving average values by day (the first window_len values in the list will be None)
+        list of moving average values by day (the first window_len-1 values are the data values themselves,
+        missing values count as 0), a 2d numpy array with a row per data set for 2d input
         will return None if something goes wrong
 
     """
-    if window_len < len(y_data) and window_len > 0:
-        moving_average_sum = 0
-        moving_avg_data = []
-        
-        for i in range(0,len(y_data)):
-            if y_data[i] and not np.isnan(y_data[i]):
-                add_value = y_data[i]
-            else:
-                add_value = 0
-            if i == window_len-1:
-                moving_average_sum = moving_average_sum + add_value
-                moving_average = moving_average_sum/window_len
-            elif i >= window_len:
-                if y_data[i - window_len] and not np.isnan(y_data[i - window_len]):
-                    sub_value = y_data[i - window_len]
-                else:
-                    sub_value = 0
-                moving_average_sum = moving_average_sum + add_value - sub_value
-                moving_average = moving_average_sum/window_len
-            else:
-                moving_average_sum = moving_average_sum + add_value
-                moving_average = add_value
-
-            moving_avg_data.append(moving_average)
-
+    values = np.asarray(y_data, dtype=float)
+    if window_len < values.shape[-1] and window_len > 0:
+        values = np.where(np.isnan(values), 0.0, values)
+        moving_avg_data = running_window_sums(values, window_len)
+        moving_avg_data[..., window_len-1:] = moving_avg_data[..., window_len-1:] / window_len
+        # until the window is full the average is just the data point
+        moving_avg_data[..., :window_len-1] = values[..., :window_len-1]
+        if values.ndim == 1:
+            return moving_avg_data.tolist()
         return moving_avg_data
                 
     else:
@@ -228,8 +313,9 @@ def moving_window_ratio(num_data, den_data, window_len):
 
     Parameters
     ----------
-    num_data : list of data values for the numerator of the ratio (int or float)
-    den_data : list of data values for the denominator of the ratio (int or float)
+    num_data : list of data values for the numerator of the ratio (int or float), or a 2d numpy array with one data set
+        per row (ie regions x dates)
+    den_data : list of data values for the denominator of the ratio (int or float), same shape as num_data
     window_len : integer with number of data points to include in each window calculation ()
 
     Raises
@@ -238,55 +324,23 @@ def moving_window_ratio(num_data, den_data, window_len):
     Returns
     -------
     moving_average : list
-        list of moving average values by day (the first window_len values in the list will be None)
+        list of moving average values by day (the first window_len-1 values in the list will be None, as are windows
+        whose denominator sum is 0, missing values count as 0), a 2d numpy array with a row per data set and NaN instead
+        of None for 2d input
         will return None if something goes wrong
 
     """
-    if window_len < len(num_data) and window_len > 0 and len(num_data) == len(den_data):
-        window_num_sum = 0
-        window_den_sum = 0
-        window_ratio_data = []
-        
-        for i in range(0,len(num_data)):
-            if num_data[i] and not np.isnan(num_data[i]):
-                add_num_value = num_data[i]
-            else:
-                add_num_value = 0
-            if den_data[i] and not np.isnan(den_data[i]):
-                add_den_value = den_data[i]
-            else:
-                add_den_value = 0
-            if i == window_len-1:
-                window_num_sum = window_num_sum + add_num_value
-                window_den_sum = window_den_sum + add_den_value
-                if window_den_sum != 0:
-                    ratio = window_num_sum / window_den_sum
-                else:
-                    ratio = None
-            elif i >= window_len:
-                if num_data[i - window_len] and not np.isnan(num_data[i - window_len]):
-                    sub_num_value = num_data[i - window_len]
-                else:
-                    sub_num_value = 0
-                if den_data[i - window_len] and not np.isnan(den_data[i - window_len]):
-                    sub_den_value = den_data[i - window_len]
-                else:
-                    sub_den_value = 0                
-                window_num_sum = window_num_sum + add_num_value - sub_num_value
-                window_den_sum = window_den_sum + add_den_value - sub_den_value
-                if window_den_sum != 0:
-                    ratio = window_num_sum / window_den_sum
-                else:
-                    ratio = None
-            else:
-                window_num_sum = window_num_sum + add_num_value
-                window_den_sum = window_den_sum + add_den_value
-                ratio = None
-
-            window_ratio_data.append(ratio)
-
-        return window_ratio_data
+    num_values = np.asarray(num_data, dtype=float)
+    den_values = np.asarray(den_data, dtype=float)
+    if window_len < num_values.shape[-1] and window_len > 0 and num_values.shape == den_values.shape:
+        num_sums = running_window_sums(np.where(np.isnan(num_values), 0.0, num_values), window_len)
+        den_sums = running_window_sums(np.where(np.isnan(den_values), 0.0, den_values), window_len)
+        ratios = np.full(num_sums.shape, np.nan)
+        np.divide(num_sums, den_sums, out=ratios, where=(den_sums != 0))
+        ratios[..., :window_len-1] = np.nan
+        if ratios.ndim == 1:
+            return [None if np.isnan(ratio) else ratio for ratio in ratios.tolist()]
+        return ratios
                 
     else:
         return None
- 
\ No newline at end of file
@@ -14,6 +14,8 @@ class GithubDirectoryTree:
     def __init__(self, repo_owner, repo_name):
         self.tree = treelib.Tree()
         self.tree.create_node("/", "/", data="directory")
+        # git blob sha of every file, changes whenever the contents of the file change
+        self.shas = {}
         
         # retrieve data
         url = "https://api.github.com/repos/" + repo_owner + "/" + repo_name + "/git/trees/master?recursive=1"
@@ -24,6 +26,8 @@ class GithubDirectoryTree:
         paths = []
         for node in data.get("tree"):
             paths.append([node.get("path"), node.get("type")])
+            if node.get("type") == "blob":
+                self.shas["/" + node.get("path")] = node.get("sha")
         
         for path, obj_type in paths:
             split = path.split("/")
@@ -93,6 +97,10 @@ class GithubDirectoryTree:
         for item in self.tree.children(directory):  
             items.append(item.identifier)
             
+    def get_sha(self, file):
+        file = "/" + "/".join(part for part in file.split("/") if part)  # make sure '/' is in the correct locations
+        return self.shas.get(file)
+        
     def split_file(self, file):
         if len(file) > 1:           # make sure '/' is in the correct locations to avoid seemingly
             file = file.strip("/")  # incorrect behaviour
@@ -7,11 +7,44 @@ Created on Sun Jun 14 17:06:00 2020
 """
 
 from datetime import datetime
+import numpy as np
 import plotly.graph_objects as go
 
 import data_analysis
 
 
+def moving_averages(y_datasets, window_len):
+    """
+    calculates data_analysis.moving_average of several data sets, the data
+    sets of the same length are calculated together in one batch
+
+    Parameters
+    ----------
+    y_datasets : list
+        list of data sets (lists or numpy arrays, None / NaN for missing values).
+    window_len : int
+        number of data points to include in moving average.
+
+    Returns
+    -------
+    list
+        list with the moving average of each data set (None where
+        moving_average returns None).
+
+    """
+    averages = [None] * len(y_datasets)
+    batches = {}
+    for i, y_data in enumerate(y_datasets):
+        batches.setdefault(len(y_data), []).append(i)
+    for indexes in batches.values():
+        batch = np.array([y_datasets[i] for i in indexes], dtype=float)
+        batch_averages = data_analysis.moving_average(batch, window_len)
+        if batch_averages is not None:
+            for i, average in zip(indexes, batch_averages.tolist()):
+                averages[i] = average
+    return averages
+
+
 class DataHandler:
     """
     class that contains methods for modifying and storing data that is to 
@@ -168,10 +201,11 @@ class DataHandler:
                 print(self.plot_configurations[index])
                 if self.plot_configurations[index]["smooth"] == "Savitzky Golay":
                     x_data, y_data = data_analysis.smooth_dataset(x_data, y_data, **self.plot_configurations[index]["savgol"].toDict())
-                elif self.plot_configurations[index]["smooth"] == "Moving Average":
-                    y_data = data_analysis.moving_average(y_data, self.plot_configurations[index]["moving_average"].window_length)
                 x_dataset.append(x_data)
                 y_dataset.append(y_data)
+            if self.plot_configurations[index]["smooth"] == "Moving Average":
+                # every region in one batch instead of one moving_average call per region
+                y_dataset = moving_averages(y_dataset, self.plot_configurations[index]["moving_average"].window_length)
 
             self.x_datasets[index] = x_dataset
             self.y_datasets[index] = y_dataset
@@ -188,10 +222,10 @@ class DataHandler:
                 y_data = self.original_y[0][i]
                 if self.plot_configurations[0]["smooth"] == "Savitzky Golay":
                     x_data, y_data = data_analysis.smooth_dataset(x_data, y_data, **self.plot_configurations[0]["savgol"].toDict())
-                elif self.plot_configurations[0]["smooth"] == "Moving Average":
-                    y_data = data_analysis.moving_average(y_data, self.plot_configurations[0]["moving_average"].window_length)
                 x_dataset.append(x_data)
                 y_dataset.append(y_data)
+            if self.plot_configurations[0]["smooth"] == "Moving Average":
+                y_dataset = moving_averages(y_dataset, self.plot_configurations[0]["moving_average"].window_length)
 
             self.x_datasets[0] = x_dataset
             self.y_datasets[0] = y_dataset
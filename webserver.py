@@ -20,7 +20,10 @@ from urllib.request import urlopen
 import us
 import pickle
 
+import covid19_archive
 import covid19_data
+import covid19_metrics
+import covid19_snapshot
 import data_grabber
 import plot_handler
 
@@ -107,6 +110,7 @@ class GraphSessionInfo:
         else:
             GraphSessionInfo.__instance = self
             
+            self.data = None
             self.dates = None
             self.lookup_table = None
             self.plotted_regions = None
@@ -126,13 +130,16 @@ class GraphSessionInfo:
     def set_plotted_regions(self, plotted_regions):
         self.plotted_regions = plotted_regions
         
+    def set_data(self, data):
+        self.data = data
+
     def set_dates_data(self, dates_data):
         self.dates = dates_data
     
     def set_lookup_table(self, lookup_table):
         self.lookup_table = lookup_table
         
-    def get_data_handler(self, graph_name, data_attribute):
+    def get_data_handler(self, graph_name, metric_name):
         cache_name = graph_name + "_" + str(self.num_derivatives) + "_" + "".join([i.node_name for i in self.plotted_regions])
         # if self.cached_data_handlers.get(cache_name):  # check if entry is cached and return that
         #     return self.cached_data_handlers.get(cache_name)
@@ -142,20 +149,14 @@ class GraphSessionInfo:
             datasets = []
             labels = []
             for node in self.plotted_regions:
-                data = getattr(node, data_attribute)
-                if callable(data):
-                    data = data()
+                # read-only view of the node's row in the shared metric array (NaN for missing values), nothing is copied
+                data = self.data.get_node_window(node, metric_name)
                     
-                if data:
+                if data is not None:
                     datasets.append(data)
                     labels.append(get_label(node))
                 else:
                     st.warning("No " + graph_name + " data was found for " + node.node_name)
-                    
-            for i, dataset in enumerate(datasets):
-                for j, data_point in enumerate(dataset):
-                    if data_point is None:
-                        datasets[i][j] = np.nan    
             
             handler = plot_handler.DataHandler(self.lookup_table, self.dates, datasets, labels)
             for i in range(self.num_derivatives):
@@ -165,11 +166,45 @@ class GraphSessionInfo:
             return copy.deepcopy(handler)           
 
 
-@st.cache(hash_funcs={covid19_data.Covid19_Tree_Node: lambda _: None}, allow_output_mutation=True)
+JHU_RAW_URL = "https://raw.githubusercontent.com/CSSEGISandData/COVID-19/master/"
+POPULATION_URL = JHU_RAW_URL + "csse_covid_19_data/UID_ISO_FIPS_LookUp_Table.csv"
+
+
+def load_vintages():
+    """
+    loads the history of earlier parses of the data (see Covid19_Data.record_vintage)
+
+    Returns
+    -------
+    Vintage_Store
+        the saved vintages, None if there are none.
+
+    """
+    if os.path.isfile("vintages.archive"):
+        return covid19_archive.load_vintages("vintages.archive")
+    # vintages saved before the archive format was used
+    if os.path.isfile("vintages"):
+        with open("vintages", "rb") as vintages_file:
+            return pickle.load(vintages_file)
+    return None
+
+
+@st.cache(hash_funcs={covid19_data.Covid19_Tree_Node: lambda _: None}, allow_output_mutation=True, ttl=3600)
 def parse_data(file_urls, us_daily_reports_folder, world_daily_reports_folder):
     """
     gets data from nodes from select nodes. This is cached so that it doesn't
-    need to be parsed after each rerun
+    need to be parsed after each rerun, and saved as a snapshot so it doesn't
+    need to be parsed after a restart either.  The snapshot is keyed by the
+    git sha of every source file, so it is reparsed as soon as the data on
+    github changes (checked at most once an hour), and daily report files are
+    only downloaded again if they changed.
+
+    The rebuild isn't incremental: when any source file changed, every time
+    series file is downloaded and the whole data set is parsed again, only
+    unchanged daily report files are read from the local download cache
+    instead of github.  The values of several files are summed into the same
+    nodes and JHU revises earlier dates in the time series files, so the
+    tree can't be updated one changed file at a time.
 
     Parameters
     ----------
@@ -183,15 +218,36 @@ def parse_data(file_urls, us_daily_reports_folder, world_daily_reports_folder):
     Returns
     -------
     data : Covid19_Data
-        data that was parsed from files.
+        data that was parsed from files. The data is frozen because the same
+        instance is shared by every session, use data.copy() to modify it.
+        Every parse is recorded as a vintage in data.vintages so revisions of
+        the data files can be compared.
 
     """
-    if(os.path.isfile("data")):
-        with open("data", "rb") as data_file:
-            data = pickle.load(data_file)
-            return data
-        
-    data = covid19_data.Covid19_Data()
+    data = covid19_data.Covid19_Data(sparse_storage=True)
+    # a single request for the listing of the repository gives the sha of every source file
+    with st.spinner("Checking for new data"):
+        source_paths = [url[len(JHU_RAW_URL):] for url in list(file_urls) + [POPULATION_URL]]
+        for folder in (us_daily_reports_folder, world_daily_reports_folder):
+            source_paths.extend(data.github_tree.list_files(folder, extensions=".csv"))
+        manifest = covid19_snapshot.source_manifest(data.github_tree, source_paths)
+
+    # with several server processes a loader process can publish the snapshot in shared memory
+    # (python covid19_snapshot.py snapshot <name>), every process then attaches to the same copy
+    if os.environ.get("COVID19_SHARED_DATA"):
+        shared = covid19_snapshot.attach_shared(os.environ["COVID19_SHARED_DATA"], manifest)
+        if shared is not None:
+            shared.vintages = load_vintages()
+            return shared.freeze()
+
+    # the node series of the snapshot are memory mapped, so loading it doesn't read the data until it is used
+    snapshot = covid19_snapshot.load_snapshot("snapshot", manifest)
+    if snapshot is not None:
+        snapshot.vintages = load_vintages()
+        return snapshot.freeze()
+
+    # daily report files that didn't change since the last parse are read from here instead of github
+    data.download_cache = "downloads"
     for file_url in file_urls:
         spinner_text = "Reading time series file: " + file_url
         with st.spinner(spinner_text):
@@ -203,12 +259,21 @@ def parse_data(file_urls, us_daily_reports_folder, world_daily_reports_folder):
         data.read_daily_reports_data(world_daily_reports_folder, "world")
     # covid19_data.dump_tree_to_file(data.time_series_data_tree, "test.txt")
     with st.spinner("Reading population data"):
-        data.read_population_data("https://raw.githubusercontent.com/CSSEGISandData/COVID-19/master/csse_covid_19_data/UID_ISO_FIPS_LookUp_Table.csv")
-    
-    with open("data", "wb") as data_file:
-        pickle.dump(data, data_file)
+        data.read_population_data(POPULATION_URL)
+
+    # the vintages are saved separately so the history survives deleting the data file to force a new parse
+    data.vintages = load_vintages()
+    data.record_vintage(datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+    covid19_archive.save_vintages(data.vintages, "vintages.archive")
+    # every registered metric is calculated once here (in parallel) and stored with the snapshot, views only read it
+    with st.spinner("Calculating metrics"):
+        covid19_snapshot.save_snapshot(data, "snapshot", manifest, list(covid19_metrics.METRICS))
+    snapshot = covid19_snapshot.load_snapshot("snapshot", manifest)
+    if snapshot is not None:
+        snapshot.vintages = data.vintages
+        data = snapshot
     
-    return data
+    return data.freeze()
 
              
 @st.cache(allow_output_mutation=True)
@@ -305,6 +370,83 @@ def get_smoothing_configuration(uid, areas, previous={}):
     return data
 
 
+CONTINENT_NAMES = {
+    "AF": "Africa",
+    "AN": "Antarctica",
+    "AS": "Asia",
+    "EU": "Europe",
+    "NA": "North America",
+    "OC": "Oceania",
+    "SA": "South America"
+    }
+
+
+def add_continent_groups(data):
+    """
+    registers a region group for each continent with the countries in it, so
+    continents can be plotted like any other region
+
+    Parameters
+    ----------
+    data : Covid19_Data
+        the data set to add the groups to.
+
+    Returns
+    -------
+    None.
+
+    """
+    continents = {}
+    for country in data.time_series_data_tree.get_children():
+        try:
+            iso2 = pc.country_alpha3_to_country_alpha2(country.iso3)
+            continent = pc.country_alpha2_to_continent_code(iso2)
+        except (KeyError, TypeError):
+            continue
+        continents.setdefault(CONTINENT_NAMES.get(continent, continent), []).append(country)
+
+    for name, countries in continents.items():
+        if data.get_region_group(name) is None:
+            data.add_region_group(name, countries)
+
+
+def get_map_data(data, nodes, metric_name, frames=slice(None)):
+    """
+    reads a metric for the nodes of a map from the date major layout of the
+    data set (one contiguous row per date) instead of walking every node series
+
+    Parameters
+    ----------
+    data : Covid19_Data
+        the data set the nodes belong to.
+    nodes : list of Covid19_Tree_Node
+        the nodes to show on the map.
+    metric_name : str
+        name of a registered metric.
+    frames : slice, optional
+        date columns of the animation frames.  The default is every date.
+
+    Returns
+    -------
+    nodes : list of Covid19_Tree_Node
+        the nodes that have data for the metric.
+    latest : list
+        value of each of those nodes on the last date, None if missing.
+    animation : list of (str, list)
+        for every frame the date and the value of each node on that date.
+
+    """
+    latest, valid = data.get_cross_section(metric_name, nodes=nodes)
+    nodes = [node for node, has_data in zip(nodes, valid.tolist()) if has_data]
+    latest = [None if math.isnan(value) else value for value in latest[valid].tolist()]
+
+    rows = data.get_node_rows(nodes)
+    animation = []
+    for date, row in zip(data.time_series_dates[frames], data.get_date_major_array(metric_name)[frames]):
+        animation.append((str(date), [None if math.isnan(value) else value for value in row[rows].tolist()]))
+    return nodes, latest, animation
+
+
 def get_label(node):
     """
     Creates a label from a node
@@ -343,7 +485,7 @@ def get_label(node):
     return new_name.strip()
 
 
-def get_regions(root_node):
+def get_regions(root_node, groups=()):
     """
     Gets regions from a tree node using the streamlit api with multiselects
     Has functionality for adding all data to multiselect
@@ -352,6 +494,8 @@ def get_regions(root_node):
     ----------
     root_node : Covid19_Tree_Node
         the root node of regions.
+    groups : list of Covid19_Region_Group, optional
+        region groups (ie continents) that can be selected as well.
 
     Returns
     -------
@@ -405,6 +549,10 @@ def get_regions(root_node):
         else:
             plotted_areas.append(region)    
 
+    if groups:
+        group_names = st.sidebar.multiselect("Select Region Groups", sorted([group.node_name for group in groups]))
+        plotted_areas.extend([group for group in groups if group.node_name in group_names])
+
     return plotted_areas
 
 
@@ -440,7 +588,7 @@ def get_regions(root_node):
 # daily_reports_folder = data_folder + "/csse_covid_19_data/csse_covid_19_daily_reports"
 
 
-time_series_url = "https://raw.githubusercontent.com/CSSEGISandData/COVID-19/master/csse_covid_19_data/csse_covid_19_time_series/"
+time_series_url = JHU_RAW_URL + "csse_covid_19_data/csse_covid_19_time_series/"
 files = [
     time_series_url + "time_series_covid19_confirmed_US.csv",
     time_series_url + "/time_series_covid19_confirmed_global.csv",
@@ -449,8 +597,9 @@ files = [
     ]
 us_daily_reports_folder = "csse_covid_19_data/csse_covid_19_daily_reports_us"
 world_daily_reports_folder = "csse_covid_19_data/csse_covid_19_daily_reports"
-covid_data = copy.deepcopy(parse_data(files, us_daily_reports_folder, world_daily_reports_folder))
+covid_data = parse_data(files, us_daily_reports_folder, world_daily_reports_folder)
 world_node = covid_data.time_series_data_tree
+add_continent_groups(covid_data)
 
 # world_node = covid19_data.read_tree_from_file("test.txt")
 
@@ -475,31 +624,11 @@ mode = st.sidebar.selectbox(
     ]
 )
 # select the type of graph
-data_options = {
-    "Confirmed Cases":"confirmed_cases_time_series_data",
-    "Deaths":"deaths_time_series_data",
-    "Daily New Confirmed Cases":"get_daily_new_cases",
-    "Daily New Deaths":"get_daily_new_deaths",
-    "Testing":"people_tested_time_series_data",
-    "Confirmed Cases Incident":"incident_rate_time_series_data",
-    "Confirmed Cases Incident - Calculated":"get_calculated_cases_incident_rate",
-    "Deaths Incident":"get_calculated_deaths_incident_rate",
-    "Daily New Confirmed Cases Incident" : "get_daily_new_cases_incident_rate",
-    "Daily New Deaths Incident" : "get_daily_new_deaths_incident_rate",
-    "Log10(mvg_avg(Daily New Confirmed Cases Incident))": "get_log10_7day_moving_average_daily_new_cases_incident_rate",
-    "Log2(mvg_avg(Daily New Confirmed Cases Incident))": "get_log2_7day_moving_average_daily_new_cases_incident_rate",
-    "Log2(mvg_avg(100*Daily New Deaths Incident))": "get_log2_7day_moving_average_daily_new_deaths_incident_rate",
-    "Active Cases":"active_cases_time_series_data",
-    "Recovered Cases":"recovered_cases_time_series_data",
-    "Recovery Rate":"get_recovery_rate",
-    "Confirmed Cases to People Tested Ratio":"get_ratio_confirmed_cases_to_people_tested",
-    "New Confirmed Cases to People Tested Ratio":"get_daily_ratio_confirmed_cases_to_people_tested",
-    "Case Fatality Rate":"get_case_fatality_rate",
-    "30 Day Moving Window Case Fatality Rate":"get_moving_window_case_fatality_rate",
-    "Testing Incident":"get_calculated_people_tested_incident_rate"
-}
+data_options = covid19_metrics.get_labels()  # label shown in the UI -> metric name in the registry
 
 if st.button("Clear Cache"):
+    # the snapshot is rebuilt on the next run, unchanged daily report files are still read from the download cache
+    covid19_snapshot.clear_snapshot("snapshot")
     st.caching.clear_cache()
 
 # get x axis data
@@ -513,7 +642,7 @@ if mode == "Line Chart":
     
     st.sidebar.markdown("---")
     
-    plotted_areas = get_regions(world_node)
+    plotted_areas = get_regions(world_node, covid_data.get_region_groups())
 
     # add original datasets to the plot handler     
     x = []
@@ -522,6 +651,7 @@ if mode == "Line Chart":
     for _ in range(len(plotted_areas)):
         x.append([dates_to_int_lookup.get(date.strftime("%m-%d-%Y")) for date in dates])
     
+    get_graph_session_info().set_data(covid_data)
     get_graph_session_info().set_dates_data(x)
     get_graph_session_info().set_lookup_table(int_to_dates_lookup)
     get_graph_session_info().set_plotted_regions(plotted_areas)
@@ -672,21 +802,14 @@ elif mode == "Area Chart":
     
     data_type = st.sidebar.selectbox("Data Table Entry", sorted(data_options.keys()))
     
-    columns = {"region":[], "date":[], data_type:[]}
+    plotted_nodes = []
     for node in selected_node.get_children():
-        data = getattr(node, data_options.get(data_type))
-        if callable(data):
-            data = data()
-            
-        if data:
-            for i, date in zip(data, dates):
-                columns["region"].append(node.node_name)
-                columns["date"].append(date)
-                columns[data_type].append(i)
+        if covid_data.get_node_window(node, data_options.get(data_type)) is not None:
+            plotted_nodes.append(node)
         else:
             st.warning("No " + data_type + " data was found for " + node.node_name)        
     
-    df = pd.DataFrame(columns)
+    df = covid_data.to_frame(data_options.get(data_type), plotted_nodes).rename(columns={data_options.get(data_type): data_type})
     
     fig = px.area(df, x="date", y=data_type, color="region", line_group="region")
     st.plotly_chart(fig, use_container_width=True)  
@@ -711,9 +834,7 @@ elif mode == "Percentage Area Chart":
     
     aggregate = [0 for i in range(len(selected_node.get_children()))]
     for node in selected_node.get_children():
-        data = getattr(node, data_options.get(data_type))
-        if callable(data):
-            data = data()
+        data = node.get_metric(data_options.get(data_type))
         if data:
             for i in range(len(aggregate)):
                 try:
@@ -726,9 +847,7 @@ elif mode == "Percentage Area Chart":
     columns = {"region":[], "date":[], data_type:[]}
     fig = go.Figure()
     for node in selected_node.get_children():
-        data = getattr(node, data_options.get(data_type))
-        if callable(data):
-            data = data()
+        data = node.get_metric(data_options.get(data_type))
         
         if data:
             data_percentage = []
@@ -770,15 +889,16 @@ elif mode == "Pie Chart":
     
 
     columns = {"region":[], "date":[], data_type:[]}
-    for node in selected_node.get_children():
-        data = getattr(node, data_options.get(data_type))
-        if callable(data):
-            data = data()
+    children = selected_node.get_children()
+    latest, latest_dates = covid_data.get_latest_values(data_options.get(data_type), nodes=children)
+    for node, data, data_date in zip(children, latest.tolist(), latest_dates):
         
-        if data:
+        if data_date is not None:
             columns["region"].append(node.node_name)
-            columns["date"].append(dates[-1])
-            columns[data_type].append(data[-1])
+            columns["date"].append(data_date)
+            columns[data_type].append(data)
+            if data_date != dates[-1]:
+                st.warning("Latest " + data_type + " data for " + node.node_name + " is from " + data_date.strftime("%m/%d/%Y"))
         else:
             date = dates[-1].strftime("%m/%d/%Y")
             st.warning("No " + data_type + " data was found for " + node.node_name + " on " + date)        
@@ -816,13 +936,12 @@ elif mode == "Bar Chart":
     for data_type in data_types:
         regions = []
         node_data = []
-        for node in selected_node.get_children():
-            data = getattr(node, data_options.get(data_type))
-            if callable(data):
-                data = data()
+        children = selected_node.get_children()
+        latest, latest_dates = covid_data.get_latest_values(data_options.get(data_type), nodes=children)
+        for node, data, data_date in zip(children, latest.tolist(), latest_dates):
             
-            if data:
-                node_data.append(data[-1])
+            if data_date is not None:
+                node_data.append(data)
                 regions.append(node.node_name)
             else:
                 date = dates[-1].strftime("%m/%d/%Y")
@@ -866,10 +985,12 @@ elif mode == "Map":
         days_in_between = math.ceil((dates[-1] - dates[0]).days / 13)  # 13 the max number of data points for counties
                                                                        # otherwise the dataset becomes too big for the animation
                                                                        # to handle
-        valid_dates = [dates[-1]]
-        i = 1
-        while valid_dates[-1] - (datetime.timedelta(days=days_in_between * i)) > dates[0]:
-            valid_dates.append(valid_dates[-1] - (datetime.timedelta(days=days_in_between * i)))
+        # every days_in_between days counting back from the last date, excluding the first date
+        frames = covid_data.get_date_slice(start_date=dates[0] + datetime.timedelta(days=1), step=max(days_in_between, 1))
+        
+        map_fips = set(i.get("id") for i in list(counties_fips.values())[1])
+        counties = [county for county in counties if county.fips and county.fips in map_fips]
+        counties, latest, animation = get_map_data(covid_data, counties, data_options.get(data_type), frames)
         
         anim_data = {}
         no_anim_data = {}
@@ -877,31 +998,26 @@ elif mode == "Map":
         j = 0
         
         for i, county in enumerate(counties):
-            if county.fips and county.fips in [i.get("id") for i in list(counties_fips.values())[1]]:
-                node_data = getattr(county, data_options.get(data_type))
-                if callable(node_data):
-                    node_data = node_data()
-                if node_data:
-                    d = {
-                        "fips":county.fips,
-                        "data":node_data[-1] if node_data[-1] is not None else 0,
-                        "county":county.node_name + ", " + county.parent.node_name
-                        
-                    }
-                    no_anim_data.update({j:d})
-                    for k, datapoint in enumerate(node_data):
-                        d = {
-                            "fips":county.fips,
-                            "county":county.node_name + ", " + county.parent.node_name,
-                            "data":datapoint if datapoint is not None else 0,
-                            "date":str(dates[k]),                            
-                        }
-                        if dates[k] in valid_dates:
-                            anim_data.update({j:d})
-                            j += 1
-                        
-                    if node_data[-1] == 0 or (node_data and node_data[-1] is None):
-                        zero_data.append(county.node_name + ", " + county.parent.node_name)
+            d = {
+                "fips":county.fips,
+                "data":latest[i] if latest[i] is not None else 0,
+                "county":county.node_name + ", " + county.parent.node_name
+                
+            }
+            no_anim_data.update({i:d})
+                
+            if latest[i] == 0 or latest[i] is None:
+                zero_data.append(county.node_name + ", " + county.parent.node_name)
+        for date, frame_data in animation:
+            for county, datapoint in zip(counties, frame_data):
+                d = {
+                    "fips":county.fips,
+                    "county":county.node_name + ", " + county.parent.node_name,
+                    "data":datapoint if datapoint is not None else 0,
+                    "date":date,                            
+                }
+                anim_data.update({j:d})
+                j += 1
         df_anim = pd.DataFrame.from_dict(anim_data, orient='index')
         df_no_anim = pd.DataFrame.from_dict(no_anim_data, orient='index')
         
@@ -940,38 +1056,37 @@ elif mode == "Map":
             st.warning("No data for counties available with selected data type")
 
     elif map_type == "US States":
-        states = [i for i in  world_node.get_child_node("US").get_children()]
+        states = [i for i in  world_node.get_child_node("US").get_children() if i.fips and us.states.lookup(i.fips)]
+        states, latest, animation = get_map_data(covid_data, states, data_options.get(data_type))
+        state_codes = [us.states.lookup(state.fips).abbr for state in states]
 
         anim_data = {}
         no_anim_data = {}
         zero_data = []
         j = 0
         for i, state in enumerate(states):
-            node_data = getattr(state, data_options.get(data_type))
-            if callable(node_data):
-                node_data = node_data()
-            if node_data and us.states.lookup(state.fips):
+            d = {
+                "state_code":state_codes[i],
+                "data":latest[i] if latest[i] is not None else 0,
+                "state":state.node_name
+                
+            }
+            no_anim_data.update({i:d})
+            
+            if latest[i] == 0 or latest[i] is None:
+                zero_data.append(state.node_name + ", " + state.parent.node_name)
+        for date, frame_data in animation:
+            for state, state_code, datapoint in zip(states, state_codes, frame_data):
                 d = {
-                    "state_code":us.states.lookup(state.fips).abbr,
-                    "data":node_data[-1] if node_data[-1] is not None else 0,
+                    "state_code":state_code,
+                    "data":datapoint if datapoint is not None else 0,
+                    "date":date,
                     "state":state.node_name
                     
                 }
-                no_anim_data.update({j:d})
-                for k, datapoint in enumerate(node_data):
-                    d = {
-                        "state_code":us.states.lookup(state.fips).abbr,
-                        "data":datapoint if datapoint is not None else 0,
-                        "date":str(dates[k]),
-                        "state":state.node_name
-                        
-                    }
-
-                    anim_data.update({j:d})
-                    j += 1
-                
-                if node_data[-1] == 0 or (node_data and node_data[-1] is None):
-                    zero_data.append(state.node_name + ", " + state.parent.node_name)
+
+                anim_data.update({j:d})
+                j += 1
             
         df_anim = pd.DataFrame.from_dict(anim_data, orient='index')
         df_no_anim = pd.DataFrame.from_dict(no_anim_data, orient='index')
@@ -1026,41 +1141,38 @@ elif mode == "Map":
         days_in_between = math.ceil((dates[-1] - dates[0]).days / 13)  # 13 the max number of data points for counties
                                                                        # otherwise the dataset becomes too big for the animation
                                                                        # to handle
-        valid_dates = [dates[-1]]
-        i = 1
-        while valid_dates[-1] - (datetime.timedelta(days=days_in_between * i)) > dates[0]:
-            valid_dates.append(valid_dates[-1] - (datetime.timedelta(days=days_in_between * i)))
+        # every days_in_between days counting back from the last date, excluding the first date
+        frames = covid_data.get_date_slice(start_date=dates[0] + datetime.timedelta(days=1), step=max(days_in_between, 1))
+        
+        map_fips = set(i.get("id") for i in list(counties_fips.values())[1])
+        counties = [county for county in counties if county.fips and county.fips in map_fips]
+        counties, latest, animation = get_map_data(covid_data, counties, data_options.get(data_type), frames)
         
         anim_data = {}
         no_anim_data = {}
         zero_data = []
         j = 0
         for i, county in enumerate(counties):
-            if county.fips and county.fips in [i.get("id") for i in list(counties_fips.values())[1]]:
-                node_data = getattr(county, data_options.get(data_type))
-                if callable(node_data):
-                    node_data = node_data()
-                if node_data:
-                    d = {
-                        "fips":county.fips,
-                        "data":node_data[-1] if node_data[-1] is not None else 0,
-                        "county":county.node_name + ", " + county.parent.node_name
-                        
-                    }
-                    no_anim_data.update({j:d})
-                    for k, datapoint in enumerate(node_data):
-                        d = {
-                            "fips":county.fips,
-                            "data":datapoint if datapoint is not None else 0,
-                            "county":county.node_name + ", " + county.parent.node_name,
-                            "date":str(dates[k])
-                        }
-                        if dates[k] in valid_dates:
-                            anim_data.update({j:d})
-                            j += 1
-
-                    if node_data[-1] == 0:
-                        zero_data.append(county.node_name + ", " + county.parent.node_name)
+            d = {
+                "fips":county.fips,
+                "data":latest[i] if latest[i] is not None else 0,
+                "county":county.node_name + ", " + county.parent.node_name
+                
+            }
+            no_anim_data.update({i:d})
+
+            if latest[i] == 0:
+                zero_data.append(county.node_name + ", " + county.parent.node_name)
+        for date, frame_data in animation:
+            for county, datapoint in zip(counties, frame_data):
+                d = {
+                    "fips":county.fips,
+                    "data":datapoint if datapoint is not None else 0,
+                    "county":county.node_name + ", " + county.parent.node_name,
+                    "date":date
+                }
+                anim_data.update({j:d})
+                j += 1
 
         df_anim = pd.DataFrame.from_dict(anim_data, orient='index')
         df_no_anim = pd.DataFrame.from_dict(no_anim_data, orient='index')
@@ -1104,48 +1216,36 @@ elif mode == "Map":
             st.warning("No data for state available with selected data type")
                           
     elif map_type == "European Countries":
-        countries = []
-        for country in world_node.get_children():
-            try:
-                iso2 = pc.country_alpha3_to_country_alpha2(country.iso3)
-            except KeyError:
-                continue
-            try:
-                continent = pc.country_alpha2_to_continent_code(iso2)
-                if continent == "EU":
-                    countries.append(country)
-            except KeyError:
-                continue
+        europe = covid_data.get_region_group(CONTINENT_NAMES["EU"])
+        countries = europe.members if europe is not None else []
+            
+        countries, latest, animation = get_map_data(covid_data, [i for i in countries if i.iso3], data_options.get(data_type))
             
         anim_data = {}
         no_anim_data = {}
         zero_data = []
         j = 0
         for i, country in enumerate(countries):
-            node_data = getattr(country, data_options.get(data_type))
-            if callable(node_data):
-                node_data = node_data()
-            if node_data and country.iso3:
+            d = {
+                "iso_code":country.iso3,
+                "data":latest[i] if latest[i] is not None else 0,
+                "country":country.node_name
+            }
+            no_anim_data.update({i:d})
+
+            if latest[i] == 0 or latest[i] is None:
+                zero_data.append(country.node_name)
+        for date, frame_data in animation:
+            for country, datapoint in zip(countries, frame_data):
                 d = {
                     "iso_code":country.iso3,
-                    "data":node_data[-1] if node_data[-1] is not None else 0,
-                    "country":country.node_name
+                    "data":datapoint if datapoint is not None else 0,
+                    "country":country.node_name,
+                    "date":date
                 }
-                no_anim_data.update({j:d})
-                for k, datapoint in enumerate(node_data):
-                    d = {
-                        "iso_code":country.iso3,
-                        "data":datapoint if datapoint is not None else 0,
-                        "country":country.node_name,
-                        "date":str(dates[k])
-                    }
-
-                    anim_data.update({j:d})
-                    j += 1
 
+                anim_data.update({j:d})
                 j += 1
-                if node_data[-1] == 0 or (node_data and node_data[-1] is None):
-                    zero_data.append(country.node_name)
                 
         df_anim = pd.DataFrame.from_dict(anim_data, orient='index')
         df_no_anim = pd.DataFrame.from_dict(no_anim_data, orient='index')
@@ -1188,34 +1288,33 @@ elif mode == "Map":
     elif map_type == "World":
         countries = [i for i in  world_node.get_children()]
 
+        countries, latest, animation = get_map_data(covid_data, [i for i in countries if i.iso3], data_options.get(data_type))
+            
         anim_data = {}
         no_anim_data = {}
         zero_data = []
         j = 0
         for i, country in enumerate(countries):
-            node_data = getattr(country, data_options.get(data_type))
-            if callable(node_data):
-                node_data = node_data()
-            if node_data and country.iso3:
+            d = {
+                "iso_code":country.iso3,
+                "data":latest[i] if latest[i] is not None else 0,
+                "country":country.node_name
+            }
+            no_anim_data.update({i:d})
+
+            if latest[i] == 0 or latest[i] is None:
+                zero_data.append(country.node_name)
+        for date, frame_data in animation:
+            for country, datapoint in zip(countries, frame_data):
                 d = {
                     "iso_code":country.iso3,
-                    "data":node_data[-1] if node_data[-1] is not None else 0,
-                    "country":country.node_name
+                    "data":datapoint if datapoint is not None else 0,
+                    "country":country.node_name,
+                    "date":date
                 }
-                no_anim_data.update({j:d})
-                for k, datapoint in enumerate(node_data):
-                    d = {
-                        "iso_code":country.iso3,
-                        "data":datapoint if datapoint is not None else 0,
-                        "country":country.node_name,
-                        "date":str(dates[k])
-                    }
-
-                    anim_data.update({j:d})
-                    j += 1
-
-                if node_data[-1] == 0 or (node_data and node_data[-1] is None):
-                    zero_data.append(country.node_name)
+
+                anim_data.update({j:d})
+                j += 1
                 
         df_anim = pd.DataFrame.from_dict(anim_data, orient='index')
         df_no_anim = pd.DataFrame.from_dict(no_anim_data, orient='index')
@@ -1256,34 +1355,30 @@ elif mode == "Map":
  
 elif mode == "Parsed Data - Time Series":
     data_type = st.sidebar.selectbox("Data Table Entry", sorted(data_options.keys()))
-    plotted_areas = get_regions(world_node)
+    plotted_areas = get_regions(world_node, covid_data.get_region_groups())
     
-    columns = {}
+    plotted_nodes = []
     for node in plotted_areas:
-        data = getattr(node, data_options.get(data_type))
-        if callable(data):
-            data = data()
-            
-        if data:
-            columns.update({node.node_name:data})
+        if covid_data.get_node_window(node, data_options.get(data_type)) is not None:
+            plotted_nodes.append(node)
         else:
             st.warning("No " + data_type + " data was found for " + node.node_name)
 
-    df = pd.DataFrame(columns, index=dates)
+    df = covid_data.to_frame(data_options.get(data_type), plotted_nodes, layout="wide")
     st.dataframe(df)
 
     
     
     
 elif mode == "Parsed Data - Daily Reports":
-    plotted_areas = get_regions(world_node)
+    plotted_areas = get_regions(world_node, covid_data.get_region_groups())
     
-    for node in plotted_areas:
+    # evaluate every metric for all regions in one pass so intermediate results are shared between metrics
+    results = covid19_metrics.evaluate(plotted_areas, list(data_options.values()))
+    for i, node in enumerate(plotted_areas):
         columns = {}
-        for data_name, data_attribute in data_options.items():
-            data = getattr(node, data_attribute)
-            if callable(data):
-                data = data()
+        for data_name, metric_name in data_options.items():
+            data = results[metric_name][i]
             if data:
                 columns.update({data_name:data})
             else: